@@ -0,0 +1,266 @@
+import collections
+import functools
+import math
+import threading
+import time
+
+import metrics
+
+#
+# Request admission and load shedding, for the query_server and feature_server.
+#
+# Each server runs at most --max_concurrent requests on its expensive endpoints at once; the rest wait in bounded
+# queues, one per priority, and are admitted interactive first, then batch (index.py sends X-Priority: batch).
+# Every request has a deadline: the caller's X-Deadline-Ms (milliseconds left), capped at --deadline_ms
+# (--batch_deadline_ms for batch).  A request is rejected with 503 and a Retry-After header, without doing any work, if
+#   * its priority's queue is full
+#   * the queue ahead of it, times the recent service time, won't drain before its deadline
+#   * it is still waiting when its deadline passes
+# so under overload the queue stays short and the requests that are admitted still finish in time, instead of
+# every request slowing down.  The query_server passes its priority and remaining deadline on to the feature_server,
+# and times out its call when the deadline passes.
+#
+# Metrics:
+#   ridley_admission_queue_depth{priority}          requests waiting
+#   ridley_admission_in_flight                      requests running
+#   ridley_admission_shed_total{priority, reason}   requests rejected: queue_full, deadline, or upstream (the feature_server)
+#   ridley_admission_wait_seconds{priority}         time from arrival to admission
+#
+
+PRIORITIES = ["interactive", "batch"]
+
+PRIORITY_HEADER = "X-Priority"
+DEADLINE_HEADER = "X-Deadline-Ms"
+
+# Weight of the latest request in the moving average of service time
+_service_time_weight = 0.1
+
+_queue_depth = metrics.gauge("ridley_admission_queue_depth", "Requests waiting for admission, by priority")
+_in_flight = metrics.gauge("ridley_admission_in_flight", "Requests admitted and running")
+_shed = metrics.counter("ridley_admission_shed_total", "Requests rejected with 503, by priority and reason")
+_wait = metrics.histogram("ridley_admission_wait_seconds", "Time from arrival to admission, by priority")
+
+
+# Raised when a request can't be served in time; becomes a 503 with Retry-After
+class Overloaded(Exception):
+    def __init__(self, message, retry_after = 1, reason = "upstream"):
+        Exception.__init__(self, message)
+        self.retry_after = max(1, int(math.ceil(retry_after)))
+        self.reason = reason
+
+
+class _Waiter(object):
+    def __init__(self, priority, deadline):
+        self.priority = priority
+        self.deadline = deadline
+        self.admitted = False
+
+
+class Admission(object):
+    def __init__(self, max_concurrent = 4, max_queue = 32, max_batch_queue = 8):
+        self._max_concurrent = max(1, max_concurrent)
+        self._max_queue = { "interactive" : max_queue, "batch" : max_batch_queue }
+        self._queues = dict((priority, collections.deque()) for priority in PRIORITIES)
+        self._in_flight = 0
+        self._service_time = None
+        self._condition = threading.Condition()
+
+        for priority in PRIORITIES:
+            _queue_depth.set(0, priority = priority)
+        _in_flight.set(0)
+
+
+    # Wait for a slot, until deadline (a time.time()).  Returns the admission time; raises Overloaded if shed.
+    def acquire(self, priority, deadline):
+        arrived = time.time()
+
+        with self._condition:
+            ahead = self._waiting_ahead(priority)
+            if self._in_flight < self._max_concurrent and ahead == 0:
+                return self._admit(priority, arrived)
+
+            queue = self._queues[priority]
+            if len(queue) >= self._max_queue[priority]:
+                raise self._overloaded(priority, "queue_full", ahead)
+
+            # Shed now, rather than after waiting, if the requests ahead won't be done in time
+            if arrived + self._expected_wait(ahead) > deadline:
+                raise self._overloaded(priority, "deadline", ahead)
+
+            waiter = _Waiter(priority, deadline)
+            queue.append(waiter)
+            _queue_depth.set(len(queue), priority = priority)
+
+            while not waiter.admitted:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    # _admit_next may already have dropped it
+                    if waiter in queue:
+                        queue.remove(waiter)
+                        _queue_depth.set(len(queue), priority = priority)
+                    raise self._overloaded(priority, "deadline", self._waiting_ahead(priority))
+
+                self._condition.wait(remaining)
+
+            _wait.observe(time.time() - arrived, priority = priority)
+            return time.time()
+
+
+    # Give up the slot of a request admitted at start, and admit the next waiter
+    def release(self, start):
+        with self._condition:
+            elapsed = time.time() - start
+            if self._service_time is None:
+                self._service_time = elapsed
+            else:
+                self._service_time += _service_time_weight * (elapsed - self._service_time)
+
+            self._in_flight -= 1
+            self._admit_next()
+            _in_flight.set(self._in_flight)
+
+
+    def _admit(self, priority, arrived):
+        self._in_flight += 1
+        _in_flight.set(self._in_flight)
+        _wait.observe(time.time() - arrived, priority = priority)
+        return time.time()
+
+
+    # Hand free slots to waiters, highest priority first, dropping any whose deadline has already passed
+    # (they wake up and shed themselves)
+    def _admit_next(self):
+        now = time.time()
+
+        for priority in PRIORITIES:
+            queue = self._queues[priority]
+            while queue and self._in_flight < self._max_concurrent:
+                waiter = queue.popleft()
+                if waiter.deadline > now:
+                    waiter.admitted = True
+                    self._in_flight += 1
+
+            _queue_depth.set(len(queue), priority = priority)
+
+        self._condition.notify_all()
+
+
+    # Requests that will be admitted before a new one of this priority
+    def _waiting_ahead(self, priority):
+        ahead = 0
+        for other in PRIORITIES:
+            ahead += len(self._queues[other])
+            if other == priority:
+                break
+
+        return ahead
+
+
+    # Seconds until the requests ahead, and the new one, get a slot
+    def _expected_wait(self, ahead):
+        if self._service_time is None:
+            return 0.0
+
+        return (ahead + 1) * self._service_time / self._max_concurrent
+
+
+    def _overloaded(self, priority, reason, ahead):
+        _shed.inc(priority = priority, reason = reason)
+        return Overloaded("overloaded: %s (%d requests waiting)" % (reason.replace("_", " "), ahead),
+                          self._expected_wait(ahead), reason)
+
+
+# The request's priority, from its X-Priority header
+def request_priority(request):
+    priority = request.headers.get(PRIORITY_HEADER, "interactive").strip().lower()
+    return priority if priority in PRIORITIES else "interactive"
+
+
+# The request's deadline, as a time.time(): X-Deadline-Ms from now, capped at the server's deadline for its priority
+def request_deadline(request, priority, args):
+    seconds = (args.batch_deadline_ms if priority == "batch" else args.deadline_ms) / 1000.0
+
+    try:
+        seconds = min(seconds, float(request.headers[DEADLINE_HEADER]) / 1000.0)
+    except (KeyError, ValueError):
+        pass
+
+    return time.time() + seconds
+
+
+# A 503 for a shed request
+def overloaded_response(ex):
+    from flask import jsonify
+
+    response = jsonify({ "message" : str(ex) })
+    response.status_code = 503
+    response.headers["Retry-After"] = str(ex.retry_after)
+    return response
+
+
+# Decorator for Flask / flask_restful handlers: admit the request through admission (or shed it with a 503).
+# get_admission returns the Admission, or None to admit everything; get_args returns the parsed command line.
+# The handler can read the deadline and priority from flask.g, and raise Overloaded itself, e.g. if a call it
+# depends on is shed or times out.  A streamed response is generated after the handler returns, so it keeps the
+# slot until it has been sent (or the client hangs up).
+def admitted(get_admission, get_args):
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(*args, **kwargs):
+            from flask import g, request
+
+            admission = get_admission()
+            g.priority = request_priority(request)
+            g.deadline = request_deadline(request, g.priority, get_args())
+
+            start = None
+            if admission is not None:
+                try:
+                    with metrics.stage("admission"):
+                        start = admission.acquire(g.priority, g.deadline)
+                except Overloaded as ex:
+                    return overloaded_response(ex)
+
+            release = start is not None
+            try:
+                response = handler(*args, **kwargs)
+                if release and getattr(response, "is_streamed", False):
+                    response.call_on_close(functools.partial(admission.release, start))
+                    release = False
+                return response
+            except Overloaded as ex:
+                _shed.inc(priority = g.priority, reason = ex.reason)
+                return overloaded_response(ex)
+            finally:
+                if release:
+                    admission.release(start)
+
+        return wrapper
+
+    return decorator
+
+
+# Seconds left until the current request's deadline (see admitted()); raises Overloaded if it has passed
+def remaining_seconds():
+    from flask import g
+
+    remaining = g.deadline - time.time()
+    if remaining <= 0:
+        raise Overloaded("deadline passed", 1, "deadline")
+
+    return remaining
+
+
+# Headers that pass the current request's priority and remaining deadline on to a server it calls
+def forward_headers():
+    from flask import g
+
+    return { PRIORITY_HEADER : g.priority, DEADLINE_HEADER : str(int(remaining_seconds() * 1000)) }
+
+
+def add_arguments(parser, max_concurrent = 4):
+    parser.add_argument("--max_concurrent", help="requests to serve at once; the rest wait in a queue", type=int, default=max_concurrent)
+    parser.add_argument("--max_queue", help="interactive requests that may wait; more are rejected with 503", type=int, default=32)
+    parser.add_argument("--max_batch_queue", help="batch (X-Priority: batch) requests that may wait", type=int, default=8)
+    parser.add_argument("--deadline_ms", help="longest an interactive request may take, including its wait", type=int, default=2000)
+    parser.add_argument("--batch_deadline_ms", help="longest a batch request may take, including its wait", type=int, default=30000)
@@ -0,0 +1,426 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import diversify
+import index_format
+import normalize
+import profiling
+import search
+import snapshot
+from database import Database
+
+#
+# Offline search benchmarks: index load time, peak RSS, single-query latency, batch throughput,
+# and recall@k against exact search, for every Database search backend.  With --diversify, also the latency of
+# diversifying each query's results (see diversify.py), on top of its search.
+#
+#   generate    write a synthetic index (clustered random vectors) of any size and dimension
+#   run         benchmark an index with each backend, and save the results as JSON
+#
+# Each backend runs in its own process, so load time and peak RSS aren't polluted by the other backends.
+# Every backend is benchmarked loading each of --formats:
+#   csv         the index itself, ignoring any snapshot
+#   snapshot    a snapshot (see snapshot.py) built for the backend in a scratch folder first; results are
+#               reported as <backend>/snapshot, with the time it took to build as snapshot_build_seconds
+# Query vectors are database vectors plus a little noise; exact top-k neighbors are computed once, by brute force.
+#
+# With --baseline, results are compared to a previous run, and the exit status is non-zero if anything
+# got worse by more than --tolerance.
+#
+#   python benchmark.py generate synthetic_1M.index --rows 1000000 --dim 514
+#   python benchmark.py run synthetic_1M.index --output bench.json --baseline bench_previous.json
+#   python benchmark.py run synthetic_1M.index --backends brute --diversify mmr
+#
+
+
+def _main():
+    parser = argparse.ArgumentParser()
+    modes = parser.add_subparsers(dest="mode")
+
+    generate = modes.add_parser("generate", help="write a synthetic index")
+    generate.add_argument("output", help="filename of the synthetic index")
+    generate.add_argument("--format", help="index format [%s] default csv" % ", ".join(sorted(_writers.keys())), choices=sorted(_writers.keys()), default="csv")
+    generate.add_argument("--rows", help="number of images", type=int, default=100000)
+    generate.add_argument("--dim", help="feature vector length", type=int, default=514)
+    generate.add_argument("--classes", help="number of classes (clusters)", type=int, default=256)
+    generate.add_argument("--seed", help="random seed", type=int, default=1975)
+    generate.add_argument("--force", help="force overwrite of existing index file", action="store_true")
+
+    run = modes.add_parser("run", help="benchmark an index with every backend")
+    run.add_argument("database", help="index to benchmark")
+    run.add_argument("--backends", help="comma-separated list of backends; default all of %s" % ", ".join(search.backends()), default=",".join(search.backends()))
+    run.add_argument("--formats", help="comma-separated list of formats to load the index from [%s] default all" % ", ".join(_formats), default=",".join(_formats))
+    run.add_argument("--queries", help="number of single queries to time", type=int, default=1000)
+    run.add_argument("--batch_size", help="number of queries per batch, for throughput", type=int, default=256)
+    run.add_argument("--k", help="number of neighbors per query", type=int, default=10)
+    run.add_argument("--noise", help="std dev of the noise added to query vectors, relative to the data", type=float, default=0.05)
+    run.add_argument("--metric", help="similariity metric [euclidean, cosine] default euclidean", default="euclidean")
+    run.add_argument("--seed", help="random seed", type=int, default=1975)
+    run.add_argument("--output", help="write results as JSON to this file")
+    run.add_argument("--baseline", help="JSON results of a previous run to compare against")
+    run.add_argument("--tolerance", help="allowed relative regression vs. the baseline", type=float, default=0.1)
+    search.add_arguments(run)
+    diversify.add_arguments(run)
+
+    # Internal: benchmark one backend in a fresh process
+    worker = modes.add_parser("worker")
+    worker.add_argument("database")
+    worker.add_argument("workdir")
+    worker.add_argument("result")
+    worker.add_argument("--k", type=int)
+    worker.add_argument("--batch_size", type=int)
+    worker.add_argument("--metric")
+    worker.add_argument("--format", choices=_formats)
+    search.add_arguments(worker)
+    diversify.add_arguments(worker)
+
+    args = parser.parse_args()
+
+    if args.mode == "generate":
+        return _generate(args)
+    elif args.mode == "run":
+        return _run(args)
+    elif args.mode == "worker":
+        return _worker(args)
+
+    parser.print_help()
+    return -1
+
+
+#
+# generate
+#
+
+def _generate(args):
+    if os.path.exists(args.output) and not args.force:
+        print("Error: %s exists; use --force to overwrite" % args.output)
+        return -1
+
+    print("Generating %d x %d vectors in %d classes (%s)..." % (args.rows, args.dim, args.classes, args.format))
+    start = time.time()
+    _writers[args.format](args.output, synthetic_vectors(args.rows, args.dim, args.classes, args.seed))
+    print("Wrote %s in %.1f s" % (args.output, time.time() - start))
+
+    return 0
+
+
+# Yields (classname, filename, features) for a synthetic index: one Gaussian cluster per class,
+# with features[0] = label / classes and features[1] = a probability, like the feature_server's vectors.
+def synthetic_vectors(rows, dim, classes, seed, block = 10000):
+    random = np.random.RandomState(seed)
+    centers = random.normal(0.0, 1.0, size = (classes, dim)).astype(np.float32)
+
+    for start in range(0, rows, block):
+        count = min(block, rows - start)
+        labels = random.randint(0, classes, size = count)
+        X = centers[labels] + random.normal(0.0, 0.5, size = (count, dim)).astype(np.float32)
+        X[:, 0] = labels / float(classes)
+        X[:, 1] = random.uniform(0.2, 1.0, size = count)
+
+        for i in range(count):
+            classname = "class_%04d" % labels[i]
+            yield classname, "/synthetic/%s/%08d.jpg" % (classname, start + i), X[i]
+
+
+def _write_csv(path, records):
+    with open(path, "wt") as index:
+        index_format.write_header(index)
+        for classname, filename, features in records:
+            index_format.write_record(index, classname, filename, features)
+
+
+# Index formats that generate can write
+_writers = {
+    "csv" : _write_csv,
+}
+
+# Formats run loads an index from
+_formats = ["csv", "snapshot"]
+
+
+#
+# run
+#
+
+def _run(args):
+    if not os.path.exists(args.database):
+        print("Error: %s not found" % args.database)
+        return -1
+
+    backends = [backend for backend in args.backends.split(",") if backend]
+    formats = [name for name in args.formats.split(",") if name]
+    for name in formats:
+        if name not in _formats:
+            print("Error: unknown format %s; expected one of %s" % (name, ", ".join(_formats)))
+            return -1
+
+    # hnsw keeps float32 vectors in its graph, so it only runs at float32 (see search.py)
+    if args.precision != "float32" and "hnsw" in backends:
+        print("Skipping hnsw: it only runs at float32")
+        backends.remove("hnsw")
+    workdir = tempfile.mkdtemp(prefix = "benchmark_")
+
+    # Queries and exact ground truth, shared by every backend
+    print("Computing exact neighbors for %d queries..." % args.queries)
+    _, _, X = index_format.read_index(args.database)
+    random = np.random.RandomState(args.seed)
+    rows = random.randint(0, len(X), size = args.queries)
+    Q = X[rows] + random.normal(0.0, args.noise * X.std(), size = (args.queries, X.shape[1]))
+
+    # Ground truth in the space the Database searches: normalized, if the index has a normalizer
+    metric = args.metric
+    normalizer = normalize.from_metadata(index_format.read_header(args.database)[0])
+    if normalizer is not None:
+        X, Q_normalized = normalizer.transform(X), normalizer.transform(Q)
+        metric = "inner" if normalizer.unit_norm and metric == "cosine" else metric
+    else:
+        Q_normalized = Q
+
+    exact = search.BruteForceSearch(X, metric)
+    _, truth = exact.search(Q_normalized, args.k)
+    np.save(os.path.join(workdir, "queries.npy"), Q)
+    np.save(os.path.join(workdir, "truth.npy"), truth)
+    num_rows, num_features = X.shape
+    del X, exact
+
+    results = {
+        "config" : {
+            "database" : args.database,
+            "rows" : num_rows,
+            "features" : num_features,
+            "index_bytes" : os.path.getsize(args.database),
+            "queries" : args.queries,
+            "batch_size" : args.batch_size,
+            "k" : args.k,
+            "metric" : args.metric,
+            "precision" : args.precision,
+            "formats" : formats,
+            "diversify" : args.diversify,
+            "time" : time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "backends" : {},
+    }
+
+    for backend in backends:
+        search_args = ["--backend", backend, "--metric", args.metric, "--filter_brute_threshold", str(args.filter_brute_threshold),
+                       "--hnsw_m", str(args.hnsw_m), "--hnsw_ef_construction", str(args.hnsw_ef_construction), "--hnsw_ef", str(args.hnsw_ef),
+                       "--precision", args.precision, "--rerank", str(args.rerank)]
+
+        for name in formats:
+            label = backend if name == "csv" else "%s/%s" % (backend, name)
+            print("\nBenchmarking %s..." % label)
+            log_path = os.path.join(workdir, label.replace("/", "_") + ".log")
+
+            database = args.database
+            build_seconds = None
+            if name == "snapshot":
+                # Build the snapshot next to a link to the index, so the benchmark never touches the index's own
+                database, build_seconds = _build_snapshot(args.database, workdir, backend, search_args, log_path)
+                if database is None:
+                    print("Error: building a %s snapshot failed; see %s" % (backend, log_path))
+                    results["backends"][label] = { "error" : "snapshot build failed" }
+                    continue
+
+            result_path = os.path.join(workdir, label.replace("/", "_") + ".json")
+            command = [sys.executable, os.path.abspath(__file__), "worker", database, workdir, result_path, "--format", name,
+                       "--k", str(args.k), "--batch_size", str(args.batch_size),
+                       "--diversify", args.diversify, "--diversify_depth", str(args.diversify_depth)] + search_args
+            if args.diversity is not None:
+                command += ["--diversity", str(args.diversity)]
+
+            with open(log_path, "at") as log:
+                status = subprocess.call(command, stdout = log, stderr = subprocess.STDOUT)
+
+            if status != 0 or not os.path.exists(result_path):
+                print("Error: %s failed; see %s" % (label, log_path))
+                results["backends"][label] = { "error" : "exit status %d" % status }
+                continue
+
+            with open(result_path, "rt") as f:
+                results["backends"][label] = json.load(f)
+            if build_seconds is not None:
+                results["backends"][label]["snapshot_build_seconds"] = build_seconds
+
+            _print_result(label, results["backends"][label], args.k)
+
+    if args.output:
+        with open(args.output, "wt") as f:
+            json.dump(results, f, indent = 2)
+        print("\nWrote %s" % args.output)
+
+    if args.baseline:
+        with open(args.baseline, "rt") as f:
+            baseline = json.load(f)
+
+        regressions = compare(baseline, results, args.tolerance)
+        if regressions:
+            print("\nRegressions vs. %s:" % args.baseline)
+            for regression in regressions:
+                print("  " + regression)
+            return 1
+
+        print("\nNo regressions vs. %s" % args.baseline)
+
+    return 0
+
+
+# Build a snapshot of the index for a backend in the work folder, in its own process; returns the path of the index
+# to load it from (a link to the index) and the build time, or (None, None) if the build failed
+def _build_snapshot(database, workdir, backend, search_args, log_path):
+    link = os.path.join(workdir, "%s_%s" % (backend, os.path.basename(database)))
+    if not os.path.exists(link):
+        os.symlink(os.path.abspath(database), link)
+
+    start = time.time()
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "snapshot.py"), link] + search_args
+    with open(log_path, "wt") as log:
+        status = subprocess.call(command, stdout = log, stderr = subprocess.STDOUT)
+
+    if status != 0 or not os.path.exists(snapshot.directory(link)):
+        return None, None
+
+    return link, time.time() - start
+
+
+# (metric, True if bigger is better)
+_compared_metrics = [
+    ("load_seconds", False),
+    ("peak_rss_mb", False),
+    ("p50_ms", False),
+    ("p99_ms", False),
+    ("batch_qps", True),
+    ("recall", True),
+    ("diversify_p50_ms", False),
+    ("diversify_p99_ms", False),
+]
+
+
+# Returns a list of human-readable regressions between two sets of results
+def compare(baseline, results, tolerance):
+    regressions = []
+
+    for backend, result in results["backends"].items():
+        previous = baseline.get("backends", {}).get(backend)
+        if not previous or "error" in previous or "error" in result:
+            continue
+
+        for metric, bigger_is_better in _compared_metrics:
+            old, new = previous.get(metric), result.get(metric)
+            if old is None or new is None or old == 0:
+                continue
+
+            change = (new - old) / abs(old)
+            if (bigger_is_better and change < -tolerance) or (not bigger_is_better and change > tolerance):
+                regressions.append("%s %s: %.3f -> %.3f (%+.1f%%)" % (backend, metric, old, new, 100.0 * change))
+
+    return regressions
+
+
+def _print_result(backend, result, k):
+    print("%-14s load %7.2f s  peak RSS %8.1f MB  p50 %8.3f ms  p99 %8.3f ms  batch %9.1f q/s  recall@%d %.4f" %
+          (backend, result["load_seconds"], result["peak_rss_mb"], result["p50_ms"], result["p99_ms"],
+           result["batch_qps"], k, result["recall"]))
+
+    if "diversify_p50_ms" in result:
+        print("%-14s diversify p50 %8.3f ms  p99 %8.3f ms  (%d candidates)" %
+              (backend, result["diversify_p50_ms"], result["diversify_p99_ms"], result["diversify_candidates"]))
+
+
+#
+# worker
+#
+
+def _worker(args):
+    Q = np.load(os.path.join(args.workdir, "queries.npy"))
+    truth = np.load(os.path.join(args.workdir, "truth.npy"))
+    rss_before = profiling.peak_rss_mb()
+
+    # csv loads the index even if there's a snapshot next to it; snapshot must find an up-to-date one
+    args.verbose = False
+    args.ignore_snapshot = args.format != "snapshot"
+    if args.format == "snapshot" and snapshot.find(args.database, args) is None:
+        print("Error: no up-to-date snapshot of %s for these settings" % args.database)
+        return -1
+
+    start = time.time()
+    database = Database(args)
+    database.load_database(args.database)
+    load_seconds = time.time() - start
+
+    # Single queries, one at a time
+    latencies = np.empty(len(Q))
+    found = np.empty((len(Q), args.k), dtype = np.int64)
+    for i in range(len(Q)):
+        start = time.time()
+        _, ids = database.search_batch(Q[i : i + 1], args.k)
+        latencies[i] = time.time() - start
+        found[i] = ids[0]
+
+    # Batches
+    start = time.time()
+    for batch in range(0, len(Q), args.batch_size):
+        database.search_batch(Q[batch : batch + args.batch_size], args.k)
+    batch_seconds = time.time() - start
+
+    result = {
+        "load_seconds" : load_seconds,
+        "peak_rss_mb" : profiling.peak_rss_mb(),
+        "rss_before_load_mb" : rss_before,
+        "p50_ms" : 1000.0 * float(np.percentile(latencies, 50)),
+        "p99_ms" : 1000.0 * float(np.percentile(latencies, 99)),
+        "mean_ms" : 1000.0 * float(latencies.mean()),
+        "batch_qps" : len(Q) / batch_seconds if batch_seconds > 0 else 0.0,
+        "recall" : recall(found, truth),
+    }
+
+    if args.diversify != "none":
+        result.update(_benchmark_diversify(database, Q, args))
+
+    with open(args.result, "wt") as f:
+        json.dump(result, f, indent = 2)
+
+    return 0
+
+
+# Latency of diversifying each query's over-fetched results, without the search itself
+def _benchmark_diversify(database, Q, args):
+    diversity = diversify.from_args(args)
+    pool = diversify.pool_size(args.k, args.diversify_depth)
+
+    latencies = np.empty(len(Q))
+    for i in range(len(Q)):
+        X = database.normalize(Q[i : i + 1])
+        distances, ids = database.search_batch(X, pool, normalized = True)
+        found = ids[0] >= 0
+
+        start = time.time()
+        database.diversify(X, distances[0][found], ids[0][found], args.k, diversity)
+        latencies[i] = time.time() - start
+
+    return {
+        "diversify_p50_ms" : 1000.0 * float(np.percentile(latencies, 50)),
+        "diversify_p99_ms" : 1000.0 * float(np.percentile(latencies, 99)),
+        "diversify_candidates" : min(pool, diversify.MAX_POOL),
+    }
+
+
+# Fraction of the exact k nearest neighbors that were found
+def recall(found, truth):
+    hits = 0
+    for row in range(len(truth)):
+        hits += len(np.intersect1d(found[row], truth[row][truth[row] >= 0]))
+
+    return hits / float(np.count_nonzero(truth >= 0))
+
+
+if __name__ == "__main__":
+    sys.exit(_main())
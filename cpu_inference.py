@@ -0,0 +1,219 @@
+import copy
+import os
+import time
+
+import torch
+import torch.nn as nn
+
+#
+# CPU inference optimizations for the feature_server.
+#
+# Without a GPU the feature_server runs the eager-mode fp32 Resnet50 with default threading.
+# This module turns that into a CPU-friendly model:
+#   * conv+bn fusion (folds batchnorm into the preceding conv's weights)
+#   * channels-last memory format (NHWC; what the oneDNN / fbgemm conv kernels prefer)
+#   * int8 quantization: dynamic (Linear layers, i.e. the classifier) or static (the conv backbone)
+#   * TorchScript trace or script, then freeze
+#   * intra-op / inter-op thread counts
+#
+# Quantization changes the feature vectors, so optimize() compares the optimized model against the
+# fp32 model on a set of calibration images, and falls back to fp32 if the features drift too far.
+# Otherwise we would silently hurt search quality.
+#
+
+_image_extensions = (".jpg", ".jpeg", ".png")
+
+
+def add_arguments(parser):
+    parser.add_argument("--jit", help="compile the model with TorchScript [none, trace, script] default none", choices=["none", "trace", "script"], default="none")
+    parser.add_argument("--quantize", help="int8 quantization [none, dynamic, static] default none. dynamic quantizes Linear layers (the classifier); static quantizes the conv backbone and needs --calibration", choices=["none", "dynamic", "static"], default="none")
+    parser.add_argument("--fuse", help="fuse conv+bn layers", action="store_true")
+    parser.add_argument("--channels_last", help="use channels-last (NHWC) memory format", action="store_true")
+    parser.add_argument("--threads", help="number of intra-op threads for inference", type=int, default=None)
+    parser.add_argument("--interop_threads", help="number of inter-op threads for inference", type=int, default=None)
+    parser.add_argument("--calibration", help="folder of images used to calibrate static quantization and to check accuracy against fp32", default=None)
+    parser.add_argument("--calibration_images", help="max number of calibration images to use", type=int, default=64)
+    parser.add_argument("--min_similarity", help="minimum cosine similarity between optimized and fp32 feature vectors; falls back to fp32 below this", type=float, default=0.99)
+
+
+# Are any CPU optimizations requested?
+def enabled(args):
+    return args.jit != "none" or args.quantize != "none" or args.fuse or args.channels_last
+
+
+# Must be called before the first forward pass: the inter-op pool can't be resized once it has started.
+def configure_threads(args):
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    if args.interop_threads:
+        try:
+            torch.set_num_interop_threads(args.interop_threads)
+        except RuntimeError as ex:
+            print("WARNING: can't set inter-op threads: %s" % ex)
+
+    print("CPU threads: intra-op %d, inter-op %d" % (torch.get_num_threads(), torch.get_num_interop_threads()))
+
+
+# Load and preprocess up to max_images images from a folder (recursively).
+# preprocess() takes the raw image bytes and returns a minibatch tensor, exactly as the server would.
+def load_calibration_batches(folder, preprocess, max_images):
+    batches = []
+
+    for root, dirs, files in os.walk(folder):
+        dirs.sort()
+        for name in sorted(files):
+            if name[0] == "." or not name.lower().endswith(_image_extensions):
+                continue
+
+            path = os.path.join(root, name)
+            try:
+                with open(path, "rb") as f:
+                    batches.append(preprocess(f.read()))
+            except Exception as ex:
+                print("Error loading calibration image %s: %s" % (path, ex))
+
+            if len(batches) >= max_images:
+                return batches
+
+    return batches
+
+
+# Build the CPU-optimized (backbone, classifier) pair.
+# backbone and classifier are the fp32 eval-mode modules; example is a minibatch used for tracing.
+# Returns (backbone, classifier, quantize), where quantize is the quantization actually applied, which differs from
+# args.quantize if it couldn't be done; returns the fp32 modules unchanged if the optimized model fails the accuracy check.
+def optimize(backbone, classifier, example, calibration, args):
+    print("Optimizing model for CPU: jit=%s quantize=%s fuse=%s channels_last=%s" %
+          (args.jit, args.quantize, args.fuse, args.channels_last))
+
+    quantize = args.quantize
+    if quantize == "static" and not calibration:
+        print("Error: static quantization requires --calibration images; not quantizing")
+        quantize = "none"
+
+    reference_backbone = backbone
+    reference_classifier = classifier
+    backbone = copy.deepcopy(backbone).eval()
+    classifier = copy.deepcopy(classifier).eval()
+
+    if quantize == "static":
+        # FX graph mode quantization does its own conv+bn(+relu) fusion, and handles the residual adds
+        # that eager-mode quantization would need hand-inserted FloatFunctionals for.
+        backbone = _quantize_static(backbone, calibration)
+    elif args.fuse:
+        fused = fuse_conv_bn(backbone)
+        print("Fused %d conv+bn pairs" % fused)
+
+    if quantize == "dynamic":
+        # Dynamic quantization only covers Linear (and RNN) layers; the conv backbone stays fp32.
+        backbone = torch.quantization.quantize_dynamic(backbone, {nn.Linear}, dtype=torch.qint8)
+        classifier = torch.quantization.quantize_dynamic(classifier, {nn.Linear}, dtype=torch.qint8)
+
+    if args.channels_last:
+        backbone = backbone.to(memory_format=torch.channels_last)
+        example = example.contiguous(memory_format=torch.channels_last)
+
+    if args.jit == "trace":
+        backbone = torch.jit.trace(backbone, example)
+        backbone = _freeze(backbone)
+    elif args.jit == "script":
+        backbone = torch.jit.script(backbone)
+        backbone = _freeze(backbone)
+
+    # Warm up: the first couple of calls to a TorchScript module run the profiling executor
+    start = time.time()
+    for _ in range(2):
+        classifier(backbone(example))
+    print("Warmup: %d ms" % ((time.time() - start) * 1000))
+
+    if calibration:
+        if not check_accuracy(reference_backbone, reference_classifier, backbone, classifier, calibration, args):
+            print("WARNING: optimized model failed the accuracy check; falling back to fp32")
+            return reference_backbone, reference_classifier, "none"
+    elif quantize != "none":
+        print("WARNING: no --calibration images; can't check accuracy of the quantized model")
+
+    return backbone, classifier, quantize
+
+
+# Compare the optimized model against fp32 on the calibration images.
+# Reports cosine similarity of the feature vectors, and how often the top-1 class agrees.
+def check_accuracy(reference_backbone, reference_classifier, backbone, classifier, calibration, args):
+    similarities = []
+    agree = 0
+
+    for batch in calibration:
+        expected = reference_backbone(batch)
+        expected_classes = reference_classifier(expected)
+
+        if args.channels_last:
+            batch = batch.contiguous(memory_format=torch.channels_last)
+
+        actual = backbone(batch)
+        actual_classes = classifier(actual)
+
+        similarity = nn.functional.cosine_similarity(expected.flatten(1).float(), actual.flatten(1).float())
+        similarities.extend(similarity.tolist())
+        agree += int((expected_classes.argmax(1) == actual_classes.argmax(1)).sum())
+
+    similarities = torch.tensor(similarities)
+    min_similarity = float(similarities.min())
+    mean_similarity = float(similarities.mean())
+    top_1_agreement = 100.0 * agree / len(similarities)
+
+    print("Accuracy vs fp32 (%d images): cosine mean = %.4f min = %.4f, top-1 agreement = %6.2f%%" %
+          (len(similarities), mean_similarity, min_similarity, top_1_agreement))
+
+    return min_similarity >= args.min_similarity
+
+
+# Fold every BatchNorm2d into the Conv2d that precedes it, in place.
+# Relies on child modules being registered in the order they're applied (true for torchvision-style Resnets:
+# conv1, bn1, ... and downsample = Sequential(conv, bn)).
+# Returns the number of pairs fused.
+def fuse_conv_bn(module):
+    fused = 0
+    children = list(module.named_children())
+
+    for i, (name, child) in enumerate(children):
+        if i > 0:
+            prev_name, prev = children[i - 1]
+            if isinstance(prev, nn.Conv2d) and isinstance(child, nn.BatchNorm2d):
+                setattr(module, prev_name, torch.nn.utils.fusion.fuse_conv_bn_eval(prev, child))
+                setattr(module, name, nn.Identity())
+                fused += 1
+                continue
+
+        fused += fuse_conv_bn(child)
+
+    return fused
+
+
+def _quantize_static(backbone, calibration):
+    from torch.quantization import get_default_qconfig
+    from torch.quantization.quantize_fx import prepare_fx, convert_fx
+
+    engine = "fbgemm" if "fbgemm" in torch.backends.quantized.supported_engines else "qnnpack"
+    torch.backends.quantized.engine = engine
+    qconfig = {"": get_default_qconfig(engine)}
+
+    try:
+        prepared = prepare_fx(backbone, qconfig, example_inputs=(calibration[0],))
+    except TypeError:
+        # PyTorch < 1.13 doesn't take example_inputs
+        prepared = prepare_fx(backbone, qconfig)
+
+    print("Calibrating static quantization (%s) on %d images..." % (engine, len(calibration)))
+    for batch in calibration:
+        prepared(batch)
+
+    return convert_fx(prepared)
+
+
+def _freeze(module):
+    # torch.jit.freeze inlines weights and attributes as constants (PyTorch 1.8+)
+    if hasattr(torch.jit, "freeze"):
+        module = torch.jit.freeze(module.eval())
+
+    return module
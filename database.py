@@ -4,9 +4,19 @@ import numpy as np
 import os
 import pandas as pd
 import sys
+import threading
 import time
+from collections import namedtuple
 from stat import *
-from sklearn.neighbors import NearestNeighbors
+
+import index_format
+import diversify
+import normalize
+import profiling
+import regions
+import search
+import snapshot
+from text_index import TextIndex
 
 #
 # Load a Database of images, and let clients search them using a query image.
@@ -15,11 +25,54 @@ from sklearn.neighbors import NearestNeighbors
 # Database also supports vanilla iteration and indexed access for the REST API.
 #
 
+# Restrict a search to images of the given classnames, under a path prefix, and/or within an id range [id_min, id_max].
+# Any field can be None.  Evaluated against posting lists built at load, never by over-fetching results.
+SearchFilter = namedtuple("SearchFilter", "classnames, path_prefix, id_min, id_max")
+
+
+# Metadata index arrays saved in a snapshot, by attribute name (without the leading _)
+_snapshot_arrays = [
+    "row_classnames",
+    "classname_ids",
+    "classname_offsets",
+    "filename_order",
+    "sorted_filenames",
+    "class_feature",
+]
+
+
+# Text + image search: how many times k of the text matches to rank by similarity, and the reciprocal rank fusion constant
+_text_fusion_depth = 10
+_rrf_constant = 60
+
+
 class Database(object):
     def __init__(self, args):
         self._args = args
         self._name = "Database"
         #self.rect = Rect(0, 0, args.width, args.height) 
+
+        # Class partitions: restrict the search to the images whose predicted class matches the query's likely classes
+        self._class_partitions = getattr(args, "class_partitions", False)
+        self._num_classes = getattr(args, "num_classes", 1000)
+        self._min_class_confidence = getattr(args, "min_class_confidence", 0.5)
+        self._class_coverage = getattr(args, "class_coverage", 0.9)
+        self._max_classes = getattr(args, "max_classes", 5)
+
+        # Reduced-precision storage: re-rank rerank * k results with the exact features from the index file
+        self._precision = getattr(args, "precision", "float32")
+        self._rerank = getattr(args, "rerank", 4)
+
+        # Regional descriptors (see regions.py), searched instead of the global vectors when the query has them
+        self._region_search = getattr(args, "region_search", False)
+        self._regions = None
+
+        # Diversified searches pick k of diversify_depth * k results (see diversify.py)
+        self._diversify_depth = getattr(args, "diversify_depth", 4)
+
+        # Inverted index of classname and path words: loaded from a snapshot, or built by the first text query
+        self._text_index = None
+        self._text_index_lock = threading.Lock()
         print("Database: %s" % (str(args)))
 
 
@@ -38,7 +91,7 @@ class Database(object):
                 print("Error: %s is not a valid database" % database_path)
                 return -1
                     
-        except Exception:
+        except Exception as ex:
             print("Error loading database %s" % database_path)
             print(type(ex))
             print(ex.args)
@@ -47,52 +100,125 @@ class Database(object):
 
         self._name = database_path.split(os.path.sep)[-1]
 
+        # Metadata from the index header: e.g. the normalizer fitted when the index was built
+        self._metadata, self._header_length = index_format.read_header(database_path)
+        self._normalizer = normalize.from_metadata(self._metadata)
+
+        # Cosine distance on unit vectors is an inner product
+        self._metric = self._args.metric
+        if self._normalizer is not None and self._normalizer.unit_norm and self._metric == "cosine":
+            self._metric = "inner"
+
+        # Map in the search structure built offline by snapshot.py, if there's an up-to-date one; else build it now
+        manifest = snapshot.find(database_path, self._args)
+        if manifest is not None:
+            self._load_snapshot(snapshot.directory(database_path), manifest)
+        elif self._load_index(database_path) == -1:
+            return -1
+
+        if self._class_partitions:
+            self._build_class_partitions()
+
+        if self._region_search:
+            self._load_regions(database_path)
+
+        # Now that we have in-RAM index of image features, keep an open filehandle to the full database on disk
+        self._db = open(database_path, "rt")
+        self._db_mmap = mmap.mmap(self._db.fileno(), 0, access = mmap.ACCESS_READ)
+        self._records = index_format.record_array(self._db_mmap, self._header_length, self._num_features)
+
+
+    # Parse the index file, and build the metadata index and search structure
+    def _load_index(self, database_path):
         # Load the features[] column of the database, so we can build a kNN for searching.
         # Also serves as an index to the on-disk database, which contains full paths and metadate for the images.
-        #
-        # TODO: very obviously this should be refactored into an offline step, not done at load.
-        # TODO: very obviously this should use a faster structure for searching; kNN slows to 1+ seconds at 1.2M records.
-        # TODO: use Annoy or HNSW for approximate nearest neighbors.
-        # How to memory-map large files from Python?
-        
-        self._index = pd.read_csv(database_path, usecols = ["features"], memory_map = True)
+        self._index = index_format.read_csv(database_path)
    
-        if (self._index.columns.values != ("features")).any():
-            print("Database index has unexpected columns: %s" % str(self.index.columns.values))
+        if sorted(self._index.columns.values) != sorted(index_format.COLUMNS):
+            print("Database index has unexpected columns: %s" % str(self._index.columns.values))
             return -1
 
-        # Convert from string to ndarray of floats
+        self._build_metadata_index()
+        self._index = self._index[["features"]]
+
+        # Convert from string to a [rows x cols] ndarray of floats
         print("Converting from ASCII...")
-        self._index["features"] = self._index["features"].apply(Database._string_to_float_array)
+        X = index_format.parse_features(self._index["features"].values, np.float32)
+        self._index = None
+
+        self._num_items = X.shape[0]
+        self._num_features = X.shape[1]
+        print("Loaded %d rows, %d features" % (self._num_items, self._num_features))
+
+        # The raw predicted class, for class partitions
+        self._class_feature = X[:, 0].copy()
+
+        # Normalize with the same transform that will be applied to queries
+        if self._normalizer is not None:
+            print("Normalizing (%s)..." % self._normalizer.method)
+            X = self._normalizer.transform(X)
+
+        # The search backend keeps the vectors, at --precision
+        backend = getattr(self._args, "backend", "knn")
+        print("Loading %s search (%s, %s)..." % (backend, self._metric, self._precision))
+        self._search = search.create(backend, X, self._metric, self._args)
+        del X
 
-        # Reshape the DataFrame to a [rows x cols] ndarray that knn requires
-        # This is SUPER-HACKY, but it was late on a Saturday night and I needed to move forward.
-        self._num_items = len(self._index)
-        self._num_features = len(self._index["features"][0])
-        new_X = np.ndarray(shape=[self._num_items, self._num_features])
 
-        print("Reshaping...")
-        X = self._index["features"].as_matrix()
-        for i in range(len(X)):
-            f = X[i] # f is a list
-            new_X[i] = f.reshape(1, -1)
+    # Write the metadata index and search structure to files in directory; see snapshot.py.
+    # Returns what the manifest needs to know to load them.
+    def save_snapshot(self, directory):
+        for name in _snapshot_arrays:
+            np.save(os.path.join(directory, name + ".npy"), getattr(self, "_" + name))
 
-        X = new_X
+        self._search.save(directory)
+        self._get_text_index().save(directory)
+
+        return {
+            "classnames" : [str(name) for name in self._classnames],
+            "num_items" : self._num_items,
+            "num_features" : self._num_features,
+        }
+
+
+    def _load_snapshot(self, directory, manifest):
+        print("Loading snapshot %s..." % directory)
+
+        for name in _snapshot_arrays:
+            setattr(self, "_" + name, np.load(os.path.join(directory, name + ".npy"), mmap_mode = "r"))
+
+        self._classnames = np.array(manifest["classnames"], dtype = object)
+        self._classname_codes = dict((name, code) for code, name in enumerate(self._classnames))
+        self._num_items = manifest["num_items"]
+        self._num_features = manifest["num_features"]
+
+        self._search = search.load(manifest["settings"]["backend"], directory, self._metric, self._args)
+        self._text_index = TextIndex.load(directory)
         print("Loaded %d rows, %d features" % (self._num_items, self._num_features))
 
-        print("Loading kNN...")
-        if self._args.metric == "cosine":
-            self._knn = NearestNeighbors(n_neighbors=5, algorithm="auto", metric=metrics.pairwise.cosine_distances, n_jobs=1)
-        else:
-            self._knn = NearestNeighbors(n_neighbors=5, algorithm="auto", metric="euclidean", n_jobs=1)
 
-#        self.knn = NearestNeighbors(n_neighbors=5, algorithm="ball_tree", metric="euclidean", n_jobs=4)         # also consider Chebyshev
-        self._knn.fit(X)
-        print(self._knn)
+    # Regional descriptors stored next to the index by index.py --regions, at --precision
+    def _load_regions(self, database_path):
+        path = regions.path_for(database_path)
+        if "regions" not in self._metadata or not os.path.exists(path):
+            print("WARNING: %s has no regional descriptors; build them with index.py --regions" % database_path)
+            return
 
-        # Now that we have in-RAM index of image features, keep an open filehandle to the full database on disk
-        self._db = open(self._args.database, "rt")
-        self._db_mmap = mmap.mmap(self._db.fileno(), 0, access = mmap.ACCESS_READ)
+        print("Loading regions %s (%s)..." % (path, self._precision))
+        try:
+            region_index = regions.RegionIndex(path, self._precision)
+        except (IOError, ValueError) as ex:
+            print("Error: %s; not searching regions" % ex)
+            return
+
+        # Regions are looked up by image id, so they must match the index one for one
+        if len(region_index) != self._num_items:
+            print("Error: %s has regions for %d images, but the index has %d; not searching regions" %
+                  (path, len(region_index), self._num_items))
+            return
+
+        self._regions = region_index
+        print("Loaded %d regions of %d features" % (region_index.num_regions, region_index.num_features))
 
 
     # Database singleton, for use with a Flask web server, since Flask is stateless between REST calls
@@ -100,7 +226,148 @@ class Database(object):
 #        return self
 
 
-    def query_image(self, feature_vector, k=5):
+    # Posting lists for search filters: ids per classname, and filenames in sorted order for prefix lookups
+    def _build_metadata_index(self):
+        print("Building metadata index...")
+
+        classnames = self._index["classname"].astype(str).str.strip()
+        codes, self._classnames = pd.factorize(classnames, sort = True)
+        self._classname_codes = dict((name, code) for code, name in enumerate(self._classnames))
+
+        self._row_classnames = codes.astype(np.int32)
+        self._classname_ids = np.argsort(codes, kind = "mergesort").astype(np.int64)
+        counts = np.bincount(codes, minlength = len(self._classnames))
+        self._classname_offsets = np.concatenate(([0], np.cumsum(counts)))
+
+        # Sorted as UTF-8 bytes (same order as the strings), so prefix lookups are a binary search of a flat array
+        filenames = self._index["filename"].astype(str).str.strip().str.encode("utf-8").values.astype(bytes)
+        self._filename_order = np.argsort(filenames, kind = "mergesort").astype(np.int64)
+        self._sorted_filenames = filenames[self._filename_order]
+
+        print("%d classnames, %d filenames" % (len(self._classnames), len(self._sorted_filenames)))
+
+
+    # The text index, building it from the metadata index the first time it's needed (not at load, since
+    # most servers never get a text query); snapshots save it, so they never build it
+    def _get_text_index(self):
+        with self._text_index_lock:
+            if self._text_index is None:
+                start = time.time()
+                filenames = np.empty(self._num_items, dtype = object)
+                filenames[self._filename_order] = pd.Series(self._sorted_filenames).str.decode("utf-8").values
+                self._text_index = TextIndex.build(self._classnames[self._row_classnames], filenames)
+                print("Built text index: %d words in %d ms" % (self._text_index.num_words, (time.time() - start) * 1000))
+
+            return self._text_index
+
+
+    # Returns the sorted ids that pass the filter, or None if there is no filter
+    def filter_candidates(self, search_filter):
+        if search_filter is None:
+            return None
+
+        candidates = None
+
+        if search_filter.classnames:
+            ids = []
+            for name in search_filter.classnames:
+                code = self._classname_codes.get(name)
+                if code is not None:
+                    ids.append(self._classname_ids[self._classname_offsets[code] : self._classname_offsets[code + 1]])
+
+            candidates = np.sort(np.concatenate(ids)) if ids else np.empty(0, dtype = np.int64)
+
+        if search_filter.path_prefix:
+            # 0xff never occurs in UTF-8, so prefix + 0xff sorts after every filename starting with prefix
+            prefix = search_filter.path_prefix.encode("utf-8")
+            lo = np.searchsorted(self._sorted_filenames, prefix, "left")
+            hi = np.searchsorted(self._sorted_filenames, prefix + b"\xff", "left")
+            ids = np.sort(self._filename_order[lo:hi])
+            candidates = ids if candidates is None else np.intersect1d(candidates, ids, assume_unique = True)
+
+        if search_filter.id_min is not None or search_filter.id_max is not None:
+            id_min = max(search_filter.id_min or 0, 0)
+            id_max = self._num_items - 1 if search_filter.id_max is None else min(search_filter.id_max, self._num_items - 1)
+
+            if candidates is None:
+                candidates = np.arange(id_min, id_max + 1, dtype = np.int64)
+            else:
+                candidates = candidates[(candidates >= id_min) & (candidates <= id_max)]
+
+        return candidates
+
+
+    # Per-class posting lists, so a query can scan only the partitions for its likely classes.
+    # feature_server stores the predicted class as features[0] = label / num_classes, so we recover it from that column.
+    # Stored as CSR: the ids of class c are _class_ids[_class_offsets[c] : _class_offsets[c + 1]]
+    def _build_class_partitions(self):
+        print("Building class partitions (%d classes)..." % self._num_classes)
+
+        labels = np.rint(self._class_feature * self._num_classes).astype(np.int64)
+        labels = np.clip(labels, 0, self._num_classes - 1)
+
+        self._class_ids = np.argsort(labels, kind = "mergesort").astype(np.int64)
+        counts = np.bincount(labels, minlength = self._num_classes)
+        self._class_offsets = np.concatenate(([0], np.cumsum(counts)))
+
+        print("%d non-empty partitions, largest = %d" % (np.count_nonzero(counts), counts.max()))
+
+
+    # Pick the partitions to search, given the query's top-k (label, probability) predictions.
+    # Returns None (search everything) if the classifier isn't confident enough.
+    def _select_partitions(self, classes):
+        if not self._class_partitions or not classes:
+            return None
+
+        classes = sorted(classes, key = lambda c: c[1], reverse = True)
+        if classes[0][1] < self._min_class_confidence:
+            return None
+
+        selected = []
+        coverage = 0.0
+        for label, probability in classes[:self._max_classes]:
+            if label < 0 or label >= self._num_classes:
+                continue
+
+            selected.append(int(label))
+            coverage += probability
+            if coverage >= self._class_coverage:
+                break
+
+        return selected
+
+
+    def _partition_candidates(self, partitions):
+        return np.sort(np.concatenate([self._class_ids[self._class_offsets[c] : self._class_offsets[c + 1]] for c in partitions]))
+
+
+    # classes is an optional list of (label, probability) from the feature_server, most likely first.
+    # search_filter is an optional SearchFilter.
+    # query_regions is an optional [regions x features] array of the query's regional descriptors.
+    # diversity is an optional diversify.Diversity.
+    def query_image(self, feature_vector, k=5, classes=None, search_filter=None, query_regions=None, diversity=None):
+        start = time.time()
+
+        distances, matches = self.search(feature_vector, k, classes, search_filter, query_regions, diversity = diversity)
+   
+        # Fetch filenames for matching images and return to client
+        results = [self.describe(matches[i], distances[i]) for i in range(len(matches))]
+
+        stop = time.time()
+        msecs = (stop - start) * 1000
+        if self._args.verbose:
+            print("query: %d ms" % msecs)
+ 
+        return results
+
+
+    # Search without fetching the matching images' descriptions.
+    # Returns (distances, ids), nearest first; fewer than k if the filter doesn't match k images.
+    # With query_regions, and regions loaded, images are ranked by their best regional match instead (see regions.py).
+    # With text, only images whose classname or path match every (informative) word of it are searched, ranked by
+    # both similarity and text match (see _fuse_text).
+    # With diversity, near-identical results are spread out (see diversify.py); results are then not in distance order.
+    def search(self, feature_vector, k=5, classes=None, search_filter=None, query_regions=None, text=None, diversity=None):
         if self._args.verbose:
             print("query_image: k=%d" % k)
 
@@ -110,48 +377,225 @@ class Database(object):
         if self._args.verbose:
             print("feature vector = %s" % str(X.shape))
 
-        X = X.reshape(1, -1)
+        candidates = self.filter_candidates(search_filter)
 
-        neighbors = self._knn.kneighbors(X, k, return_distance=True)
-        distances = neighbors[0].squeeze()
-        matches = neighbors[1].squeeze()
-   
-        # Fetch filenames for matching images and return to client
-        results = []
-        for i in range(len(matches)):
-            idx = int(matches[i])
+        if text:
+            text_ids, text_scores = self._text_matches(text, candidates, match_all = True)
+            candidates = text_ids
 
-            item = self._get_image_description( idx )
+        if candidates is not None and len(candidates) == 0:
+            return np.empty(0), np.empty(0, dtype = np.int64)
 
-            #print("match[%d] = %d = %s" % (i, idx, item))
+        if diversity is not None and diversity.method == "none":
+            diversity = None
 
-            classname, filename, _ = item.split(",")
-            classname = classname.strip()
-            filename = filename.strip()
-            #print("neighbor[%d]: %s %s" % (idx, classname, filename))
+        # Keep more results than we return, to diversify
+        k_keep = k
+        if diversity is not None:
+            k_keep = diversify.pool_size(k, self._diversify_depth)
 
-            results.append({"id": idx, "class" : classname, "filename" : filename, "distance" : distances[i]})
+        # Rank more of the text matches by similarity than we return, so the two rankings can be fused
+        k_search = k_keep
+        if text:
+            k_search = min(len(candidates), max(k * _text_fusion_depth, k_keep))
+
+        partitions = self._select_partitions(classes)
+        if partitions:
+            partition_candidates = self._partition_candidates(partitions)
+            if candidates is not None:
+                partition_candidates = np.intersect1d(candidates, partition_candidates, assume_unique = True)
+
+            # Not enough images in those classes? Fall back to a global (but still filtered) search
+            if len(partition_candidates) >= k_search:
+                candidates = partition_candidates
+
+        if query_regions is not None and self._regions is not None:
+            distances, matches = self._regions.search(query_regions, k_search, candidates)
+            if text:
+                distances, matches = self._seed_text_matches(None, query_regions, distances, matches, text_ids, text_scores, k_search)
+                distances, matches = self._fuse_text(distances, matches, text_ids, text_scores, k_keep)
+            if diversity is not None:
+                distances, matches = self.diversify(None, distances, matches, k, diversity, 1.0 - distances)
+
+            msecs = (time.time() - start) * 1000
+            scanned = self._num_items if candidates is None else len(candidates)
+            if self._args.verbose:
+                print("region search: %d ms (%d query regions, %d candidates, k=%d)" % (msecs, len(query_regions), scanned, k))
+
+            return distances, matches
+
+        X = self.normalize(X.reshape(1, -1))
+
+        distances, matches = self._search.search(X, self._shortlist(k_search), candidates)
+        distances, matches = self._rerank_exact(X, distances, matches, k_search)
+        found = matches[0] >= 0
+        distances = distances[0][found]
+        matches = matches[0][found]
+
+        if text:
+            distances, matches = self._seed_text_matches(X, None, distances, matches, text_ids, text_scores, k_search)
+            distances, matches = self._fuse_text(distances, matches, text_ids, text_scores, k_keep)
+        if diversity is not None:
+            distances, matches = self.diversify(X, distances, matches, k, diversity)
 
         stop = time.time()
         msecs = (stop - start) * 1000
-        print("query: %d ms" % msecs)
- 
-        return results
+        scanned = self._num_items if candidates is None else len(candidates)
+        if self._args.verbose:
+            print("search: %d ms (%d candidates, k=%d)" % (msecs, scanned, k))
 
+        return distances, matches
 
-    def _get_image_description( self, idx ):
-        # TODO: seek to database[idx] and read the entry
-        # TODO: generate a lookup table (and index into the index >.<) that tells us where to fseek() to.
-        header_offset = 28
-        features_offset_in_row = 165 # seek past class ID and filename to find the feature vector
-        feature_size = 12 # size of a feature vector elelemnt: float printed as %11.6f, plus a space between each feature
 
-        record_length = features_offset_in_row + (feature_size * self._num_features)
+    # Text-only search: images whose classname or path match text, best first, straight from the inverted index.
+    # Returns (distances, ids) like search(), with distance = 1 - text score (0 if every word matched in the classname)
+    def text_search(self, text, k=5, search_filter=None):
+        ids, scores = self._text_matches(text, self.filter_candidates(search_filter))
+
+        # Best score first; ties in id order
+        order = np.argsort(-scores, kind = "mergesort")[:k]
+        return 1.0 - scores[order].astype(np.float64), ids[order]
+
+
+    # (ids, scores) of the images matching text (any word, or every word with match_all), restricted to candidates if given
+    def _text_matches(self, text, candidates = None, match_all = False):
+        ids, scores = self._get_text_index().search(text, match_all)
+
+        if candidates is not None:
+            keep = np.isin(ids, candidates, assume_unique = True)
+            ids, scores = ids[keep], scores[keep]
+
+        return ids, scores
+
+
+    # Add the depth best text matches to the similarity shortlist (distances, ids: nearest first), so a strong text
+    # match that isn't among the nearest neighbors still gets fused.  Their distances are exact: from the index
+    # file's features, or their regions (query_regions).  Returns the merged shortlist, nearest first.
+    def _seed_text_matches(self, X, query_regions, distances, ids, text_ids, text_scores, depth):
+        seeds = np.setdiff1d(text_ids[np.argsort(-text_scores, kind = "mergesort")[:depth]], ids)
+        if len(seeds) == 0:
+            return distances, ids
+
+        if query_regions is not None:
+            seed_distances, seeds = self._regions.search(query_regions, len(seeds), seeds)
+        else:
+            seed_distances = search.exact_distances(np.asarray(X, dtype = np.float64), self.normalize(self.exact_features(seeds)), self._metric)
+
+        distances = np.concatenate((distances, seed_distances))
+        ids = np.concatenate((ids, seeds))
+
+        order = np.argsort(distances, kind = "mergesort")
+        return distances[order], ids[order]
+
+
+    # Fuse the similarity ranking of the text matches (distances, ids: the shortlist, nearest first) with their
+    # text ranking, by reciprocal rank fusion: score = 1 / (61 + similarity rank) + 1 / (61 + text rank).
+    # Images with the same text score share a text rank.
+    # Returns the top k (distances, ids) by fused score; distances stay the similarity distances.
+    def _fuse_text(self, distances, ids, text_ids, text_scores, k):
+        text_rank = np.searchsorted(np.sort(-text_scores), -text_scores[np.searchsorted(text_ids, ids)], "left")
+
+        fused = 1.0 / (_rrf_constant + 1 + np.arange(len(ids))) + 1.0 / (_rrf_constant + 1 + text_rank)
+
+        order = np.argsort(-fused, kind = "mergesort")[:k]
+        return distances[order], ids[order]
+
+
+    # Pick k of a search's results (distances, ids, nearest first) with diversify.rerank, from the vectors the search
+    # backend holds.  X is the normalized query, [1 x features]; relevance, if given, replaces the results' cosine
+    # similarity to it.  Only the first diversify.MAX_POOL results are re-ranked; any after them keep their order.
+    def diversify(self, X, distances, ids, k, diversity, relevance=None):
+        pool = min(len(ids), diversify.MAX_POOL)
+        V = self.vectors[ids[:pool]]
+
+        if relevance is None:
+            q = np.asarray(X, dtype = np.float32).reshape(-1)
+            relevance = V.dot(q) / np.maximum(np.linalg.norm(V, axis = 1) * np.linalg.norm(q), 1e-12)
+
+        order = diversify.rerank(V, relevance[:pool], min(k, pool), diversity)
+        order = np.concatenate((order, np.arange(pool, len(ids))))[:k]
+        return distances[order], ids[order]
+
+
+    # Search for many query vectors at once, without filters or class partitions.
+    # Q is [queries x features]; returns (distances, ids), each [queries x k], nearest first (id -1 if not found).
+    # Set normalized if Q is already normalized, e.g. rows of self.vectors
+    def search_batch(self, Q, k=5, normalized=False):
+        Q = np.atleast_2d(Q)
+        if not normalized:
+            Q = self.normalize(Q)
+
+        distances, ids = self._search.search(Q, self._shortlist(k))
+        return self._rerank_exact(Q, distances, ids, k)
+
+
+    # Number of results to ask the search backend for, before re-ranking
+    def _shortlist(self, k):
+        if self._precision == "float32" or self._rerank <= 1:
+            return k
+
+        return k * self._rerank
+
+
+    # Re-rank results from reduced-precision vectors by their distance to the exact features in the index file.
+    # Returns (distances, ids), each [queries x k]
+    def _rerank_exact(self, Q, distances, ids, k):
+        if ids.shape[1] == k:
+            return distances, ids
+
+        distances = np.full(ids.shape, np.inf)
+        found = ids >= 0
+        X = self.normalize(self.exact_features(ids[found]))
+
+        rows = np.nonzero(found)[0]
+        distances[found] = search.exact_distances(np.asarray(Q, dtype = np.float64)[rows], X, self._metric)
+
+        order = np.argsort(distances, axis = 1, kind = "mergesort")[:, :k]
+        return np.take_along_axis(distances, order, axis = 1), np.take_along_axis(ids, order, axis = 1)
+
+
+    # Apply the index's normalizer (if any) to query vectors
+    def normalize(self, Q):
+        if self._normalizer is None:
+            return Q
+
+        return self._normalizer.transform(Q)
+
+
+    # Raw features of the given ids, parsed from the memory-mapped index file at full precision
+    def exact_features(self, ids):
+        return index_format.parse_record_features(self._records[np.asarray(ids, dtype = np.int64)], self._num_features)
+
+
+    # Classnames of the given ids, straight from the in-RAM metadata index
+    def classnames_of(self, ids):
+        return self._classnames[self._row_classnames[np.asarray(ids)]]
+
+
+    # Returns the description of a search result: id, class, filename and distance
+    def describe(self, idx, distance):
+        idx = int(idx)
+        item = self._get_image_description( idx )
+
+        #print("match[%d] = %d = %s" % (i, idx, item))
+
+        classname, filename, _ = item.split(",")
+        classname = classname.strip()
+        filename = filename.strip()
+        #print("neighbor[%d]: %s %s" % (idx, classname, filename))
+
+        return {"id": idx, "class" : classname, "filename" : filename, "distance" : float(distance)}
+
+
+    def _get_image_description( self, idx ):
+        # Records are fixed-width; see index_format.py
+        header_offset = self._header_length
+        record_length = index_format.record_length(self._num_features)
         #print("num_features = %d, hack_offset = %d" % (self.num_features, record_length))
 
+        # Slice rather than seek() + readline(): the mmap is shared by concurrent requests
         file_offset = header_offset + (idx * record_length)
-        self._db_mmap.seek(file_offset)
-        item = self._db_mmap.readline()
+        item = self._db_mmap[file_offset : file_offset + record_length]
 
         item = item.decode( "utf-8" )
 
@@ -175,9 +619,35 @@ class Database(object):
         return self._get_image_description( key )
 
     
+    # Sizes of the in-memory search structures, for /admin/memory
+    def memory_stats(self):
+        stats = profiling.sizes({
+            "vectors" : self._search.X,
+            "norms" : self._search.norms,
+            "row_classnames" : self._row_classnames,
+            "classname_ids" : self._classname_ids,
+            "filename_order" : self._filename_order,
+            "sorted_filenames" : self._sorted_filenames,
+            "class_ids" : getattr(self, "_class_ids", None),
+        })
+        if self._text_index is not None:
+            stats["text_words"] = self._text_index.num_words
+            stats["text_postings"] = self._text_index.num_postings
+        if self._regions is not None:
+            stats["region_vectors_mb"] = self._regions.vectors.nbytes / (1024.0 * 1024.0)
+            stats["regions"] = self._regions.num_regions
+
+        stats["backend"] = type(self._search).__name__
+        stats["precision"] = self._precision
+        stats["metric"] = self._metric
+        stats["index_file_mb"] = len(self._db_mmap) / (1024.0 * 1024.0)
+
+        return stats
+
+    
     # Database is iterable
     def __len__(self):
-        return len( self._index )
+        return self._num_items
     
     def __iter__( self ):
         self._idx = 0
@@ -188,7 +658,7 @@ class Database(object):
             raise StopIteration
             
         #item = self._index.iloc[ self._idx ]
-        item = self_get_image_description( self._idx )
+        item = self._get_image_description( self._idx )
         self._idx += 1
         
         return item
@@ -214,7 +684,30 @@ class Database(object):
     def _get_shape(self):
         return (self._num_items, self._num_features)
 
+
+    # The normalized vectors; decoded float32 rows on indexing, see precision.py
+    def _get_vectors(self):
+        return self._search.X
+
+    def _get_metadata(self):
+        return self._metadata
+
+    # Levels of regional descriptors to ask the feature_server for with each query, or None if not searching regions
+    def _get_region_levels(self):
+        if self._regions is None:
+            return None
+
+        return self._metadata["regions"]["levels"]
+
+    # The metric the backend searches with: "inner" for cosine on an l2-normalized index
+    def _get_metric(self):
+        return self._metric
+
     name        = property( _get_name, None )
     shape       = property( _get_shape, None )
+    vectors     = property( _get_vectors, None )
+    metadata    = property( _get_metadata, None )
+    metric      = property( _get_metric, None )
+    region_levels = property( _get_region_levels, None )
 
  
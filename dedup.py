@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+import numpy as np
+
+import index_format
+import normalize
+import search
+
+#
+# Find duplicate and near-duplicate images in an index, offline, without re-featurizing anything.
+#
+# Every pair of images closer than --threshold is a duplicate; duplicates are merged into clusters with union-find,
+# and the clusters are written as newline-delimited JSON, largest first:
+#   {"size": 3, "ids": [12, 5078, 90211], "filenames": [...]}
+#
+# Pairs are found a block of rows at a time, across all cores:
+#   brute   exact: blocked matrix multiplies of each block against every earlier row
+#   hnsw    approximate: each row's --neighbors nearest neighbors from an HNSW graph (pip install hnswlib)
+#
+# Incremental: after appending images to an index, pass the previous run's clusters with --previous and the id of
+# the first new image with --since.  Only pairs involving a new image are searched for; old pairs come from --previous.
+#
+#   python dedup.py caltech256.index --threshold 0.5 --output duplicates.ndjson
+#   python dedup.py caltech256.index --threshold 0.5 --since 30607 --previous duplicates.ndjson --output duplicates_new.ndjson
+#
+
+# Set in the parent before the worker pool forks, so workers share it copy-on-write
+_state = {}
+
+
+def _main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("database", help="index to deduplicate")
+    parser.add_argument("--threshold", help="images closer than this are duplicates", type=float, required=True)
+    parser.add_argument("--metric", help="similariity metric [euclidean, cosine] default euclidean", default="euclidean")
+    parser.add_argument("--method", help="how to find pairs [brute, hnsw] default brute", choices=["brute", "hnsw"], default="brute")
+    parser.add_argument("--neighbors", help="hnsw: number of neighbors to check per image", type=int, default=10)
+    parser.add_argument("--block_size", help="number of rows per block", type=int, default=4096)
+    parser.add_argument("--workers", help="number of processes; default one per core", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("--since", help="incremental: id of the first new image; only pairs involving new images are searched", type=int, default=0)
+    parser.add_argument("--previous", help="incremental: clusters from a previous run (newline-delimited JSON)")
+    parser.add_argument("--output", help="write clusters to this file (default stdout)", default="-")
+    parser.add_argument("--pairs", help="also write every duplicate pair to this file, as it's found")
+    parser.add_argument("--hnsw_m", help="hnsw: graph degree", type=int, default=16)
+    parser.add_argument("--hnsw_ef_construction", help="hnsw: build-time beam width", type=int, default=200)
+    parser.add_argument("--hnsw_ef", help="hnsw: query-time beam width", type=int, default=64)
+    args = parser.parse_args()
+
+    if not os.path.exists(args.database):
+        print("Error: %s not found" % args.database)
+        return -1
+
+    log = sys.stderr if args.output == "-" else sys.stdout
+
+    start = time.time()
+    _, filenames, X = index_format.read_index(args.database, np.float32)
+    log.write("Loaded %d x %d in %.1f s\n" % (X.shape[0], X.shape[1], time.time() - start))
+
+    # Compare vectors the way the Database does: normalized, if the index has a normalizer
+    normalizer = normalize.from_metadata(index_format.read_header(args.database)[0])
+    if normalizer is not None:
+        log.write("Normalizing (%s)\n" % normalizer.method)
+        X = normalizer.transform(X)
+
+    clusters = UnionFind(len(X))
+    if args.previous:
+        log.write("Merging previous clusters from %s\n" % args.previous)
+        for ids in read_clusters(args.previous):
+            ids = [i for i in ids if i < len(X)]
+            for i in ids[1:]:
+                clusters.union(ids[0], i)
+
+    pairs = open(args.pairs, "wt") if args.pairs else None
+    start = time.time()
+    num_pairs = 0
+
+    for i, j, distances in find_pairs(X, args, log):
+        num_pairs += len(i)
+        for a, b in zip(i.tolist(), j.tolist()):
+            clusters.union(a, b)
+
+        if pairs is not None:
+            for a, b, d in zip(i.tolist(), j.tolist(), distances.tolist()):
+                pairs.write(json.dumps({ "ids" : [a, b], "distance" : d }) + "\n")
+            pairs.flush()
+
+    if pairs is not None:
+        pairs.close()
+
+    log.write("\n%d pairs in %.1f s\n" % (num_pairs, time.time() - start))
+
+    output = sys.stdout if args.output == "-" else open(args.output, "wt")
+    count = 0
+    for ids in clusters.clusters():
+        output.write(json.dumps({ "size" : len(ids), "ids" : ids, "filenames" : [filenames[i] for i in ids] }) + "\n")
+        count += 1
+
+    if output is not sys.stdout:
+        output.close()
+
+    log.write("%d clusters of duplicates\n" % count)
+    return 0
+
+
+# Yields (i, j, distances) arrays of pairs closer than args.threshold, with i >= args.since, and each pair once.
+def find_pairs(X, args, log = sys.stderr):
+    _state["X"] = X
+    _state["args"] = args
+
+    if args.metric == "cosine":
+        _state["norms"] = np.sqrt(np.einsum("ij,ij->i", X, X))
+    else:
+        _state["norms"] = np.einsum("ij,ij->i", X, X)
+
+    if args.method == "hnsw":
+        log.write("Building HNSW graph...\n")
+        _state["index"] = search.HnswSearch(X, args.metric, args)
+
+    blocks = [(start, min(start + args.block_size, len(X))) for start in range(args.since, len(X), args.block_size)]
+    log.write("Searching %d rows for duplicates, %d blocks, %d workers (%s)...\n" % (len(X) - args.since, len(blocks), args.workers, args.method))
+
+    search_block = _search_block_hnsw if args.method == "hnsw" else _search_block_brute
+
+    # Workers inherit _state by forking; without fork (e.g. Windows), search in this process
+    if args.workers > 1 and "fork" in multiprocessing.get_all_start_methods():
+        pool = multiprocessing.get_context("fork").Pool(args.workers)
+        results = pool.imap_unordered(search_block, blocks)
+    else:
+        pool = None
+        results = (search_block(block) for block in blocks)
+
+    try:
+        for n, result in enumerate(results):
+            if (n + 1) % 10 == 0:
+                log.write(".")
+                log.flush()
+            yield result
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+
+# Exact: rows [start, end) against every row before them, a block of columns at a time
+def _search_block_brute(block):
+    start, end = block
+    X, norms, args = _state["X"], _state["norms"], _state["args"]
+    found_i, found_j, found_d = [], [], []
+
+    Q = X[start:end]
+    for column in range(0, end, args.block_size):
+        columns = min(column + args.block_size, end)
+        dots = np.dot(Q, X[column:columns].T)
+
+        if args.metric == "cosine":
+            distances = 1.0 - dots / np.maximum(np.outer(norms[start:end], norms[column:columns]), 1e-12)
+            close = distances <= args.threshold
+        else:
+            distances = norms[start:end, np.newaxis] + norms[np.newaxis, column:columns] - 2.0 * dots
+            close = distances <= args.threshold * args.threshold
+
+        # Each pair once: only j < i
+        rows, cols = np.nonzero(close)
+        keep = (column + cols) < (start + rows)
+        rows, cols = rows[keep], cols[keep]
+
+        found_i.append(start + rows)
+        found_j.append(column + cols)
+        found_d.append(distances[rows, cols])
+
+    distances = np.concatenate(found_d).astype(np.float64)
+    if args.metric != "cosine":
+        distances = np.sqrt(np.maximum(distances, 0.0))
+
+    return np.concatenate(found_i), np.concatenate(found_j), distances
+
+
+# Approximate: each row's nearest neighbors from the HNSW graph
+def _search_block_hnsw(block):
+    start, end = block
+    X, index, args = _state["X"], _state["index"], _state["args"]
+
+    distances, ids = index.search(X[start:end], args.neighbors + 1)
+    rows = np.repeat(np.arange(start, end), ids.shape[1])
+    ids = ids.ravel()
+    distances = distances.ravel()
+
+    # Neighbors aren't symmetric, so a pair may be found from both ends; union-find doesn't mind
+    keep = (ids >= 0) & (ids != rows) & (distances <= args.threshold)
+    return rows[keep], ids[keep], distances[keep]
+
+
+# Read the clusters written by a previous run.  Yields a list of ids per cluster.
+def read_clusters(path):
+    with open(path, "rt") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)["ids"]
+
+
+# Disjoint sets over ids 0..n-1, with path halving and union by size
+class UnionFind(object):
+    def __init__(self, n):
+        self._parent = np.arange(n, dtype = np.int64)
+        self._size = np.ones(n, dtype = np.int64)
+
+
+    def find(self, i):
+        parent = self._parent
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+
+        return i
+
+
+    def union(self, a, b):
+        a, b = self.find(a), self.find(b)
+        if a == b:
+            return
+
+        if self._size[a] < self._size[b]:
+            a, b = b, a
+
+        self._parent[b] = a
+        self._size[a] += self._size[b]
+
+
+    # Clusters with more than one member, largest first, each a sorted list of ids
+    def clusters(self):
+        # Point every id straight at its root
+        roots = self._parent
+        while True:
+            grandparents = roots[roots]
+            if np.array_equal(grandparents, roots):
+                break
+            roots = grandparents
+
+        counts = np.bincount(roots, minlength = len(roots))
+        order = np.argsort(roots, kind = "mergesort")
+        offsets = np.concatenate(([0], np.cumsum(counts)))
+
+        clusters = [order[offsets[root] : offsets[root + 1]].tolist() for root in np.nonzero(counts > 1)[0]]
+        clusters.sort(key = lambda ids: (-len(ids), ids[0]))
+        return clusters
+
+if __name__ == "__main__":
+    sys.exit(_main())
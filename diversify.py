@@ -0,0 +1,122 @@
+from collections import namedtuple
+
+import numpy as np
+
+#
+# Result diversification: re-rank the top of a search so near-identical images (burst shots, frames of one video,
+# re-encodes of one photo) don't take up every result slot.
+#
+# The Database over-fetches --diversify_depth * k results, then picks k of them with one of:
+#   mmr       maximal marginal relevance: repeatedly take the result with the best
+#               (1 - diversity) * relevance - diversity * (highest similarity to a result already taken)
+#   cluster   results at least 1 - diversity similar to a better result are its near-duplicates; return the best of
+#             each group of near-duplicates first, in rank order, then the second best of each, and so on
+# Relevance is a result's cosine similarity to the query (its regional similarity, for region search), and the
+# similarity of two results is the cosine of their vectors, decoded from the search matrix the backend already holds.
+# Both take one [n x n] matrix product over the over-fetched results, plus a vector step per result, so they add
+# a few milliseconds; benchmark.py run --diversify measures them.
+#
+# Clients choose per request, with ?diversify=mmr|cluster&diversity=<0..1> on the search endpoints.
+#
+
+METHODS = ["none", "mmr", "cluster"]
+
+# Default diversity, by method
+DEFAULT_DIVERSITY = {
+    "mmr" : 0.5,
+    "cluster" : 0.1,
+}
+
+# Most results to diversify; the rest of a larger k keep their order
+MAX_POOL = 512
+
+# How to diversify a search: method is one of METHODS, diversity in [0, 1], or None for the method's default
+Diversity = namedtuple("Diversity", "method, diversity")
+
+
+# Number of results to search for, to diversify k of them
+def pool_size(k, depth):
+    return max(k, min(k * depth, MAX_POOL))
+
+
+# Cosine similarities of the rows of V, [n x n]
+def similarities(V):
+    V = V / np.maximum(np.linalg.norm(V, axis = 1), 1e-12)[:, np.newaxis]
+    return V.dot(V.T)
+
+
+# Returns the indices of k rows of V, best first.  relevance is each row's similarity to the query; rows are
+# in rank order, which breaks ties.
+def rerank(V, relevance, k, diversity):
+    k = min(k, len(V))
+    if diversity.method == "none" or k <= 1:
+        return np.arange(k)
+
+    amount = diversity.diversity
+    if amount is None:
+        amount = DEFAULT_DIVERSITY[diversity.method]
+    amount = min(max(float(amount), 0.0), 1.0)
+
+    S = similarities(np.asarray(V, dtype = np.float32))
+
+    if diversity.method == "mmr":
+        return mmr(S, np.asarray(relevance, dtype = np.float32), k, amount)
+    elif diversity.method == "cluster":
+        return cluster(S, k, amount)
+
+    raise ValueError("unknown diversify method %s; expected one of %s" % (diversity.method, ", ".join(METHODS)))
+
+
+# Maximal marginal relevance over the similarity matrix S
+def mmr(S, relevance, k, diversity):
+    selected = np.empty(k, dtype = np.int64)
+    taken = np.zeros(len(S), dtype = bool)
+    # Highest similarity of each row to a row already selected
+    redundancy = np.zeros(len(S), dtype = np.float32)
+
+    for i in range(k):
+        score = (1.0 - diversity) * relevance - diversity * redundancy
+        score[taken] = -np.inf
+
+        pick = int(np.argmax(score))
+        selected[i] = pick
+        taken[pick] = True
+        redundancy = S[pick] if i == 0 else np.maximum(redundancy, S[pick])
+
+    return selected
+
+
+# Near-duplicate groups over the similarity matrix S: each row joins the first row above it that started a group and
+# is at least 1 - diversity similar to it, or starts its own.  Returns k rows: group leaders first, then seconds, ...
+def cluster(S, k, diversity):
+    n = len(S)
+    threshold = 1.0 - diversity
+
+    group = np.full(n, -1, dtype = np.int64)
+    for i in range(n):
+        if group[i] >= 0:
+            continue
+
+        group[i] = i
+        group[(group < 0) & (S[i] >= threshold)] = i
+
+    # Each row's place in its group, in rank order (groups are numbered by their leader, so ranks sort within them)
+    ranks = np.arange(n)
+    by_group = np.lexsort((ranks, group))
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(group[by_group])) + 1))
+    place = np.empty(n, dtype = np.int64)
+    place[by_group] = ranks - np.repeat(starts, np.diff(np.concatenate((starts, [n]))))
+
+    return np.lexsort((ranks, place))[:k]
+
+
+# The server's default Diversity, from the command line
+def from_args(args):
+    return Diversity(getattr(args, "diversify", "none"), getattr(args, "diversity", None))
+
+
+def add_arguments(parser):
+    parser.add_argument("--diversify", help="diversify search results by default [%s] default none; clients can override with ?diversify=" % ", ".join(METHODS), choices=METHODS, default="none")
+    parser.add_argument("--diversity", help="how different diversified results must be, 0..1; default %s" %
+                        ", ".join("%s for %s" % (DEFAULT_DIVERSITY[method], method) for method in METHODS[1:]), type=float, default=None)
+    parser.add_argument("--diversify_depth", help="search for this many times k results, to diversify k of them", type=int, default=4)
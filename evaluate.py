@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+
+import argparse
+import concurrent.futures
+import json
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+import requests
+
+import index_format
+import search
+from database import Database
+from index import ignore_file
+
+#
+# Evaluate search quality: recall@k, precision@k and mAP, overall and per class.
+# A result is relevant if it has the same class as the query (its parent folder, e.g. dog/small_dog_1234.jpg).
+#
+# Two modes:
+#   http    POST every image in a folder to a running query_server, several requests at a time
+#   index   search an index file in-process, in batches, with no feature_server or query_server.
+#           Queries are the vectors of a second index (e.g. caltech256_test.index), or every image in
+#           the database itself (leave-one-out: the query image is removed from its own results).
+#
+# Prints a summary, and writes the full results as JSON (--output) so runs with different backends,
+# PCA settings etc. can be compared.  With --output -, the JSON is all that goes to stdout; the rest goes to stderr.
+#
+# mAP is the mean over queries of average precision over the top k results.  AP is normalized by the number of
+# relevant images that could have been returned (min(k, images of that class in the database)) when the class
+# sizes are known (index mode), otherwise by the number of relevant results returned (http mode).
+#
+
+_thread_state = threading.local()
+
+
+def _main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--k", help="number of results to evaluate per query", type=int, default=10)
+    parser.add_argument("--recall_at", help="comma-separated list of k for recall@k and precision@k", default="1,5,10")
+    parser.add_argument("--output", help="write results as JSON to this file ('-' for stdout)")
+    parser.add_argument("--label", help="label for this run, stored in the JSON results")
+    parser.add_argument("--per_class", help="print per-class results", action="store_true")
+    modes = parser.add_subparsers(dest="mode")
+
+    http = modes.add_parser("http", help="query a running query_server")
+    http.add_argument("input", help="folder of query images; the parent folder of each image is its class")
+    http.add_argument("--host", help="hostname of query server", default="localhost")
+    http.add_argument("--port", help="port of query server", type=int, default=1980)
+    http.add_argument("--workers", help="number of concurrent requests", type=int, default=8)
+    http.add_argument("--timeout", help="seconds to wait for each request", type=float, default=60)
+
+    index = modes.add_parser("index", help="search an index file in-process")
+    index.add_argument("database", help="index to search")
+    index.add_argument("--queries", help="index of query vectors. Default: leave-one-out over the database")
+    index.add_argument("--limit", help="evaluate at most this many queries (evenly spaced)", type=int, default=None)
+    index.add_argument("--batch_size", help="number of queries per search", type=int, default=256)
+    index.add_argument("--metric", help="similariity metric [euclidean, cosine] default euclidean", default="euclidean")
+    index.add_argument("--verbose", "-v", help="print verbose query information", action="store_true")
+    search.add_arguments(index)
+
+    args = parser.parse_args()
+    args.recall_at = sorted(set(int(k) for k in args.recall_at.split(",") if int(k) <= args.k))
+
+    # With --output -, stdout is just the JSON: progress, the Database's logging and the summary go to stderr
+    output = sys.stdout
+    if args.output == "-":
+        sys.stdout = sys.stderr
+
+    if args.mode == "http":
+        if not os.path.exists(args.input):
+            print("Error: %s not found" % args.input)
+            return -1
+
+        query_classes, result_classes, class_sizes, elapsed = _evaluate_http(args)
+    elif args.mode == "index":
+        if not os.path.exists(args.database):
+            print("Error: %s not found" % args.database)
+            return -1
+
+        query_classes, result_classes, class_sizes, elapsed = _evaluate_index(args)
+    else:
+        parser.print_help()
+        return -1
+
+    results = score(query_classes, result_classes, args.k, args.recall_at, class_sizes)
+    results["config"] = _config(args)
+    results["summary"]["elapsed_seconds"] = elapsed
+    results["summary"]["queries_per_second"] = len(query_classes) / elapsed if elapsed > 0 else 0.0
+
+    _print_results(results, args)
+
+    if args.output == "-":
+        json.dump(results, output, indent = 2)
+        output.write("\n")
+    elif args.output:
+        with open(args.output, "wt") as f:
+            json.dump(results, f, indent = 2)
+        print("Wrote %s" % args.output)
+
+
+# Score a set of queries.
+#   query_classes   [queries] class of each query
+#   result_classes  [queries] list of the classes of each query's results, nearest first
+#   class_sizes     optional dict of class -> number of relevant images in the database, for normalizing AP
+# Returns a dict with "summary" and "classes" results.
+def score(query_classes, result_classes, k, recall_at, class_sizes = None):
+    query_classes = np.asarray(query_classes, dtype = object)
+
+    # relevant[q, i] = result i of query q has the query's class
+    relevant = np.zeros((len(query_classes), k), dtype = bool)
+    for q, classes in enumerate(result_classes):
+        classes = list(classes)[:k]
+        relevant[q, :len(classes)] = [c == query_classes[q] for c in classes]
+
+    hits = np.cumsum(relevant, axis = 1)
+    precision_at = hits / np.arange(1, k + 1)
+
+    if class_sizes is not None:
+        possible = np.array([min(k, class_sizes.get(c, 0)) for c in query_classes])
+    else:
+        possible = hits[:, -1] if k > 0 else np.zeros(len(query_classes))
+
+    average_precision = np.where(possible > 0, (precision_at * relevant).sum(axis = 1) / np.maximum(possible, 1), 0.0)
+
+    def summarize(rows):
+        summary = { "queries" : int(rows.sum()) }
+        for n in recall_at:
+            summary["recall@%d" % n] = float(relevant[rows, :n].any(axis = 1).mean()) if summary["queries"] else 0.0
+            summary["precision@%d" % n] = float(precision_at[rows, n - 1].mean()) if summary["queries"] else 0.0
+        summary["mAP@%d" % k] = float(average_precision[rows].mean()) if summary["queries"] else 0.0
+        return summary
+
+    classes = {}
+    for c in sorted(set(query_classes)):
+        classes[c] = summarize(query_classes == c)
+
+    summary = summarize(np.ones(len(query_classes), dtype = bool))
+
+    # Mean of the per-class results, so small classes count as much as big ones (what total.py called mAP)
+    for key in list(summary.keys()):
+        if key != "queries" and classes:
+            summary["class_mean_" + key] = float(np.mean([result[key] for result in classes.values()]))
+
+    return { "summary" : summary, "classes" : classes }
+
+
+def _evaluate_http(args):
+    files = _find_images(args.input.rstrip(os.path.sep))
+    print("Querying %d images on %s:%d with %d workers..." % (len(files), args.host, args.port, args.workers))
+
+    url = "http://%s:%d/v1/search" % (args.host, args.port)
+    query_classes = [_classname(path) for path in files]
+    result_classes = [[] for _ in files]
+    errors = 0
+
+    start = time.time()
+    with concurrent.futures.ThreadPoolExecutor(max_workers = args.workers) as executor:
+        futures = dict((executor.submit(_query_http, url, path, args), i) for i, path in enumerate(files))
+
+        for n, future in enumerate(concurrent.futures.as_completed(futures)):
+            i = futures[future]
+            try:
+                result_classes[i] = future.result()
+            except Exception as ex:
+                print("Error querying %s: %s" % (files[i], ex))
+                errors += 1
+
+            if (n + 1) % 100 == 0:
+                sys.stdout.write(".")
+                sys.stdout.flush()
+
+    elapsed = time.time() - start
+    print("\n%d queries, %d errors, %.1f s" % (len(files), errors, elapsed))
+
+    return query_classes, result_classes, None, elapsed
+
+
+def _query_http(url, path, args):
+    # One keep-alive session per worker thread
+    session = getattr(_thread_state, "session", None)
+    if session is None:
+        session = _thread_state.session = requests.Session()
+
+    with open(path, "rb") as f:
+        payload = f.read()
+
+    reply = session.post(url, params = { "k" : args.k }, data = payload,
+                         headers = { "content-type" : "application/octet-stream" }, timeout = args.timeout)
+    reply.raise_for_status()
+
+    return [match["class"] for match in reply.json()]
+
+
+def _evaluate_index(args):
+    database = Database(args)
+    database.load_database(args.database)
+
+    db_classes = database.classnames_of(np.arange(len(database)))
+    names, counts = np.unique(db_classes, return_counts = True)
+    class_sizes = dict(zip(names, counts.tolist()))
+
+    leave_one_out = args.queries is None
+    if leave_one_out:
+        Q = database.vectors
+        query_classes = db_classes
+        query_ids = np.arange(len(database))
+
+        # The query image itself isn't a relevant result
+        class_sizes = dict((name, count - 1) for name, count in class_sizes.items())
+    else:
+        query_classes, _, Q = index_format.read_index(args.queries)
+        query_ids = None
+
+    if args.limit and args.limit < len(Q):
+        rows = np.linspace(0, len(Q) - 1, args.limit).astype(np.int64)
+        Q = Q[rows]
+        query_classes = query_classes[rows]
+        query_ids = query_ids[rows] if query_ids is not None else None
+
+    print("Searching %d queries, %d at a time..." % (len(Q), args.batch_size))
+    k = args.k + 1 if leave_one_out else args.k
+    result_classes = []
+
+    start = time.time()
+    for batch in range(0, len(Q), args.batch_size):
+        distances, ids = database.search_batch(Q[batch : batch + args.batch_size], k, normalized = leave_one_out)
+
+        for row in range(len(ids)):
+            found = ids[row][ids[row] >= 0]
+            if leave_one_out:
+                found = found[found != query_ids[batch + row]][:args.k]
+
+            result_classes.append(database.classnames_of(found))
+
+    elapsed = time.time() - start
+    print("%d queries, %.1f s" % (len(Q), elapsed))
+
+    return query_classes, result_classes, class_sizes, elapsed
+
+
+def _config(args):
+    config = dict((key, value) for key, value in vars(args).items() if isinstance(value, (str, int, float, bool, list, type(None))))
+    config["time"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+    return config
+
+
+def _print_results(results, args):
+    summary = results["summary"]
+
+    if args.per_class:
+        for classname, result in sorted(results["classes"].items()):
+            print("%-32s %s" % (classname, _format(result, args)))
+
+    print("\nSummary")
+    print("=======\n")
+    print("Queries = %d  (%.1f queries/s)" % (summary["queries"], summary["queries_per_second"]))
+    print("All queries:   %s" % _format(summary, args))
+    print("Class average: %s" % _format(dict((key[len("class_mean_"):], value) for key, value in summary.items() if key.startswith("class_mean_")), args))
+
+    ranked = sorted(results["classes"].items(), key = lambda item: item[1]["mAP@%d" % args.k], reverse = True)
+    print("Best 5 classes:  %s" % ", ".join(name for name, _ in ranked[:5]))
+    print("Worst 5 classes: %s" % ", ".join(name for name, _ in ranked[-5:]))
+
+
+def _format(result, args):
+    fields = ["recall@%d = %6.2f" % (n, 100.0 * result.get("recall@%d" % n, 0.0)) for n in args.recall_at]
+    fields.append("mAP@%d = %6.2f" % (args.k, 100.0 * result.get("mAP@%d" % args.k, 0.0)))
+    return "  ".join(fields)
+
+
+def _find_images(path):
+    if os.path.isfile(path):
+        return [path]
+
+    files = []
+    for root, dirs, names in os.walk(path):
+        dirs[:] = sorted(name for name in dirs if not ignore_file(name))
+        files.extend(os.path.join(root, name) for name in sorted(names) if not ignore_file(name))
+
+    return files
+
+
+# ASSUMES the parent folder is the classname, e.g. dog/small_dog_1234.jpg
+def _classname(path):
+    return path.split(os.sep)[-2]
+
+
+if __name__ == "__main__":
+    _main()
@@ -1,20 +1,26 @@
 #!/usr/bin/env python
 
-from flask import Flask, jsonify, request, _app_ctx_stack
+from flask import Flask, jsonify, request
 from flask_restful import Resource, Api, reqparse
-from PIL import Image
 import argparse
-import io
+import collections
 import os
-import sys
+import threading
 import time
 
+import numpy as np
 import torch
 import torch.backends.cudnn as cudnn
-import torch.nn as nn
+import torch.nn.functional as F
 
 from copper.model import Model
-from copper import utils
+
+import admission
+import cpu_inference
+import metrics
+import profiling
+import preprocess
+from preprocess import Preprocessor, spec_from_model
 
 
 # 
@@ -37,39 +43,102 @@ from copper import utils
 _app = None
 _api = None
 _args= None
-_feature_extractor = None
-_classifier = None
+_models = collections.OrderedDict()
+_default_model = None
+_admission = None
+
+# A model we serve features from.  id is what clients ask for with ?model=, and what index headers record;
+# dim is the length of its feature vectors (deep features + class label and probability);
+# feature_maps is its _FeatureMapHook, or None if it can't return regional descriptors
+HostedModel = collections.namedtuple("HostedModel", "id, path, feature_extractor, classifier, preprocess, dim, num_classes, feature_maps")
+
+MODEL_HEADER = "X-Model-Id"
+DIM_HEADER = "X-Feature-Dim"
 
 # REST resources
 
+_image_features_parser = reqparse.RequestParser()
+_image_features_parser.add_argument("classes", type = int, default = 0, location = "args",
+        help = "also return the top-k class probabilities; the response becomes {features, classes, num_classes}")
+_image_features_parser.add_argument("regions", type = int, default = 0, location = "args",
+        help = "also return regional descriptors at this many levels (see regions.py); the response becomes {features, classes, num_classes, regions}")
+_image_features_parser.add_argument("model", type = str, location = "args",
+        help = "id of the model to use (see /v1/models); default: the first one the server was started with")
+
+# Requests go through admission control (see admission.py): at most --max_concurrent forward passes at once,
+# interactive (query_server) requests ahead of batch (index.py) ones, and 503 with Retry-After for what can't make its deadline
 class ImageFeaturesResource(Resource):
+    method_decorators = [ admission.admitted(lambda: _admission, lambda: _args) ]
+
     def post(self):
         if request.headers["Content-Type"] != "application/octet-stream":
             return "Unsupported Media Type", 415
 
+        params = _image_features_parser.parse_args()
         image_bytes = request.data
 
+        hosted = _models.get(params.model or _default_model)
+        if hosted is None:
+            return {"message" : "model %s not found; this server has %s" % (params.model, ", ".join(_models))}, 404
+
         # Perform forward pass to extract the image embedding vector
         start = time.time()
-        vector = _get_feature_vector( _feature_extractor, _classifier, image_bytes )
+        if params.regions > 0 and hosted.feature_maps is None:
+            return {"message" : "model %s can't return regions: they need the eager model's feature map; restart without --jit / --quantize" % hosted.id}, 400
+
+        vector, classes, num_classes, regions = _get_feature_vector( hosted, image_bytes, params.classes, params.regions )
         stop = time.time()
         msecs = (stop - start) * 1000
-        print("%d ms: %s bytes -> %d" % (msecs, request.headers["Content-Length"], len(vector)))
-    
-        return jsonify(vector)
-    
+        if _args.verbose:
+            print("%d ms: %s bytes -> %s %d [trace %s: %s]" % (msecs, request.headers["Content-Length"], hosted.id, len(vector), metrics.current_trace_id(), metrics.format_stages()))
+
+        # Every response says which model made it, so clients can tell if it matches their index
+        with metrics.stage("serialize"):
+            if params.regions > 0:
+                response = jsonify({ "features" : vector, "classes" : classes, "num_classes" : num_classes, "regions" : regions,
+                                     "model" : hosted.id, "dim" : hosted.dim })
+            elif params.classes > 0:
+                response = jsonify({ "features" : vector, "classes" : classes, "num_classes" : num_classes,
+                                     "model" : hosted.id, "dim" : hosted.dim })
+            else:
+                response = jsonify(vector)
+
+        response.headers[MODEL_HEADER] = hosted.id
+        response.headers[DIM_HEADER] = str(hosted.dim)
+        return response
+
+
+# GET /v1/models: the models this server hosts, and which is the default
+class ModelListResource(Resource):
+    def get(self):
+        return {
+                "default" : _default_model,
+                "models" : [ { "id" : hosted.id,
+                               "model" : os.path.basename(hosted.path),
+                               "dim" : hosted.dim,
+                               "num_classes" : hosted.num_classes,
+                               "regions" : hosted.feature_maps is not None,
+                               "crop" : hosted.preprocess.spec.crop } for hosted in _models.values() ]
+               }
+
 
 
 def _main():
     parser = argparse.ArgumentParser()
-    parser.add_argument("model", help="CNN model to use for image embedding")
+    parser.add_argument("models", help="CNN models to use for image embedding, as <path> or <id>=<path>; the first is the default", nargs="+")
     parser.add_argument("--host", help="hostname to listen for queries. Defaults to 0.0.0.0 (visible externally!)", nargs="?", default="0.0.0.0")
     parser.add_argument("--port", help="port number to listen for queries", nargs="?", default=1975)
     parser.add_argument("--verbose", "-v", help="print verbose query information", action="store_true")
     parser.add_argument("--gpu", help="GPU to use for feature extraction, 0-based", type = int, default = None) 
+    cpu_inference.add_arguments(parser)
+    preprocess.add_arguments(parser)
+    admission.add_arguments(parser, max_concurrent = 1)
+    profiling.add_arguments(parser)
 
     global _args
     _args = parser.parse_args()
+
+    cpu_inference.configure_threads(_args)
    
     cudnn.benchmark = True
     print("CUDA support: ", torch.cuda.is_available())
@@ -81,17 +150,82 @@ def _main():
     else:
         print( "WARNING: Using CPU" )
 
-    # Check if model exists
-    if not os.path.exists(_args.model):
-        print("Error: model %s not found" % _args.model)
-        return -1
+    # Load every model; the first is the default
+    for spec in _args.models:
+        model_id, path = _parse_model_spec(spec)
+        if model_id in _models:
+            print("Error: two models have id %s; name them with <id>=<path>" % model_id)
+            return -1
+
+        # Check if model exists
+        if not os.path.exists(path):
+            print("Error: model %s not found" % path)
+            return -1
+
+        try:
+            _models[model_id] = _load_model(model_id, path)
+        except ValueError as ex:
+            print("Error: %s" % ex)
+            return -1
+
+    global _default_model
+    _default_model = next(iter(_models))
+    print("Serving models: %s (default %s)" % (", ".join("%s [%d]" % (hosted.id, hosted.dim) for hosted in _models.values()), _default_model))
+    
+    # Start the web server
+    global _app
+    global _api
+
+    _app = Flask(__name__)
+    _api = Api(_app)
+
+    global _admission
+    _admission = admission.Admission(_args.max_concurrent, _args.max_queue, _args.max_batch_queue)
+
+    # Trace ids (propagated from the query_server), per-stage timing, and Prometheus metrics on /metrics
+    metrics.install(_app)
+
+    # On-demand CPU profiles and memory stats, only if asked for
+    if _args.admin:
+        profiling.install(_app, _memory_stats)
+
+    _api.add_resource(ImageFeaturesResource,
+            "/v1/image_features",
+            "/v1/image_features")
+
+    _api.add_resource(ModelListResource,
+            "/v1/models")
+
+    _app.run(host = _args.host, port = _args.port)
+
+
+# <id>=<path>, or just <path>: the id is the model's filename without its .model extension
+def _parse_model_spec(spec):
+    if "=" in spec:
+        model_id, path = spec.split("=", 1)
+        return model_id, path
+
+    name = os.path.basename(spec)
+    if name.endswith(".model"):
+        name = name[:-len(".model")]
+
+    return name, spec
+
+
+# Load a model, split off its classifier, move it to the GPU or optimize it for CPU, and measure its feature vectors
+def _load_model(model_id, path):
+    print("Loading model %s from %s" % (model_id, path))
 
     # Load the model; ignore optimizer state and command-line used to train the model (we are not fine-tuning the model)
-    global _feature_extractor
-    _feature_extractor, _, _ = Model.load( _args.model )
+    feature_extractor, _, _ = Model.load( path )
+
+    # Compile the model's preprocessing spec (input size, mean/std) and crop set into a reusable pipeline
+    preprocessor = Preprocessor( spec_from_model(feature_extractor), channels_last = _args.channels_last, verbose = _args.verbose,
+                                 crops = preprocess.crops_from_args(_args), flip = _args.flip )
 
-    # Disable batchnorm update and gradient history-keeping
-    _feature_extractor._model.eval()
+    # Disable batchnorm update and gradient history-keeping.  Grad mode is per thread, so this only covers loading;
+    # request threads run their forward passes under torch.inference_mode()
+    feature_extractor._model.eval()
     torch.set_grad_enabled( False )
 
     # Remove the final layer (classifier) but save it so we can generate both a deep feature vector, and a class vector.
@@ -100,12 +234,11 @@ def _main():
     # The feature vector matches photos with visual similarity.
     # A weighted blend might yield subjectively better search results.
     # NOTE: we replace the final layer with an identity layer. This is MUCH easier than deleting it, which breaks forward()
-    global _classifier
-    _classifier = _feature_extractor._model.fc
-    _feature_extractor._model.fc = torch.nn.Sequential() 
+    classifier = feature_extractor._model.fc
+    feature_extractor._model.fc = torch.nn.Sequential() 
 
-    print("classifier = ", _classifier)
-    layers = list(_feature_extractor._model.children())
+    print("classifier = ", classifier)
+    layers = list(feature_extractor._model.children())
     print("Last layers of model:")
     for layer in layers[-2:]:
         print(" * ", layer)
@@ -114,64 +247,193 @@ def _main():
     # Move model to the GPU if available
     # Lame that Model has a _model, which is exposed in a few places. Fix it.
     if torch.cuda.is_available() and _args.gpu is not None:                               
-        _feature_extractor._model = _feature_extractor._model.cuda()
-        _classifier = _classifier.cuda()
-    
-    # Start the web server
-    global _app
-    global _api
+        feature_extractor._model = feature_extractor._model.cuda()
+        classifier = classifier.cuda()
+    elif cpu_inference.enabled(_args):
+        feature_extractor._model, classifier, quantize = _optimize_for_cpu(feature_extractor._model, classifier, preprocessor)
+        print("Model %s: quantize %s" % (model_id, quantize))
+
+    # Keep the last spatial feature map (before the global pool) for regional descriptors
+    feature_maps = _FeatureMapHook.install(feature_extractor._model)
+
+    # One forward pass on a blank image, for the vector lengths; clients get [label, probability, features...]
+    crop = preprocessor.spec.crop
+    blank = torch.zeros(1, 3, crop, crop)
+    if torch.cuda.is_available() and _args.gpu is not None:
+        blank = blank.cuda()
 
-    _app = Flask(__name__)
-    _api = Api(_app)
+    if feature_maps is not None:
+        feature_maps.reset(True)
 
-    _api.add_resource(ImageFeaturesResource,
-            "/v1/image_features",
-            "/v1/image_features")
+    with torch.inference_mode():
+        features = feature_extractor.forward( blank )
+        num_classes = classifier.forward( features ).shape[-1]
 
-    _app.run(host = _args.host, port = _args.port)
+    # The hook must have fired: an FX-quantized (--quantize static) model still has a layer4, but its graph doesn't call it
+    if feature_maps is not None and (feature_maps.value is None or feature_maps.value.dim() != 4):
+        feature_maps.remove()
+        feature_maps = None
+    if feature_maps is not None:
+        feature_maps.reset(False)
 
+    print("Model %s: %d features, %d classes, regions %s" % (model_id, features.shape[-1] + 2, num_classes,
+                                                             "supported" if feature_maps is not None else "not supported"))
 
-def _get_feature_vector( feature_extractor, classifier, image_bytes ):
-    # Convert image_bytes to an Image for easy resize/crop
-    image = Image.open( io.BytesIO(image_bytes) )
+    return HostedModel(model_id, path, feature_extractor, classifier, preprocessor, features.shape[-1] + 2, num_classes, feature_maps)
 
-    if _args.verbose:
-       print("Image = %s" % image)
 
-    # Resize and crop the input image to match what the model expects
-    # TODO: the model should tell us its input dims!
-    model_width = 256
-    model_height = 256
-    scale_width = model_width / image.width
-    scale_height = model_height / image.height
-    scale = max(scale_width, scale_height)
-    new_size = (int)(scale * image.width), (int)(scale * image.height)
+def _memory_stats():
+    stats = { "torch_threads" : torch.get_num_threads() }
+    for hosted in _models.values():
+        for name, module in (("feature_extractor", hosted.feature_extractor._model), ("classifier", hosted.classifier)):
+            try:
+                stats[hosted.id + "_" + name + "_mb"] = sum(t.numel() * t.element_size() for t in list(module.parameters()) + list(module.buffers())) / (1024.0 * 1024.0)
+            except (AttributeError, RuntimeError):
+                # TorchScript modules with frozen or packed (quantized) weights don't expose them all
+                pass
 
-    if _args.verbose:
-        print("scale image %d x %d -> %d x %d" % (image.width, image.height, new_size[0], new_size[1]))
+    return stats
 
-    image = image.resize( new_size );
 
-    if image.mode != "RGB":
-        image = image.convert("RGB")
+# Swap the eager fp32 model for a traced / fused / quantized one; see cpu_inference.py
+def _optimize_for_cpu(model, classifier, preprocessor):
+    calibration = []
+    if _args.calibration:
+        calibration = cpu_inference.load_calibration_batches(_args.calibration, preprocessor, _args.calibration_images)
+        print("Loaded %d calibration images" % len(calibration))
 
-    # extract a center crop; returns a tensor
-    # TODO: the model should tell us its input dims!
-    crop = utils.image_crop( image, 224, 224 )
+    if calibration:
+        example = calibration[0]
+    else:
+        crop = preprocessor.spec.crop
+        example = torch.zeros(1, 3, crop, crop)
 
-    # create a minibatch of size 1 (PyTorch models only accept minibatches)
-    batch = crop.unsqueeze(0)
+    return cpu_inference.optimize(model, classifier, example, calibration, _args)
+
+
+# Forward hook on a model's layer4 that keeps this thread's last feature map, only when asked to (see reset),
+# so forward passes that don't need regions don't hold on to it
+class _FeatureMapHook(object):
+    def __init__(self, module):
+        self._local = threading.local()
+        self._handle = module.register_forward_hook(self._save)
+
+
+    # Hook model's layer4; None if it has none or doesn't take hooks (TorchScript)
+    @staticmethod
+    def install(model):
+        if not hasattr(model, "layer4"):
+            return None
+
+        try:
+            return _FeatureMapHook(model.layer4)
+        except (AttributeError, RuntimeError):
+            return None
+
+
+    # Call before each forward pass: forget the last feature map, and keep the next one if wanted
+    def reset(self, wanted):
+        self._local.wanted = wanted
+        self._local.value = None
+
+
+    def remove(self):
+        self._handle.remove()
+
+
+    def _save(self, module, input, output):
+        if getattr(self._local, "wanted", False):
+            self._local.value = output
+
+
+    # Properties
+    def _get_value(self):
+        return getattr(self._local, "value", None)
+
+    value       = property( _get_value, None )
 
-    if torch.cuda.is_available() and _args.gpu is not None:
-        batch = batch.cuda()
+
+# R-MAC regions of a [channels x height x width] feature map: at level l, an l x l grid of overlapping square windows
+# of side 2 * min(height, width) / (l + 1), each max-pooled and L2-normalized.  Returns [regions x channels]
+def _regional_descriptors( feature_map, levels ):
+    channels, height, width = feature_map.shape
+    descriptors = []
+
+    for level in range(1, levels + 1):
+        size = max(1, int(2 * min(height, width) / (level + 1)))
+        if level == 1:
+            tops, lefts = [(height - size) // 2], [(width - size) // 2]
+        else:
+            tops = torch.linspace(0, height - size, level).round().long().tolist()
+            lefts = torch.linspace(0, width - size, level).round().long().tolist()
+
+        for top in tops:
+            for left in lefts:
+                descriptors.append( feature_map[:, top : top + size, left : left + size].amax(dim = (1, 2)) )
+
+    return F.normalize( torch.stack(descriptors).float(), dim = 1 )
+
+
+# Returns the hosted model's feature vector, the top_k (label, probability) class predictions (if top_k > 0),
+# the number of classes, and the regional descriptors at region_levels (if region_levels > 0)
+def _get_feature_vector( hosted, image_bytes, top_k = 0, region_levels = 0 ):
+    feature_extractor = hosted.feature_extractor
+    classifier = hosted.classifier
+
+    # Several center / corner crops of a model whose feature map we can read are windows of one forward pass
+    # over the resized image (see preprocess.py); only --flip (and the full crop) add batch entries
+    windows = hosted.feature_maps is not None and len(hosted.preprocess.window_crops) > 1
+
+    with metrics.stage("preprocess"):
+        if windows:
+            batch, boxes, others = hosted.preprocess.image_to_windows( image_bytes )
+        else:
+            batch = hosted.preprocess( image_bytes )
+
+        if torch.cuda.is_available() and _args.gpu is not None:
+            batch = batch.cuda()
+            if windows and others is not None:
+                others = others.cuda()
 
     # perform forward pass
     # we generate two vectors: the image features, and the class predictions
     # both together may yield better image description than either alone
-    features = feature_extractor.forward( batch )
-    raw_output  = classifier.forward( features )
-    
-    labels, probabilities = Model.get_predictions( raw_output )
+    # With --crops / --flip the batch holds every crop of the image; pool their features into one vector
+    # before classifying (for a linear classifier, mean pooling gives the mean of the crops' logits)
+    if hosted.feature_maps is not None:
+        hosted.feature_maps.reset(windows or region_levels > 0)
+
+    # Grad mode is per thread, and request threads start with it on; inference_mode also skips version counting
+    with torch.inference_mode():
+        with metrics.stage("forward"):
+            features = feature_extractor.forward( batch )
+            if windows:
+                feature_maps = hosted.feature_maps.value
+                features = _window_features( feature_maps, boxes, batch.shape[-1], hosted.preprocess.spec.crop )
+                if others is not None:
+                    features = torch.cat(( features, feature_extractor.forward( others ) ))
+
+            if len(features) > 1:
+                features = _pool_crops( features )
+            raw_output  = classifier.forward( features )
+
+            labels, probabilities = Model.get_predictions( raw_output )
+
+        # Regions of the first crop only, so an image always has the same number of them.
+        # Rounded to about float16 precision, which is how index.py stores them; it keeps the JSON short.
+        regions = []
+        if region_levels > 0:
+            with metrics.stage("regions"):
+                if windows:
+                    feature_map = _window( feature_maps[0], boxes[0], batch.shape[-1], hosted.preprocess.spec.crop )
+                else:
+                    feature_map = hosted.feature_maps.value[0]
+
+                R = _regional_descriptors( feature_map, region_levels )
+                regions = np.round( R.detach().cpu().double().numpy(), 5 ).tolist()
+
+        if hosted.feature_maps is not None:
+            hosted.feature_maps.reset(False)
 
     raw_output = raw_output.squeeze(0)
     features = features.squeeze(0)
@@ -201,7 +463,47 @@ def _get_feature_vector( feature_extractor, classifier, image_bytes ):
     features.insert( 0, float(labels[0] / len(raw_output)) )
     features.insert( 1, float(probabilities[0]) ) 
 
-    return features
+    classes = []
+    if top_k > 0:
+        top_probabilities, top_labels = torch.softmax( raw_output.float(), 0 ).topk( min(top_k, len(raw_output)) )
+        classes = [ [int(label), float(probability)] for label, probability in zip(top_labels.tolist(), top_probabilities.tolist()) ]
+
+    return features, classes, len(raw_output), regions
+
+
+# [crops x features] -> [1 x features]
+# Features of crops from the feature maps of a resized image (and its mirror image), one per (left, top) box:
+# each crop's window of the map, average-pooled like the model's own global pool.  The mirror image's windows are
+# mirrored back, so they line up with the crops they are the flips of.  Returns [crops (x 2 with flip) x channels]
+def _window_features( feature_maps, boxes, image_width, crop ):
+    features = []
+    for i, feature_map in enumerate(feature_maps):
+        if i > 0:
+            feature_map = torch.flip( feature_map, dims = [2] )
+
+        for box in boxes:
+            features.append( _window( feature_map, box, image_width, crop ).mean( dim = (1, 2) ) )
+
+    return torch.stack( features )
+
+
+# The window of a [channels x height x width] feature map of an image_width wide image under a crop x crop box at
+# (left, top) in the image, in whole cells of the map
+def _window( feature_map, box, image_width, crop ):
+    _, height, width = feature_map.shape
+    stride = image_width / float(width)
+    size = max(1, min(int(round(crop / stride)), height, width))
+
+    left = min(max(int(round(box[0] / stride)), 0), width - size)
+    top = min(max(int(round(box[1] / stride)), 0), height - size)
+    return feature_map[:, top : top + size, left : left + size]
+
+
+def _pool_crops( features ):
+    if _args.crop_pooling == "max":
+        return features.max( 0, keepdim = True )[0]
+
+    return features.mean( 0, keepdim = True )
 
 
 if __name__ == "__main__":
@@ -2,6 +2,7 @@
 import os
 import io
 import sys
+import time
 import argparse
 import requests
 import numpy as np
@@ -10,7 +11,16 @@ from PIL import Image
 from stat import *
 from base64 import *
 
+import admission
+import index_format
+import index_tool
+import normalize
+import regions
+import thumbnails
+
 _args = None
+_thumbnails = None
+_regions = None
 
 _files_to_ignore = [
     "@eaDir",
@@ -19,6 +29,12 @@ _files_to_ignore = [
 ]
 
 
+# The feature_server refused a request in a way retrying or skipping the image won't fix (we send it PNGs we
+# decoded ourselves, so a 4xx is about the request, e.g. regions from a model that can't make them); stops indexing
+class FeatureServerError(Exception):
+    pass
+
+
 
 def _main():
     parser = argparse.ArgumentParser()
@@ -30,7 +46,13 @@ def _main():
     parser.add_argument("--height", help="resize image to <height>", nargs="?", type=int, default=256)
     parser.add_argument("--force", help="force overwrite of existing index file", action="store_true")
     parser.add_argument("--s3", help="prefix every file in index with a string like https://s3-foo/bucket/", type=str)
+    parser.add_argument("--model", help="id of the feature_server model to index with (see /v1/models); default: its default model")
+    parser.add_argument("--retries", help="times to retry an image when the feature_server is overloaded", type=int, default=20)
     parser.add_argument("-v", "--v", help="verbose logging", dest = "verbose", action="store_true")
+    parser.add_argument("--thumbnails", help="also store a small JPEG of every image in <output>.thumbnails, for the query_server to serve", action="store_true")
+    parser.add_argument("--thumbnail_size", help="maximum thumbnail width and height", type=int, default=thumbnails.DEFAULT_SIZE)
+    parser.add_argument("--regions", help="also store regional descriptors at this many levels in <output>.regions, for --region_search (see regions.py)", type=int, default=0)
+    normalize.add_arguments(parser)
 
     global _args
     _args = parser.parse_args()
@@ -45,33 +67,62 @@ def _main():
         print("Error: %s exists; use --force to overwrite" % _args.output)
         return -1
 
+    # Stamp the index with the model that makes its vectors, so query_servers use the same one for queries
+    model = _get_model()
+    if model is None:
+        return -1
+    print("Indexing with model %s (%d features)" % (model["id"], model["dim"]))
+    metadata = { "model" : { "id" : model["id"], "dim" : model["dim"] } }
+
     print("Indexing photos: %d x %d" % (_args.width, _args.height))
 
-    with open(_args.output, "wt") as index:
-        # Don't print spaces between column names; confuses Pandas
-        index.write("classname,filename,features\n")
+    global _thumbnails
+    if _args.thumbnails:
+        _thumbnails = thumbnails.ThumbnailWriter(thumbnails.path_for(_args.output))
+
+    # The query_server asks for the same levels of regions for its queries
+    global _regions
+    if _args.regions > 0:
+        metadata["regions"] = { "levels" : _args.regions }
+        _regions = regions.RegionWriter(regions.path_for(_args.output))
 
-        # Index a single file
-        if os.path.isfile(_args.input):
-            index_file(_args.input, index, _args)
+    try:
+        with open(_args.output, "wt") as index:
+            index_format.write_header(index, metadata)
+
+            # Index a single file
+            if os.path.isfile(_args.input):
+                index_file(_args.input, index, _args)
+            else:
+                # Index folder(s)
+                for name in os.listdir(_args.input):
+                    if name[0] == '.':
+                        continue
+
+                    path = _args.input + os.path.sep + name
+
+                    if os.path.isfile(path):
+                        index_file(path, index, _args) 
+                    elif os.path.isdir(path):
+                        index_folder(path, index, _args)
+    
             index.flush()
             index.close()
-            return;
+    except FeatureServerError as ex:
+        print("\nError: %s; %s is incomplete" % (ex, _args.output))
+        return -1
 
-        # Index folder(s)
-        for name in os.listdir(_args.input):
-            if name[0] == '.':
-                continue
+    if _thumbnails is not None:
+        _thumbnails.close()
+        print("Wrote %d thumbnails to %s" % (len(_thumbnails), thumbnails.path_for(_args.output)))
 
-            path = _args.input + os.path.sep + name
+    if _regions is not None:
+        _regions.close()
+        print("Wrote regions of %d images to %s" % (len(_regions), regions.path_for(_args.output)))
 
-            if os.path.isfile(path):
-                index_file(path, index, _args) 
-            elif os.path.isdir(path):
-                index_folder(path, index, _args)
-    
-        index.flush()
-        index.close()
+    # Fit the normalizer to the finished index, and store it in the header
+    if _args.normalize:
+        index_tool.normalize_file(_args.output, _args.output, _args.normalize, _args.class_features, _args.class_weight)
 
 
 # Recursively calls itself for all subfolders
@@ -79,7 +130,7 @@ def index_folder(input_path, index, args):
     print("index_folder: %s" % input_path)
 
     for name in os.listdir(input_path):
-        if _ignore_file( input_path ):
+        if ignore_file( name ):
             continue
 
         path = input_path + os.path.sep + name
@@ -95,7 +146,7 @@ def index_folder(input_path, index, args):
 def index_file(input_path, index, args):
     # extract feature vector from file (if an image)
 
-    if _ignore_file( input_path ):
+    if ignore_file( input_path ):
         return
 
     # TODO: build a path lookup table to avoid duplicating path strings a million times
@@ -111,7 +162,11 @@ def index_file(input_path, index, args):
     try:
         image = Image.open(input_path)
 
-        X = _get_feature_vector(image)
+        X, R = _get_feature_vector(image)
+
+        # Thumbnail before the record is written, so a bad image skips both and ids stay in step
+        if _thumbnails is not None:
+            thumbnail = thumbnails.make_thumbnail(image, args.thumbnail_size)
    
         if args.verbose:
             print("[%16s] %32s" % (classname, filename))
@@ -121,14 +176,16 @@ def index_file(input_path, index, args):
     
         # append a row to the index
         # TODO: write features in binary instead of a .csv file: huge savings
-        index.write("%-32s, " % classname)
-        index.write("%-128s, " % filename)
+        index_format.write_record(index, classname, filename, X)
 
-        for val in X:
-            index.write("%11.6f " % float(val))
+        if _thumbnails is not None:
+            _thumbnails.add(thumbnail)
 
-        index.write("\n")
+        if _regions is not None:
+            _regions.add(R)
 
+    except FeatureServerError:
+        raise
     except Exception as ex:
         print("Error loading image %s" % input_path)
         print(type(ex))
@@ -137,12 +194,15 @@ def index_file(input_path, index, args):
         pass
 
 
-def _ignore_file( name ):
+# True for files and folders not to index: hidden ones, and NAS / macOS metadata.  Also used by evaluate.py
+def ignore_file( path ):
+    name = os.path.basename( path.rstrip(os.sep) )
+    if name.startswith("."):
+        return True
+
     for ignore in _files_to_ignore:
         if ignore in name:
             return True
-        if name[0] == '.':
-            return True
 
     return False
 
@@ -168,6 +228,30 @@ def _string_to_float_array(str):
     return ar
 
 
+# The feature_server's description of --model (or its default model): {id, dim, ...}, or None if it doesn't have it
+def _get_model():
+    url = "http://" + _args.host + ":" + str(_args.port) + "/v1/models"
+    try:
+        reply = requests.get(url).json()
+    except (requests.RequestException, ValueError) as ex:
+        print("Error: can't list the feature_server's models at %s: %s" % (url, ex))
+        return None
+
+    model_id = _args.model or reply["default"]
+    for model in reply["models"]:
+        if model["id"] == model_id:
+            if _args.regions > 0 and not model.get("regions"):
+                print("Error: the feature_server's model %s can't return regions (it's --jit or --quantize); restart it without them, or index without --regions" % model_id)
+                return None
+
+            # Every request asks for this model by id, even if it's the default now
+            _args.model = model_id
+            return model
+
+    print("Error: the feature_server has no model %s; it has %s" % (model_id, ", ".join(model["id"] for model in reply["models"])))
+    return None
+
+
 def _get_feature_vector(image):
     # Resize
     size = (_args.width, _args.height)
@@ -177,15 +261,46 @@ def _get_feature_vector(image):
     img.save(byte_array, format='PNG')
     data = byte_array.getvalue()
 
-    response = requests.post(url="http://" + _args.host + ":" + str(_args.port) + "/v1/image_features",
-                            data=data,
-                            headers={'Content-Type': 'application/octet-stream'})
+    params = { "model" : _args.model }
+    if _args.regions > 0:
+        params["regions"] = _args.regions
+
+    # We're batch traffic: the feature_server serves interactive searches first, and sheds us with 503 when it's busy
+    for attempt in range(_args.retries + 1):
+        response = requests.post(url="http://" + _args.host + ":" + str(_args.port) + "/v1/image_features",
+                                params=params,
+                                data=data,
+                                headers={'Content-Type': 'application/octet-stream',
+                                         admission.PRIORITY_HEADER: "batch"})
+
+        if response.status_code != 503 or attempt == _args.retries:
+            break
+
+        time.sleep(float(response.headers.get("Retry-After", 1)))
+
+    if 400 <= response.status_code < 500:
+        try:
+            message = response.json()["message"]
+        except (ValueError, KeyError, TypeError):
+            message = response.text.strip()
+        raise FeatureServerError("feature_server refused the request with %d: %s" % (response.status_code, message))
+
+    response.raise_for_status()
+
+    # The feature_server may have been restarted with other models; never mix vectors from two models in one index
+    if response.headers.get("X-Model-Id") != _args.model:
+        raise FeatureServerError("feature_server answered with model %s, not %s" % (response.headers.get("X-Model-Id"), _args.model))
+
+    # With regions, the reply is {features, regions, ...}
+    if _args.regions > 0:
+        reply = response.json()
+        return np.array(reply["features"]), np.array(reply["regions"], dtype = np.float32)
  
     response = response.text
 
     features = _string_to_float_array(response)
 
-    return features
+    return features, None
 
 
 
@@ -0,0 +1,178 @@
+import json
+
+import numpy as np
+import pandas as pd
+
+#
+# The on-disk index format written by index.py, and read by the Database and the offline tools.
+#
+# A .CSV file with an optional metadata line, a header, then one fixed-width record per image:
+#   #ridley {"normalizer": {...}}     JSON metadata about the index, e.g. its normalizer (see normalize.py)
+#   classname, padded to 32 characters
+#   filename, padded to 128 characters
+#   features, each printed as %11.6f followed by a space
+# Records are fixed-width so the Database can seek straight to record[id] in the memory-mapped file.
+#
+
+HEADER = "classname,filename,features\n"    # Don't print spaces between column names; confuses Pandas
+COLUMNS = ["classname", "filename", "features"]
+METADATA_PREFIX = "#ridley "
+
+_classname_width = 32
+_filename_width = 128
+_feature_width = 12
+
+# Offset of the features within a record: classname, ", ", filename, ", "
+FEATURES_OFFSET = _classname_width + 2 + _filename_width + 2
+
+_rows_per_block = 10000
+
+
+def write_header(index, metadata = None):
+    index.write(header(metadata))
+
+
+# The header as a string, with a metadata line if metadata isn't empty
+def header(metadata = None):
+    if not metadata:
+        return HEADER
+
+    # ASCII-only JSON, so the header's length in bytes is its length in characters
+    return METADATA_PREFIX + json.dumps(metadata, sort_keys = True) + "\n" + HEADER
+
+
+def write_record(index, classname, filename, features):
+    index.write("%-32s, " % classname)
+    index.write("%-128s, " % filename)
+
+    for val in features:
+        index.write("%11.6f " % float(val))
+
+    index.write("\n")
+
+
+# Offset of the first record
+def header_length(metadata = None):
+    return len(header(metadata))
+
+
+# Returns (metadata, offset of the first record) of an index file
+def read_header(path):
+    with open(path, "rb") as index:
+        line = index.readline().decode("utf-8")
+        length = len(line)
+        metadata = {}
+
+        if line.startswith(METADATA_PREFIX):
+            metadata = json.loads(line[len(METADATA_PREFIX):])
+            line = index.readline().decode("utf-8")
+            length += len(line)
+
+    if line != HEADER:
+        raise ValueError("%s is not an index file: unexpected header %r" % (path, line[:80]))
+
+    return metadata, length
+
+
+# Length of one record (including the newline) with num_features features
+def record_length(num_features):
+    return FEATURES_OFFSET + (_feature_width * num_features) + 1
+
+
+# Split a record into (classname, filename, features string)
+def split_record(record):
+    classname, filename, features = record.split(",")
+    return classname.strip(), filename.strip(), features
+
+
+# Yields the raw records (bytes, including the newline) of an index file, one at a time, after its header.
+# For tools that stream through indexes too big to load.
+def iter_records(path):
+    _, length = read_header(path)
+
+    with open(path, "rb") as index:
+        index.seek(length)
+        for record in index:
+            yield record
+
+
+# Number of features in a raw record
+def record_num_features(record):
+    return (len(record) - FEATURES_OFFSET - 1) // _feature_width
+
+
+# Classname of a raw record, without parsing the features
+def record_classname(record):
+    return record[:_classname_width].decode("utf-8").strip()
+
+
+# Convert a column of feature strings to a [rows x features] ndarray.
+# Parses a block of rows at a time, rather than one Python float at a time.
+def parse_features(strings, dtype = np.float64):
+    strings = list(strings)
+    if not strings:
+        return np.empty((0, 0), dtype = dtype)
+
+    num_features = len(strings[0].split())
+    X = np.empty((len(strings), num_features), dtype = dtype)
+
+    for start in range(0, len(strings), _rows_per_block):
+        block = strings[start : start + _rows_per_block]
+        values = np.array(" ".join(block).split(), dtype = dtype)
+        X[start : start + len(block)] = values.reshape(len(block), num_features)
+
+    return X
+
+
+# Parse the features of raw fixed-width records (bytes, starting at FEATURES_OFFSET) to a [rows x features] ndarray.
+# Faster than parse_features for a few records at a time: every feature is exactly "%11.6f ", so the digits are at
+# the same positions in every field, and can be multiplied by their place values without any string parsing.
+# Whole and millionths are summed separately, so both stay exact in float32.
+_whole_places = np.array([1000, 100, 10, 1, 0, 0, 0, 0, 0, 0, 0, 0], dtype = np.float32)
+_micro_places = np.array([0, 0, 0, 0, 0, 100000, 10000, 1000, 100, 10, 1, 0], dtype = np.float32)
+
+def parse_fixed_features(records, num_features):
+    fields = np.frombuffer(b"".join(record[:_feature_width * num_features] for record in records), dtype = np.uint8)
+    return _parse_fixed_fields(fields.reshape(-1, _feature_width), num_features)
+
+
+# Parse the features of rows of record_array(), e.g. records[ids], in one pass
+def parse_record_features(records, num_features):
+    fields = records[:, FEATURES_OFFSET : FEATURES_OFFSET + _feature_width * num_features]
+    return _parse_fixed_fields(fields.reshape(-1, _feature_width), num_features)
+
+
+# The records of an index file's bytes (e.g. a memory map of it) as a [rows x record length] uint8 array, without copying
+def record_array(buffer, header_length, num_features):
+    length = record_length(num_features)
+    rows = (len(buffer) - header_length) // length
+    return np.frombuffer(buffer, dtype = np.uint8, count = rows * length, offset = header_length).reshape(rows, length)
+
+
+# [fields x _feature_width] uint8 characters -> [rows x num_features]
+def _parse_fixed_fields(fields, num_features):
+    digits = fields - np.uint8(ord("0"))
+    digits[digits > 9] = 0
+    digits = digits.astype(np.float32)
+
+    X = digits.dot(_whole_places).astype(np.float64) + digits.dot(_micro_places).astype(np.float64) * 1e-6
+    X[(fields == ord("-")).any(axis = 1)] *= -1.0
+
+    return X.reshape(-1, num_features)
+
+
+# Load an index into memory, with pandas, skipping the metadata line if any
+def read_csv(path, usecols = COLUMNS):
+    _, length = read_header(path)
+    return pd.read_csv(path, usecols = usecols, memory_map = True, skiprows = 1 if length > len(HEADER) else 0)
+
+
+# Load an index into memory.  Returns (classnames, filenames, X), with the raw (not normalized) features
+def read_index(path, dtype = np.float64):
+    index = read_csv(path)
+
+    classnames = index["classname"].astype(str).str.strip().values
+    filenames = index["filename"].astype(str).str.strip().values
+    X = parse_features(index["features"].values, dtype)
+
+    return classnames, filenames, X
@@ -0,0 +1,554 @@
+#!/usr/bin/env python
+
+import argparse
+import collections
+import csv
+import hashlib
+import os
+import re
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+import index_format
+import normalize
+import packed
+import regions
+import thumbnails
+
+#
+# Merge and split index files, e.g. to combine the caltech and exo indexes, spread a 1.2M image index across
+# machines, or build parts of an index on several hosts and join them.
+#
+#   merge         concatenate indexes into one
+#   split-count   split an index into shards of at most --rows images
+#   split-class   split an index into one shard per class
+#   remap         translate image ids between a merged index and its parts, using the id map
+#   normalize     fit a normalizer (see normalize.py) to an index, and store it in the index header
+#
+# Everything streams through the indexes a record at a time, so they can be bigger than RAM.
+# Records are copied byte for byte; every input must have the same number of features and the same metadata
+# (e.g. normalizer), which is copied to the output.
+#
+# Every operation writes an id map next to its output: a .CSV of source,source_id,target,target_id with one
+# line per image, where source and target are absolute index paths, so same-named indexes in different folders
+# are told apart.  remap --index takes a path, or just a filename if only one index in the map has it.
+#
+# Thumbnails and regional descriptors stored next to the inputs (see thumbnails.py, regions.py) are merged and split
+# along with them, if every input has them; otherwise the outputs have none, and no regions in their metadata.
+# Every output file is checked before anything is written, so a name collision never leaves a partial result.
+# split-class names shards after their class; classes whose names only differ in characters a filename can't hold
+# (or in case) get a hash of the name appended, so they never share a shard.
+#
+#   python index_tool.py merge all.index caltech256.index exo.index
+#   python index_tool.py split-count imagenet.index imagenet_shard --rows 300000
+#   python index_tool.py remap all.index.idmap 17 42 --index exo.index
+#   python index_tool.py remap imagenet_shard.idmap 17 --reverse --index imagenet_shard_0002.index
+#   python index_tool.py normalize caltech256.index caltech256_l2.index --normalize l2
+#
+
+_idmap_columns = ["source", "source_id", "target", "target_id"]
+
+# Per-image packed files stored next to an index (see packed.py), and the metadata key that describes them, if any
+_sidecars = [
+    (thumbnails.path_for, None),
+    (regions.path_for, "regions"),
+]
+
+_copy_bytes = 16 * 1024 * 1024
+
+
+def _main():
+    parser = argparse.ArgumentParser()
+    modes = parser.add_subparsers(dest="mode")
+
+    merge = modes.add_parser("merge", help="concatenate indexes into one")
+    merge.add_argument("output", help="merged index")
+    merge.add_argument("inputs", help="indexes to merge, in order", nargs="+")
+    merge.add_argument("--force", help="force overwrite of existing index file", action="store_true")
+
+    split_count = modes.add_parser("split-count", help="split an index into shards of at most --rows images")
+    split_count.add_argument("input", help="index to split")
+    split_count.add_argument("prefix", help="shards are written to <prefix>_0000.index, <prefix>_0001.index, ...")
+    split_count.add_argument("--rows", help="images per shard", type=int, required=True)
+    split_count.add_argument("--force", help="force overwrite of existing index files", action="store_true")
+
+    split_class = modes.add_parser("split-class", help="split an index into one shard per class")
+    split_class.add_argument("input", help="index to split")
+    split_class.add_argument("prefix", help="shards are written to <prefix>_<classname>.index")
+    split_class.add_argument("--max_open", help="maximum number of shard files open at once", type=int, default=64)
+    split_class.add_argument("--force", help="force overwrite of existing index files", action="store_true")
+
+    remap = modes.add_parser("remap", help="translate image ids using an id map")
+    remap.add_argument("idmap", help="id map written by merge or split")
+    remap.add_argument("ids", help="ids to translate; default: read one per line from stdin", type=int, nargs="*")
+    remap.add_argument("--index", help="the index the ids belong to; required if the map has more than one")
+    remap.add_argument("--reverse", help="translate target ids back to source ids", action="store_true")
+
+    normalize_index = modes.add_parser("normalize", help="fit a normalizer to an index, and store it in the index header")
+    normalize_index.add_argument("input", help="index to normalize")
+    normalize_index.add_argument("output", help="normalized index; may be the same as input")
+    normalize.add_arguments(normalize_index)
+    normalize_index.add_argument("--force", help="force overwrite of existing index file", action="store_true")
+
+    args = parser.parse_args()
+
+    try:
+        if args.mode == "merge":
+            return merge_indexes(args.output, args.inputs, args.force)
+        elif args.mode == "split-count":
+            return split_by_count(args.input, args.prefix, args.rows, args.force)
+        elif args.mode == "split-class":
+            return split_by_class(args.input, args.prefix, args.max_open, args.force)
+        elif args.mode == "remap":
+            return _remap(args)
+        elif args.mode == "normalize":
+            if not args.normalize:
+                raise ValueError("choose a normalization with --normalize")
+            return normalize_file(args.input, args.output, args.normalize, args.class_features, args.class_weight, args.force)
+    except (IOError, ValueError) as ex:
+        print("Error: %s" % ex)
+        return -1
+
+    parser.print_help()
+    return -1
+
+
+#
+# merge
+#
+
+def merge_indexes(output, inputs, force = False):
+    for path in inputs:
+        if not os.path.exists(path):
+            raise IOError("%s not found" % path)
+
+    sources = [_idmap_path(path) for path in inputs]
+    for source, count in collections.Counter(sources).items():
+        if count > 1:
+            raise ValueError("%s is merged %d times; its ids would be ambiguous in the id map" % (source, count))
+
+    _check_outputs([output], force, output + ".idmap")
+
+    # Check every input has the same number of features and metadata before writing anything
+    num_features = None
+    metadata, _ = index_format.read_header(inputs[0])
+    for path in inputs:
+        n = _num_features(path)
+        if n is not None and num_features is not None and n != num_features:
+            raise ValueError("%s has %d features, expected %d" % (path, n, num_features))
+        num_features = n if n is not None else num_features
+
+        if index_format.read_header(path)[0] != metadata:
+            raise ValueError("%s has different metadata (e.g. normalizer) than %s" % (path, inputs[0]))
+
+    sidecars = _sidecars_of(inputs)
+    metadata = _sidecar_metadata(metadata, sidecars)
+
+    print("Merging %d indexes into %s..." % (len(inputs), output))
+    start = time.time()
+    target_id = 0
+
+    with open(output, "wb") as index, open(output + ".idmap", "wt", newline = "") as f:
+        index.write(index_format.header(metadata).encode("utf-8"))
+        idmap = _idmap_writer(f)
+
+        for path, source in zip(inputs, sources):
+            count = 0
+            for record in _records(path, num_features):
+                index.write(record)
+                idmap.writerow((source, count, _idmap_path(output), target_id))
+                target_id += 1
+                count += 1
+
+            print("%s: %d images" % (path, count))
+
+    counts = [_num_records(path, num_features) for path in inputs]
+    _copy_sidecars(sidecars, inputs, [(output, [(i, np.arange(count)) for i, count in enumerate(counts)])])
+
+    print("Wrote %d images to %s in %.1f s" % (target_id, output, time.time() - start))
+    return 0
+
+
+#
+# split
+#
+
+def split_by_count(path, prefix, rows, force = False):
+    if rows <= 0:
+        raise ValueError("--rows must be positive")
+
+    shard = None
+    num_features = _num_features(path)
+    metadata, _ = index_format.read_header(path)
+
+    num_images = _num_records(path, num_features)
+    shard_paths = ["%s_%04d.index" % (prefix, n) for n in range((num_images + rows - 1) // rows)]
+    _check_outputs(shard_paths, force, prefix + ".idmap")
+
+    sidecars = _sidecars_of([path])
+    metadata = _sidecar_metadata(metadata, sidecars)
+
+    with open(prefix + ".idmap", "wt", newline = "") as f:
+        idmap = _idmap_writer(f)
+
+        for source_id, record in enumerate(_records(path, num_features)):
+            if source_id % rows == 0:
+                if shard is not None:
+                    shard.close()
+
+                shard_path = shard_paths[source_id // rows]
+                print("Writing %s..." % shard_path)
+
+                shard = open(shard_path, "wb")
+                shard.write(index_format.header(metadata).encode("utf-8"))
+
+            shard.write(record)
+            idmap.writerow((_idmap_path(path), source_id, _idmap_path(shard_path), source_id % rows))
+
+    if shard is not None:
+        shard.close()
+
+    _copy_sidecars(sidecars, [path], [(shard_path, [(0, np.arange(n * rows, min((n + 1) * rows, num_images)))])
+                                      for n, shard_path in enumerate(shard_paths)])
+
+    return 0
+
+
+def split_by_class(path, prefix, max_open = 64, force = False):
+    num_features = _num_features(path)
+
+    # A first pass for the shard names, to check them all before writing anything
+    classnames = set(index_format.record_classname(record) for record in _records(path, num_features))
+    shard_of = _class_shard_paths(prefix, classnames)
+    _check_outputs(sorted(shard_of.values()), force, prefix + ".idmap")
+
+    sidecars = _sidecars_of([path])
+    shards = _ShardWriter(max_open, _sidecar_metadata(index_format.read_header(path)[0], sidecars))
+    members = collections.defaultdict(list)
+
+    with open(prefix + ".idmap", "wt", newline = "") as f:
+        idmap = _idmap_writer(f)
+
+        for source_id, record in enumerate(_records(path, num_features)):
+            shard_path = shard_of[index_format.record_classname(record)]
+            shards.write(shard_path, record)
+
+            idmap.writerow((_idmap_path(path), source_id, _idmap_path(shard_path), len(members[shard_path])))
+            members[shard_path].append(source_id)
+
+    shards.close()
+    _copy_sidecars(sidecars, [path], [(shard_path, [(0, np.array(ids, dtype = np.int64))]) for shard_path, ids in sorted(members.items())])
+
+    print("Wrote %d shards; largest has %d images" % (len(members), max(len(ids) for ids in members.values()) if members else 0))
+
+    return 0
+
+
+# Returns a dict of classname -> shard path, <prefix>_<classname>.index.  Classnames that would share a filename
+# (on a case-insensitive filesystem too) once made safe get a hash of the classname appended.
+def _class_shard_paths(prefix, classnames):
+    names = collections.defaultdict(list)
+    for classname in sorted(classnames):
+        names[_safe_filename(classname).lower()].append(classname)
+
+    shard_of = {}
+    for same in names.values():
+        for classname in same:
+            name = _safe_filename(classname)
+            if len(same) > 1:
+                name += "_" + hashlib.sha1(classname.encode("utf-8")).hexdigest()[:8]
+                print("WARNING: classes %s have the same filename; writing %s to %s_%s.index" %
+                      (", ".join(sorted(same)), classname, prefix, name))
+
+            shard_of[classname] = "%s_%s.index" % (prefix, name)
+
+    return shard_of
+
+
+# Appends records to many shard files, keeping at most max_open of them open (least recently used are closed)
+class _ShardWriter(object):
+    def __init__(self, max_open, metadata):
+        self._max_open = max(1, max_open)
+        self._header = index_format.header(metadata).encode("utf-8")
+        self._open = collections.OrderedDict()
+        self._created = set()
+
+
+    def write(self, path, record):
+        shard = self._open.pop(path, None)
+
+        if shard is None:
+            if len(self._open) >= self._max_open:
+                _, oldest = self._open.popitem(last = False)
+                oldest.close()
+
+            if path in self._created:
+                shard = open(path, "ab")
+            else:
+                print("Writing %s..." % path)
+
+                shard = open(path, "wb")
+                shard.write(self._header)
+                self._created.add(path)
+
+        self._open[path] = shard
+        shard.write(record)
+
+
+    def close(self):
+        for shard in self._open.values():
+            shard.close()
+        self._open.clear()
+
+
+#
+# normalize
+#
+
+def normalize_file(path, output, method, class_features = 2, class_weight = 0.0, force = False):
+    if output != path:
+        _check_outputs([output], force)
+
+    metadata, _ = index_format.read_header(path)
+    num_features = _num_features(path)
+    start = time.time()
+
+    # A new output gets a copy of the input's sidecars; normalizing in place leaves them as they are
+    sidecars = _sidecars_of([path]) if output != path else []
+    if output != path:
+        metadata = _sidecar_metadata(metadata, sidecars)
+
+    if method == "standardize":
+        print("Fitting %s normalization to %s..." % (method, path))
+        fit = normalize.StandardizeFit(class_features)
+        for block in _feature_blocks(path, num_features):
+            fit.add(block)
+        normalizer = fit.normalizer(class_weight)
+    else:
+        normalizer = normalize.Normalizer(method, class_features, class_weight)
+
+    metadata = dict(metadata)
+    metadata["normalizer"] = normalizer.to_dict()
+
+    # Write to a temporary file, so output can be the input
+    temp = output + ".tmp"
+    with open(temp, "wb") as index:
+        index.write(index_format.header(metadata).encode("utf-8"))
+        for record in _records(path, num_features):
+            index.write(record)
+
+    os.replace(temp, output)
+
+    if output != path:
+        _copy_sidecars(sidecars, [path], [(output, [(0, np.arange(_num_records(path, num_features)))])])
+    print("Wrote %s with %s normalization in %.1f s" % (output, method, time.time() - start))
+
+    return 0
+
+
+# Yields the features of an index as float64 arrays of up to `rows` rows
+def _feature_blocks(path, num_features, rows = 10000):
+    block = []
+    for record in _records(path, num_features):
+        block.append(record[index_format.FEATURES_OFFSET:])
+        if len(block) == rows:
+            yield index_format.parse_fixed_features(block, num_features)
+            block = []
+
+    if block:
+        yield index_format.parse_fixed_features(block, num_features)
+
+
+#
+# remap
+#
+
+def _remap(args):
+    mapping = load_id_map(args.idmap, args.index, args.reverse)
+
+    ids = args.ids if args.ids else (int(line) for line in sys.stdin if line.strip())
+    for i in ids:
+        if i in mapping:
+            print("%s %d" % mapping[i])
+        else:
+            print("- %d" % i)
+
+    return 0
+
+
+# Returns a dict of id -> (index, id), from source ids to target ids, or with reverse from target ids to source ids.
+# index is the index the ids belong to: one of the sources (or targets, with reverse), as a path, or a filename if
+# only one index in the map has it (id maps written before paths were absolute only have filenames).
+# It's required if there's more than one, e.g. the inputs of a merge, or the shards of a split with reverse.
+def load_id_map(path, index = None, reverse = False):
+    idmap = pd.read_csv(path, dtype = { "source" : str, "target" : str })
+    column, other = ("target", "source") if reverse else ("source", "target")
+
+    if index is None:
+        if idmap[column].nunique() > 1:
+            raise ValueError("%s maps ids of %d indexes; choose one with --index" % (path, idmap[column].nunique()))
+    else:
+        selected = idmap[column] == _idmap_path(index)
+        if not selected.any():
+            selected = idmap[column].map(os.path.basename) == os.path.basename(index)
+            named = idmap[column][selected].unique()
+            if len(named) > 1:
+                raise ValueError("%s maps ids of %d indexes named %s (%s); give --index as a path" %
+                                 (path, len(named), os.path.basename(index), ", ".join(sorted(named))))
+
+        idmap = idmap[selected]
+        if len(idmap) == 0:
+            raise ValueError("%s has no ids of %s" % (path, index))
+
+    return dict(zip(idmap[column + "_id"].tolist(), zip(idmap[other].tolist(), idmap[other + "_id"].tolist())))
+
+
+#
+# helpers
+#
+
+# How an id map names an index
+def _idmap_path(path):
+    return os.path.abspath(path)
+
+
+# A csv.writer for a new id map, with its header written; paths with commas are quoted
+def _idmap_writer(f):
+    writer = csv.writer(f, lineterminator = "\n")
+    writer.writerow(_idmap_columns)
+    return writer
+
+
+# Yields the records of an index, checking each has num_features features
+def _records(path, num_features):
+    for i, record in enumerate(index_format.iter_records(path)):
+        if len(record) != index_format.record_length(num_features):
+            raise ValueError("%s: record %d has length %d, expected %d (%d features)" %
+                             (path, i, len(record), index_format.record_length(num_features), num_features))
+        yield record
+
+
+# Number of images in an index, from its size: records are fixed-width
+def _num_records(path, num_features):
+    if num_features is None:
+        return 0
+
+    _, length = index_format.read_header(path)
+    return (os.path.getsize(path) - length) // index_format.record_length(num_features)
+
+
+# Number of features in an index, from its first record (None if it's empty)
+def _num_features(path):
+    for record in index_format.iter_records(path):
+        return index_format.record_num_features(record)
+
+    return None
+
+
+def _check_output(path, force):
+    if os.path.exists(path) and not force:
+        raise IOError("%s exists; use --force to overwrite" % path)
+
+
+# Check every file an operation writes: the output indexes, their sidecars, and the id map (if any)
+def _check_outputs(indexes, force, idmap = None):
+    for path in indexes:
+        _check_output(path, force)
+        for path_for, _ in _sidecars:
+            for sidecar in packed.paths(path_for(path)):
+                _check_output(sidecar, force)
+
+    if idmap is not None:
+        _check_output(idmap, force)
+
+
+# The sidecars (path_for, metadata key) that every input has, for every image, with items of the same size
+def _sidecars_of(inputs):
+    found = []
+    for path_for, key in _sidecars:
+        item_bytes = [_sidecar_item_bytes(path_for(path), _num_records(path, _num_features(path))) for path in inputs]
+        if None not in item_bytes and len(set(item_bytes)) == 1:
+            found.append((path_for, key))
+        elif any(os.path.exists(path_for(path)) or key in index_format.read_header(path)[0] for path in inputs):
+            print("WARNING: not every input has matching %s; the output won't have any" % path_for("").lstrip("."))
+
+    return found
+
+
+# Bytes per item of a sidecar with num_images images, or None if it doesn't exist or doesn't match
+def _sidecar_item_bytes(path, num_images):
+    if not all(os.path.exists(sidecar) for sidecar in packed.paths(path)):
+        return None
+
+    try:
+        offsets, item_bytes = packed.load(path, mmap_mode = "r")
+    except ValueError:
+        return None
+
+    return item_bytes if len(offsets) == num_images + 1 else None
+
+
+# Output metadata: without the keys of sidecars the output won't have
+def _sidecar_metadata(metadata, sidecars):
+    dropped = set(key for _, key in _sidecars if key is not None) - set(key for _, key in sidecars)
+    return dict((key, value) for key, value in metadata.items() if key not in dropped)
+
+
+# Write the sidecars of each output from its images' items in the inputs.
+# outputs is a list of (index, parts), where parts is a list of (input number, array of its image ids), in output order.
+# Outputs get no file for sidecars that aren't carried; any left from an earlier run (with --force) are removed.
+def _copy_sidecars(sidecars, inputs, outputs):
+    for path_for, _ in _sidecars:
+        for output, _ in outputs:
+            for path in packed.paths(path_for(output)):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    for path_for, _ in sidecars:
+        offsets, item_bytes = zip(*[packed.load(path_for(path)) for path in inputs])
+
+        for output, parts in outputs:
+            counts = []
+            with open(path_for(output), "wb") as target:
+                for i, ids in parts:
+                    counts.append(offsets[i][ids + 1] - offsets[i][ids])
+                    with open(path_for(inputs[i]), "rb") as source:
+                        for start, stop in _runs(ids):
+                            source.seek(int(offsets[i][start]) * item_bytes[i])
+                            _copy(source, target, int(offsets[i][stop] - offsets[i][start]) * item_bytes[i])
+
+            counts = np.concatenate(counts) if counts else np.empty(0, dtype = np.int64)
+            packed.save_offsets(path_for(output), np.concatenate(([0], np.cumsum(counts))))
+
+        print("Copied %s to %d indexes" % (path_for("").lstrip("."), len(outputs)))
+
+
+# Runs of consecutive ids, as [start, stop) pairs
+def _runs(ids):
+    if len(ids) == 0:
+        return []
+
+    breaks = np.flatnonzero(np.diff(ids) != 1) + 1
+    starts = ids[np.concatenate(([0], breaks))]
+    stops = ids[np.concatenate((breaks - 1, [len(ids) - 1]))] + 1
+    return zip(starts.tolist(), stops.tolist())
+
+
+def _copy(source, target, length):
+    while length > 0:
+        data = source.read(min(length, _copy_bytes))
+        if not data:
+            raise IOError("%s ended early" % source.name)
+        target.write(data)
+        length -= len(data)
+
+
+def _safe_filename(name):
+    return re.sub(r"[^A-Za-z0-9._-]+", "_", name) or "_"
+
+
+if __name__ == "__main__":
+    sys.exit(_main())
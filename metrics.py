@@ -0,0 +1,251 @@
+import bisect
+import collections
+import contextlib
+import threading
+import time
+import uuid
+
+#
+# Lightweight metrics for the query_server and feature_server, exported in Prometheus text format on /metrics.
+#
+#   with metrics.stage("decode"):           time a stage of the current request into ridley_stage_seconds{stage="decode"}
+#   metrics.counter(name, help).inc()       counters, gauges and histograms, with optional labels
+#
+# Every request gets a trace id: the client's X-Request-Id header, or a new one.  query_server passes it on to
+# the feature_server, and both servers log it with the per-stage timings, so one slow request can be followed
+# across both processes.
+#
+# No dependency on prometheus_client; observing a value is a dict lookup and a bisect under a lock.
+#
+
+TRACE_HEADER = "X-Request-Id"
+
+_default_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_registry = collections.OrderedDict()
+_registry_lock = threading.Lock()
+_trace = threading.local()
+
+
+class _Metric(object):
+    def __init__(self, name, help, kind):
+        self._name = name
+        self._help = help
+        self._kind = kind
+        self._values = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self._name, self._help), "# TYPE %s %s" % (self._name, self._kind)]
+
+        with self._lock:
+            for labels, value in self._values.items():
+                lines.extend(self._render_value(labels, value))
+
+        return lines
+
+
+    def _render_value(self, labels, value):
+        return ["%s%s %s" % (self._name, _format_labels(labels), _format_value(value))]
+
+
+class Counter(_Metric):
+    def __init__(self, name, help):
+        _Metric.__init__(self, name, help, "counter")
+
+
+    def inc(self, amount = 1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    def __init__(self, name, help):
+        _Metric.__init__(self, name, help, "gauge")
+
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[_label_key(labels)] = value
+
+
+    def inc(self, amount = 1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+    def dec(self, amount = 1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    def __init__(self, name, help, buckets = _default_buckets):
+        _Metric.__init__(self, name, help, "histogram")
+        self._buckets = tuple(sorted(buckets))
+
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # per-bucket counts (not cumulative), +Inf, then sum
+                counts = self._values[key] = [0] * (len(self._buckets) + 1) + [0.0]
+
+            counts[bisect.bisect_left(self._buckets, value)] += 1
+            counts[-1] += value
+
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, **labels)
+
+
+    def _render_value(self, labels, counts):
+        lines = []
+        cumulative = 0
+
+        for i, bound in enumerate(self._buckets + (float("inf"),)):
+            cumulative += counts[i]
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            lines.append("%s_bucket%s %d" % (self._name, _format_labels(labels + (("le", le),)), cumulative))
+
+        lines.append("%s_sum%s %s" % (self._name, _format_labels(labels), _format_value(counts[-1])))
+        lines.append("%s_count%s %d" % (self._name, _format_labels(labels), cumulative))
+
+        return lines
+
+
+def counter(name, help):
+    return _get_or_create(Counter, name, help)
+
+
+def gauge(name, help):
+    return _get_or_create(Gauge, name, help)
+
+
+def histogram(name, help, buckets = _default_buckets):
+    return _get_or_create(Histogram, name, help, buckets)
+
+
+def _get_or_create(cls, name, help, *args):
+    with _registry_lock:
+        metric = _registry.get(name)
+        if metric is None:
+            metric = _registry[name] = cls(name, help, *args)
+
+        return metric
+
+
+# Prometheus text exposition format
+def render():
+    with _registry_lock:
+        registered = list(_registry.values())
+
+    lines = []
+    for metric in registered:
+        lines.extend(metric.render())
+
+    return "\n".join(lines) + "\n"
+
+
+#
+# Per-request stage timing and trace ids
+#
+
+_stage_seconds = histogram("ridley_stage_seconds", "Time spent in each stage of a request")
+
+
+def start_trace(trace_id = None):
+    _trace.id = trace_id or uuid.uuid4().hex
+    _trace.stages = []
+    return _trace.id
+
+
+def current_trace_id():
+    return getattr(_trace, "id", None)
+
+
+# [(stage, seconds)] timed so far in the current request
+def current_stages():
+    return list(getattr(_trace, "stages", []))
+
+
+@contextlib.contextmanager
+def stage(name):
+    start = time.time()
+    try:
+        yield
+    finally:
+        observe_stage(name, time.time() - start)
+
+
+# Record seconds spent in a stage of the current request, for stages timed in pieces (e.g. while streaming)
+def observe_stage(name, seconds):
+    _stage_seconds.observe(seconds, stage = name)
+
+    stages = getattr(_trace, "stages", None)
+    if stages is not None:
+        stages.append((name, seconds))
+
+
+def format_stages():
+    return ", ".join("%s %.1f ms" % (name, seconds * 1000) for name, seconds in current_stages())
+
+
+# Add trace ids, request timing and a /metrics endpoint to a Flask app.
+# If log is set, print each request's trace id and stage timings.
+def install(app, log = False):
+    from flask import Response, g, request
+
+    requests_total = counter("ridley_requests_total", "Requests by endpoint and status")
+    request_seconds = histogram("ridley_request_seconds", "Request latency by endpoint")
+
+    @app.before_request
+    def _before_request():
+        g.metrics_start = time.time()
+        start_trace(request.headers.get(TRACE_HEADER))
+
+    @app.after_request
+    def _after_request(response):
+        endpoint = request.url_rule.rule if request.url_rule is not None else "unknown"
+        if endpoint != "/metrics":
+            request_seconds.observe(time.time() - g.metrics_start, endpoint = endpoint)
+            requests_total.inc(endpoint = endpoint, status = str(response.status_code))
+
+            if log:
+                print("trace %s: %s %d, %.1f ms: %s" % (current_trace_id(), endpoint, response.status_code,
+                      (time.time() - g.metrics_start) * 1000, format_stages()))
+
+        response.headers[TRACE_HEADER] = current_trace_id()
+        return response
+
+    def _metrics():
+        return Response(render(), mimetype = "text/plain; version=0.0.4")
+
+    app.add_url_rule("/metrics", "metrics", _metrics)
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+
+    return "{" + ",".join('%s="%s"' % (key, str(value).replace("\\", "\\\\").replace('"', '\\"')) for key, value in labels) + "}"
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+
+    return str(value)
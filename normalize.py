@@ -0,0 +1,126 @@
+import numpy as np
+
+#
+# Feature-vector normalization, fitted when an index is built and stored in its header (see index_format.py).
+#
+# The feature_server's vectors are [label / num_classes, probability, deep features...]: a "class block" of
+# class_features values, then unnormalized CNN activations.  A Normalizer maps them to:
+#   l2            [class_weight * class block, deep / ||deep||], then scaled to unit length.
+#                 Cosine distance on unit vectors is 1 - q.x, so cosine search becomes an inner product.
+#   standardize   [class_weight * class block, (deep - mean) / std / sqrt(dims)], with mean and std fitted on the index.
+#
+# The index file keeps the raw features; the Database applies the normalizer to the index vectors when it loads them,
+# and to every query vector, so both go through exactly the same transform.
+#
+
+METHODS = ["l2", "standardize"]
+
+_block_rows = 65536
+
+
+class Normalizer(object):
+    def __init__(self, method = "l2", class_features = 2, class_weight = 0.0, mean = None, std = None):
+        if method not in METHODS:
+            raise ValueError("unknown normalization %s; expected one of %s" % (method, ", ".join(METHODS)))
+
+        if method == "standardize" and (mean is None or std is None):
+            raise ValueError("standardize needs a mean and std; fit it with index_tool.py normalize")
+
+        self._method = method
+        self._class_features = class_features
+        self._class_weight = class_weight
+        self._mean = None if mean is None else np.asarray(mean, dtype = np.float32)
+        self._std = None if std is None else np.maximum(np.asarray(std, dtype = np.float32), 1e-6)
+
+
+    # Returns the normalized float32 copy of X ([rows x features], or a single vector)
+    def transform(self, X):
+        X = np.asarray(X)
+        vector = X.ndim == 1
+        X = np.atleast_2d(X)
+
+        Y = np.empty(X.shape, dtype = np.float32)
+        for start in range(0, len(X), _block_rows):
+            Y[start : start + _block_rows] = self._transform_block(X[start : start + _block_rows].astype(np.float32))
+
+        return Y[0] if vector else Y
+
+
+    def _transform_block(self, X):
+        c = self._class_features
+        X[:, :c] *= self._class_weight
+
+        if self._method == "standardize":
+            X[:, c:] -= self._mean
+            X[:, c:] /= self._std * np.sqrt(max(X.shape[1] - c, 1))
+            return X
+
+        X[:, c:] /= np.maximum(np.linalg.norm(X[:, c:], axis = 1), 1e-12)[:, np.newaxis]
+        X /= np.maximum(np.linalg.norm(X, axis = 1), 1e-12)[:, np.newaxis]
+        return X
+
+
+    # For the index header
+    def to_dict(self):
+        params = { "method" : self._method, "class_features" : self._class_features, "class_weight" : self._class_weight }
+        if self._method == "standardize":
+            params["mean"] = self._mean.tolist()
+            params["std"] = self._std.tolist()
+
+        return params
+
+
+    @staticmethod
+    def from_dict(params):
+        return Normalizer(params["method"], params.get("class_features", 2), params.get("class_weight", 0.0),
+                          params.get("mean"), params.get("std"))
+
+
+    # Properties
+    def _get_method(self):
+        return self._method
+
+    # Every normalized vector has length 1
+    def _get_unit_norm(self):
+        return self._method == "l2"
+
+    method      = property( _get_method, None )
+    unit_norm   = property( _get_unit_norm, None )
+
+
+# Accumulates the per-dimension mean and std of the deep features, a block of rows at a time
+class StandardizeFit(object):
+    def __init__(self, class_features = 2):
+        self._class_features = class_features
+        self._count = 0
+        self._sum = None
+        self._sum_squares = None
+
+
+    def add(self, X):
+        X = np.asarray(X, dtype = np.float64)[:, self._class_features:]
+        if self._sum is None:
+            self._sum = np.zeros(X.shape[1])
+            self._sum_squares = np.zeros(X.shape[1])
+
+        self._count += len(X)
+        self._sum += X.sum(axis = 0)
+        self._sum_squares += np.einsum("ij,ij->j", X, X)
+
+
+    def normalizer(self, class_weight = 0.0):
+        mean = self._sum / max(self._count, 1)
+        std = np.sqrt(np.maximum(self._sum_squares / max(self._count, 1) - mean * mean, 0.0))
+        return Normalizer("standardize", self._class_features, class_weight, mean, std)
+
+
+# The normalizer stored in an index header, or None
+def from_metadata(metadata):
+    params = metadata.get("normalizer")
+    return Normalizer.from_dict(params) if params else None
+
+
+def add_arguments(parser):
+    parser.add_argument("--normalize", help="normalize feature vectors [%s]" % ", ".join(METHODS), choices=METHODS)
+    parser.add_argument("--class_features", help="number of leading class features (label, probability) in each vector", type=int, default=2)
+    parser.add_argument("--class_weight", help="weight of the class features after normalization", type=float, default=0.0)
@@ -0,0 +1,74 @@
+import os
+
+import numpy as np
+
+#
+# Packed per-image files stored next to an index: thumbnails (see thumbnails.py) and regional descriptors (see regions.py).
+#
+#   <path>           every image's items, back to back, in index order
+#   <path>.offsets   .npy of num_images + 1 int64 offsets: image i is items [offsets[i], offsets[i + 1])
+#
+# Every item in a file has the same size: a byte of JPEG for thumbnails, a row of features for regions.
+# index_tool.py copies them item ranges at a time, so they are merged and split along with their index.
+#
+
+OFFSETS_SUFFIX = ".offsets"
+
+
+def offsets_path(path):
+    return path + OFFSETS_SUFFIX
+
+
+# The files of a packed file at path
+def paths(path):
+    return [path, offsets_path(path)]
+
+
+# Appends each image's items in index order; close() writes the offsets
+class PackedWriter(object):
+    def __init__(self, path):
+        self._path = path
+        self._file = open(path, "wb")
+        self._offsets = [0]
+
+
+    # data is the bytes of items items
+    def add(self, data, items):
+        self._file.write(data)
+        self._offsets.append(self._offsets[-1] + items)
+
+
+    def close(self):
+        self._file.close()
+        save_offsets(self._path, self._offsets)
+
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+
+def save_offsets(path, offsets):
+    # Through a file object, so np.save doesn't append .npy
+    with open(offsets_path(path), "wb") as f:
+        np.save(f, np.asarray(offsets, dtype = np.int64), allow_pickle = False)
+
+
+# Returns (offsets, bytes per item) of a packed file, or 0 bytes per item if it has no items.
+# item_bytes, if given, is the size items must have.  Raises ValueError if the file doesn't hold a whole number of items.
+def load(path, item_bytes = None, mmap_mode = None):
+    offsets = np.load(offsets_path(path), mmap_mode = mmap_mode)
+    if len(offsets) == 0:
+        raise ValueError("%s has no offsets" % offsets_path(path))
+
+    items = int(offsets[-1])
+    size = os.path.getsize(path)
+    if items == 0:
+        if size:
+            raise ValueError("%s has %d bytes, but its offsets expect none" % (path, size))
+        return offsets, 0
+
+    if size % items or (item_bytes is not None and size != items * item_bytes):
+        raise ValueError("%s has %d bytes, which isn't %d items%s" %
+                         (path, size, items, "" if item_bytes is None else " of %d bytes" % item_bytes))
+
+    return offsets, size // items
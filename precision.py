@@ -0,0 +1,157 @@
+import os
+
+import numpy as np
+
+#
+# Reduced-precision storage for the search matrix.
+#
+#   float32   4 bytes per feature
+#   float16   2 bytes per feature
+#   int8      1 byte per feature: per-dimension scalar quantization, x ~= offset[d] + scale[d] * code,
+#             with offset and scale chosen so each dimension's [min, max] spans the 256 codes
+#
+# CompactVectors behaves like a read-only float32 matrix: indexing it (X[i], X[start:stop], X[ids]) decodes just
+# those rows, and dot() scans a block of rows straight from the codes, reading 2x / 4x less memory than float32.
+# Search results on float16 / int8 are approximate; the Database re-ranks a shortlist with the exact features.
+#
+
+PRECISIONS = ["float32", "float16", "int8"]
+
+_dtypes = {
+    "float32" : np.float32,
+    "float16" : np.float16,
+    "int8" : np.int8,
+}
+
+_block_rows = 65536
+
+
+class CompactVectors(object):
+    def __init__(self, X, precision = "float32"):
+        if precision not in _dtypes:
+            raise ValueError("unknown precision %s; expected one of %s" % (precision, ", ".join(PRECISIONS)))
+
+        self._precision = precision
+        self._offset = None
+        self._scale = None
+
+        if precision == "int8":
+            self._fit_int8(X)
+
+        self._codes = np.empty(X.shape, dtype = _dtypes[precision])
+        for start in range(0, len(X), _block_rows):
+            self._codes[start : start + _block_rows] = self._encode(X[start : start + _block_rows])
+
+
+    def _fit_int8(self, X):
+        low = np.full(X.shape[1], np.inf, dtype = np.float32)
+        high = np.full(X.shape[1], -np.inf, dtype = np.float32)
+
+        for start in range(0, len(X), _block_rows):
+            block = X[start : start + _block_rows]
+            low = np.minimum(low, block.min(axis = 0))
+            high = np.maximum(high, block.max(axis = 0))
+
+        self._scale = np.maximum((high - low) / 255.0, 1e-12).astype(np.float32)
+        # code -128 decodes to the minimum
+        self._offset = (low + 128.0 * self._scale).astype(np.float32)
+
+
+    def _encode(self, X):
+        if self._precision != "int8":
+            return X
+
+        return np.clip(np.rint((X - self._offset) / self._scale), -128, 127)
+
+
+    def _decode(self, codes):
+        if self._precision == "float32":
+            return codes
+
+        if self._precision == "float16":
+            return codes.astype(np.float32)
+
+        X = codes.astype(np.float32)
+        X *= self._scale
+        X += self._offset
+        return X
+
+
+    # Decoded float32 rows: an int, a slice, or an array of row ids
+    def __getitem__(self, rows):
+        return self._decode(self._codes[rows])
+
+
+    # Q.dot(X[rows].T), without decoding the rows: for int8, Q.x = Q.offset + (Q * scale).code
+    def dot(self, Q, rows):
+        codes = self._codes[rows]
+
+        if self._precision == "float32":
+            return Q.dot(codes.T)
+
+        if self._precision == "float16":
+            return Q.dot(codes.astype(np.float32).T)
+
+        dots = (Q * self._scale).dot(codes.astype(np.float32).T)
+        dots += Q.dot(self._offset)[:, np.newaxis]
+        return dots
+
+
+    def __len__(self):
+        return len(self._codes)
+
+
+    def save(self, directory):
+        np.save(os.path.join(directory, "vectors.npy"), self._codes)
+        if self._precision == "int8":
+            np.save(os.path.join(directory, "int8_scale.npy"), self._scale)
+            np.save(os.path.join(directory, "int8_offset.npy"), self._offset)
+
+
+    # Use float32 or float16 vectors as they are, e.g. a memory map, without copying them
+    @staticmethod
+    def wrap(codes):
+        precision = np.dtype(codes.dtype).name
+        if precision not in ("float32", "float16"):
+            raise ValueError("can't wrap %s vectors; expected float32 or float16" % precision)
+
+        vectors = CompactVectors.__new__(CompactVectors)
+        vectors._precision = precision
+        vectors._codes = codes
+        vectors._scale = None
+        vectors._offset = None
+        return vectors
+
+
+    # Memory-map saved vectors, read-only
+    @staticmethod
+    def load(directory, precision):
+        vectors = CompactVectors.__new__(CompactVectors)
+        vectors._precision = precision
+        vectors._codes = np.load(os.path.join(directory, "vectors.npy"), mmap_mode = "r")
+        vectors._scale = None
+        vectors._offset = None
+
+        if precision == "int8":
+            vectors._scale = np.load(os.path.join(directory, "int8_scale.npy"))
+            vectors._offset = np.load(os.path.join(directory, "int8_offset.npy"))
+
+        if vectors._codes.dtype != _dtypes[precision]:
+            raise ValueError("%s holds %s vectors, not %s" % (directory, vectors._codes.dtype, precision))
+
+        return vectors
+
+
+    # Properties
+    def _get_precision(self):
+        return self._precision
+
+    def _get_shape(self):
+        return self._codes.shape
+
+    def _get_nbytes(self):
+        return self._codes.nbytes
+
+    precision   = property( _get_precision, None )
+    shape       = property( _get_shape, None )
+    nbytes      = property( _get_nbytes, None )
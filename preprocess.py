@@ -0,0 +1,239 @@
+from collections import namedtuple
+from PIL import Image
+import io
+import math
+import numpy as np
+import torch
+
+#
+# Image preprocessing for the feature_server.
+#
+# The preprocessing spec (resize, center crop, per-channel mean and std) comes from the loaded Model,
+# and is compiled once into a Preprocessor that is reused for every request:
+#   * JPEGs are decoded at reduced size (PIL draft mode lets libjpeg scale by 1/2, 1/4 or 1/8 during the IDCT)
+#   * resize and center crop are a single resample of the crop box, straight to the model's input size
+#   * uint8 -> normalized float32 is one multiply-add with precomputed per-channel scale and bias
+#
+# The result is HWC in memory, so the tensor we hand back is already channels-last;
+# we only copy to NCHW if the model wants contiguous NCHW input.
+#
+# For test-time augmentation, a Preprocessor can cut several crops (and their mirror images) from one decoded image;
+# they come back as a single minibatch, so the model sees them in one forward pass:
+#   center          the usual center crop
+#   tl, tr, bl, br  crops of the same size from the corners of the resized image
+#   full            the whole of the resized image's shorter side, centered, scaled down to the crop size
+#
+# Models whose last feature map the feature_server can read (see feature_server._FeatureMapHook) don't need a batch
+# entry per crop: image_to_windows returns the whole resized image (and its mirror image), and where the center and
+# corner crops are in it, so their features can be pooled from windows of one feature map.  Only "full", which is
+# at another scale, still needs crops of its own.
+#
+
+PreprocessSpec = namedtuple("PreprocessSpec", "resize, crop, mean, std")
+
+# Resnets trained on ImageNet: resize shorter side to 256, center crop 224, ImageNet mean/std
+_default_spec = PreprocessSpec(256, 224, (0.485, 0.456, 0.406), (0.229, 0.224, 0.225))
+
+CROPS = ["center", "tl", "tr", "bl", "br", "full"]
+
+# Crops that are windows of the resized image, at its scale
+WINDOW_CROPS = ["center", "tl", "tr", "bl", "br"]
+
+
+# Read the preprocessing spec from a Model, falling back to ImageNet defaults for anything it doesn't tell us.
+def spec_from_model(model):
+    crop = _model_attr(model, ["input_size", "_input_size", "image_size", "_image_size"], _default_spec.crop)
+    if isinstance(crop, (tuple, list)):
+        crop = crop[-1]     # e.g. [3, 224, 224]
+
+    # Keep the usual 256:224 ratio between resize and crop unless the model says otherwise
+    resize = _model_attr(model, ["resize", "_resize", "resize_size", "_resize_size"], int(round(crop * 256 / 224)))
+    mean = _model_attr(model, ["mean", "_mean"], _default_spec.mean)
+    std = _model_attr(model, ["std", "_std"], _default_spec.std)
+
+    return PreprocessSpec(int(resize), int(crop), tuple(float(m) for m in mean), tuple(float(s) for s in std))
+
+
+def _model_attr(model, names, default):
+    for name in names:
+        value = getattr(model, name, None)
+        if value is not None:
+            return value
+
+    return default
+
+
+class Preprocessor(object):
+    def __init__(self, spec, channels_last = False, verbose = False, crops = ("center",), flip = False):
+        for crop in crops:
+            if crop not in CROPS:
+                raise ValueError("unknown crop %s; expected some of %s" % (crop, ", ".join(CROPS)))
+
+        self._spec = spec
+        self._channels_last = channels_last
+        self._verbose = verbose
+        self._crops = list(crops)
+        self._flip = flip
+
+        # (x / 255 - mean) / std == x * scale - bias
+        std = np.array(spec.std, dtype = np.float32)
+        self._scale = (1.0 / (255.0 * std)).reshape(1, 1, 3)
+        self._bias = (np.array(spec.mean, dtype = np.float32) / std).reshape(1, 1, 3)
+
+        print("Preprocessor: resize %d, crop %d, mean %s, std %s, crops %s%s" % (spec.resize, spec.crop, str(spec.mean), str(spec.std),
+              ",".join(self._crops), " + flips" if flip else ""))
+
+
+    # Convert image_bytes to a normalized minibatch of batch_size crops
+    def __call__(self, image_bytes):
+        image = Image.open( io.BytesIO(image_bytes) )
+        return self.image_to_batch( image )
+
+
+    def image_to_batch(self, image):
+        return self._crop_batch( self.decode( image ), self._crops )
+
+
+    # For window crops: returns (the image resized to spec.resize, and its mirror image with flip, as a minibatch,
+    # the (left, top) of each of window_crops in it, a minibatch of the other crops and their flips or None)
+    def image_to_windows(self, image_bytes):
+        image = self.decode( Image.open( io.BytesIO(image_bytes) ) )
+        scale = self._spec.resize / min(image.width, image.height)
+        size = (int(round(image.width * scale)), int(round(image.height * scale)))
+
+        resized = np.empty((2 if self._flip else 1, size[1], size[0], 3), dtype = np.float32)
+        self.normalize( image.resize(size, Image.BILINEAR), out = resized[0] )
+        if self._flip:
+            resized[1] = resized[0, :, ::-1]
+
+        boxes = [tuple(int(round(x * scale)) for x in self.crop_box(image, name)[:2]) for name in self.window_crops]
+
+        others = [name for name in self._crops if name not in WINDOW_CROPS]
+        return self._to_batch_tensor(resized), boxes, self._crop_batch(image, others) if others else None
+
+
+    # Normalize every crop straight into its slot in the batch; flips are mirrored copies of the crops
+    def _crop_batch(self, image, names):
+        crop = self._spec.crop
+
+        batch = np.empty((len(names) * (2 if self._flip else 1), crop, crop, 3), dtype = np.float32)
+        for i, name in enumerate(names):
+            self.normalize( self._resize_box(image, self.crop_box(image, name)), out = batch[i] )
+
+        if self._flip:
+            batch[len(names):] = batch[:len(names), :, ::-1]
+
+        return self._to_batch_tensor(batch)
+
+
+    # float32 NHWC ndarray -> NCHW tensor (channels-last strides unless the model wants contiguous NCHW)
+    def _to_batch_tensor(self, batch):
+        tensor = torch.from_numpy( batch ).permute(0, 3, 1, 2)
+        if not self._channels_last:
+            tensor = tensor.contiguous()
+
+        return tensor
+
+
+    # Decode (at reduced size if possible), resize shorter side to spec.resize, center crop spec.crop x spec.crop.
+    # Returns an RGB Image.
+    def resize_and_crop(self, image):
+        image = self.decode( image )
+        return self._resize_box( image, self.crop_box(image, "center") )
+
+
+    # Decode an Image as RGB, at reduced size if that still leaves its shorter side >= spec.resize
+    def decode(self, image):
+        spec = self._spec
+
+        # Ask the decoder for the smallest image whose shorter side is still >= spec.resize.
+        # No-op for formats other than JPEG, or images that are already small.
+        scale = spec.resize / min(image.width, image.height)
+        if scale < 1.0:
+            image.draft("RGB", (int(math.ceil(image.width * scale)), int(math.ceil(image.height * scale))))
+
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+
+        return image
+
+
+    # A named crop (see CROPS) of the image resized to spec.resize, as a (left, top, right, bottom) box in source pixels
+    def crop_box(self, image, name):
+        spec = self._spec
+        scale = spec.resize / min(image.width, image.height)
+        crop = spec.crop / scale if name != "full" else min(image.width, image.height)
+
+        left = (image.width - crop) / 2
+        top = (image.height - crop) / 2
+        if name in ("tl", "bl"):
+            left = 0
+        if name in ("tr", "br"):
+            left = image.width - crop
+        if name in ("tl", "tr"):
+            top = 0
+        if name in ("bl", "br"):
+            top = image.height - crop
+
+        return (left, top, left + crop, top + crop)
+
+
+    # Resample a box of the image directly to crop x crop
+    def _resize_box(self, image, box):
+        crop = self._spec.crop
+
+        if self._verbose:
+            print("image %d x %d -> box (%d, %d, %d, %d) -> %d x %d" % ((image.width, image.height) + tuple(box) + (crop, crop)))
+
+        return image.resize( (crop, crop), Image.BILINEAR, box = box )
+
+
+    # uint8 HWC Image -> normalized float32 HWC ndarray (written to out, if given)
+    def normalize(self, image, out = None):
+        pixels = np.asarray( image )
+        normalized = np.empty(pixels.shape, dtype = np.float32) if out is None else out
+        np.multiply(pixels, self._scale, out = normalized)
+        normalized -= self._bias
+
+        return normalized
+
+
+    # float32 HWC ndarray -> CHW tensor (channels-last strides unless the model wants contiguous NCHW)
+    def to_tensor(self, normalized):
+        tensor = torch.from_numpy( normalized ).permute(2, 0, 1)
+        if not self._channels_last:
+            tensor = tensor.contiguous()
+
+        return tensor
+
+
+    # Properties
+    def _get_spec(self):
+        return self._spec
+
+    # Number of images in each minibatch: crops, and their flips
+    def _get_batch_size(self):
+        return len(self._crops) * (2 if self._flip else 1)
+
+    # The crops that are windows of the resized image (see image_to_windows)
+    def _get_window_crops(self):
+        return [name for name in self._crops if name in WINDOW_CROPS]
+
+    def _get_flip(self):
+        return self._flip
+
+    spec        = property( _get_spec, None )
+    batch_size  = property( _get_batch_size, None )
+    window_crops = property( _get_window_crops, None )
+    flip        = property( _get_flip, None )
+
+
+def add_arguments(parser):
+    parser.add_argument("--crops", help="comma-separated crops to extract features from, pooled into one vector [%s] default center" % ", ".join(CROPS), default="center")
+    parser.add_argument("--flip", help="also extract features from the mirror image of every crop", action="store_true")
+    parser.add_argument("--crop_pooling", help="how to pool the features of several crops [mean, max] default mean", choices=["mean", "max"], default="mean")
+
+
+# --crops as a list
+def crops_from_args(args):
+    return [crop.strip() for crop in args.crops.split(",") if crop.strip()]
@@ -0,0 +1,154 @@
+import collections
+import gc
+import os
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+
+#
+# On-demand profiling of a live server, through admin endpoints that only exist if the server is started with --admin.
+#
+#   GET /admin/profile?seconds=N&hz=H   sample every thread's Python stack H times a second for N seconds.
+#                                       Returns collapsed stacks ("thread;outer;...;inner count" per line), the input
+#                                       format of flamegraph.pl, speedscope and inferno.
+#   GET /admin/memory?top=N             process RSS, gc counts, the server's own stats (index matrix size, cache sizes),
+#                                       and the top N allocation sites from tracemalloc.
+#                                       tracemalloc slows allocation down, so it only runs between ?trace=start and ?trace=stop.
+#
+# The sampler is a plain loop over sys._current_frames() in the requesting thread: nothing runs unless a profile
+# has been asked for, so it's cheap enough to leave compiled in.
+#
+
+_max_seconds = 120
+_profile_lock = threading.Lock()
+
+
+# Sample the stacks of every other thread for `seconds`, `hz` times a second.
+# Returns a Counter of collapsed stack -> number of samples.
+def sample_stacks(seconds, hz = 100):
+    interval = 1.0 / hz
+    me = threading.current_thread().ident
+    stacks = collections.Counter()
+    deadline = time.time() + seconds
+
+    while time.time() < deadline:
+        names = dict((thread.ident, thread.name) for thread in threading.enumerate())
+
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == me:
+                continue
+
+            stack = []
+            while frame is not None:
+                stack.append(_frame_name(frame))
+                frame = frame.f_back
+
+            stack.append(names.get(thread_id, "thread-%d" % thread_id).replace(";", ":"))
+            stacks[";".join(reversed(stack))] += 1
+
+        time.sleep(interval)
+
+    return stacks
+
+
+def format_collapsed(stacks):
+    return "".join("%s %d\n" % (stack, count) for stack, count in stacks.most_common())
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    # First line of the function, not the current line, so samples anywhere in a function merge together
+    return ("%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)).replace(";", ":")
+
+
+def memory_stats(top = 20, stats = None):
+    result = {
+        "peak_rss_mb" : peak_rss_mb(),
+        "gc_counts" : list(gc.get_count()),
+        "gc_objects" : len(gc.get_objects()),
+        "tracemalloc" : tracemalloc.is_tracing(),
+    }
+
+    if stats is not None:
+        result["server"] = stats()
+
+    if tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ))
+
+        result["traced_mb"] = current / (1024.0 * 1024.0)
+        result["traced_peak_mb"] = peak / (1024.0 * 1024.0)
+        result["top_allocations"] = [
+            { "location" : str(stat.traceback), "size_mb" : stat.size / (1024.0 * 1024.0), "count" : stat.count }
+            for stat in snapshot.statistics("lineno")[:top]
+        ]
+
+    return result
+
+
+# Sizes of numpy arrays and containers, in MB or entries, for memory_stats().
+# values is a dict of name -> ndarray / sized container / None
+def sizes(values):
+    result = {}
+    for name, value in values.items():
+        if value is None:
+            continue
+        elif hasattr(value, "nbytes"):
+            result[name + "_mb"] = value.nbytes / (1024.0 * 1024.0)
+        elif hasattr(value, "__len__"):
+            result[name + "_entries"] = len(value)
+
+    return result
+
+
+# Peak resident set size of this process, in MB
+def peak_rss_mb():
+    # ru_maxrss is kilobytes on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        peak /= 1024.0
+
+    return peak / 1024.0
+
+
+def add_arguments(parser):
+    parser.add_argument("--admin", help="enable the /admin/profile and /admin/memory endpoints", action="store_true")
+
+
+# Add the admin endpoints to a Flask app.
+# stats is an optional function returning a dict of the server's own memory stats.
+def install(app, stats = None):
+    from flask import Response, jsonify, request
+
+    def _profile():
+        seconds = min(max(request.args.get("seconds", 10, type = float), 0.1), _max_seconds)
+        hz = min(max(request.args.get("hz", 100, type = float), 1), 1000)
+
+        if not _profile_lock.acquire(False):
+            return Response("a profile is already running\n", status = 409, mimetype = "text/plain")
+
+        try:
+            print("Profiling for %.1f s at %d Hz..." % (seconds, hz))
+            stacks = sample_stacks(seconds, hz)
+        finally:
+            _profile_lock.release()
+
+        return Response(format_collapsed(stacks), mimetype = "text/plain")
+
+    def _memory():
+        trace = request.args.get("trace")
+        if trace == "start" and not tracemalloc.is_tracing():
+            tracemalloc.start(request.args.get("frames", 1, type = int))
+        elif trace == "stop" and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+        return jsonify(memory_stats(request.args.get("top", 20, type = int), stats))
+
+    app.add_url_rule("/admin/profile", "admin_profile", _profile)
+    app.add_url_rule("/admin/memory", "admin_memory", _memory)
+    print("Admin endpoints enabled: /admin/profile, /admin/memory")
@@ -7,13 +7,25 @@ import re
 import sys
 import argparse
 import requests
+import json
+import time
 import numpy as np
-from database import Database
+from database import Database, SearchFilter
+import admission
+import diversify
+import metrics
+import profiling
+import regions
+import search
+import snapshot
+import thumbnails
+from result_cache import ResultCache, make_cursor, parse_cursor
 from PIL import Image
 from stat import *
-from flask import Flask, jsonify, request
-from flask_restful import Resource, Api, reqparse
+from flask import Flask, Response, g, jsonify, request
+from flask_restful import Resource, Api, inputs, reqparse
 from flask_cors import CORS
+from werkzeug.exceptions import BadGateway
 
 
 # Load a previously-generated Database of images
@@ -29,23 +41,57 @@ _app = None
 _api = None 
 _args = None
 _database = None
+_result_cache = None
+_thumbnails = None
+_admission = None
+_model = None
+# False if the feature_server can't return the regions --region_search needs; see _check_model
+_query_regions = True
 
 #
 # REST resources
 #
 
 _image_search_parser = reqparse.RequestParser()
-_image_search_parser.add_argument("k", type = int, default = 5, help = "number of search results to return")
+_image_search_parser.add_argument("k", type = inputs.positive, default = 5, location = ("args", "form"), help = "number of search results to return, at least 1")
+_image_search_parser.add_argument("class", type = str, action = "append", dest = "classnames", location = "args", help = "only return images of this class; may be repeated")
+_image_search_parser.add_argument("path_prefix", type = str, location = "args", help = "only return images whose filename starts with this prefix")
+_image_search_parser.add_argument("id_min", type = int, location = "args", help = "only return images with id >= id_min")
+_image_search_parser.add_argument("id_max", type = int, location = "args", help = "only return images with id <= id_max")
+_image_search_parser.add_argument("page_size", type = inputs.positive, location = "args", help = "return the k results a page at a time, at least 1 per page; the response includes a next_cursor")
+_image_search_parser.add_argument("cursor", type = str, location = "args", help = "next_cursor from a previous page; GET /v1/search?cursor=...")
+_image_search_parser.add_argument("q", type = str, location = "args", help = "text query: only return images whose class or path match it, ranked by both text and image similarity")
+_image_search_parser.add_argument("diversify", type = str, choices = diversify.METHODS, location = "args", help = "spread out near-identical results: mmr or cluster (see diversify.py); default --diversify")
+_image_search_parser.add_argument("diversity", type = float, location = "args", help = "how different diversified results must be, 0..1; default --diversity")
+_image_search_parser.add_argument("stream", type = inputs.boolean, default = False, location = "args", help = "stream results as newline-delimited JSON")
 
 # Two ways the client can perform a search:
 #   Client can GET /images/<id>/similar
 #   Client can POST an image (binary file)
+# Either way, the client can page through the results with GET /v1/search?cursor=<next_cursor>
+# Add ?q=<text> to either for a hybrid text + image search, or GET /v1/search?q=<text> for text alone (no image, no vectors)
+# Add ?diversify=mmr|cluster to either image search so near-identical images don't fill the results
+# Searches go through admission control (see admission.py): too many at once, and they get a 503 with Retry-After.
 class ImageSearchResource(Resource):
+    method_decorators = [ admission.admitted(lambda: _admission, lambda: _args) ]
+
     def get(self, image_id = None):
         if _args.verbose:
             print("headers =\n", request.headers)
 
-        params = _image_search_parser.parse_args()
+        params = _parse_search_args()
+
+        if params.cursor:
+            return _page_response(params)
+
+        if image_id is None:
+            if not params.q:
+                return {"message" : "GET /v1/search requires a cursor or a text query (q)"}, 400
+
+            with metrics.stage("text_search"):
+                distances, ids = _database.text_search(params.q, _clamp_k(params.k), _search_filter(params))
+
+            return _results_response(distances, ids, params)
 
         # Get information about the requested search image
         item = _database[ image_id ]
@@ -60,20 +106,21 @@ class ImageSearchResource(Resource):
         # Fetch the image and get the feature_vector
         # Actually this is REALLY STUPID; the feature_vector is in the database!
         # We just need to store it in a canonical format
-        response = requests.get(url)
+        with metrics.stage("fetch_image"):
+            try:
+                response = requests.get(url, timeout = admission.remaining_seconds())
+            except requests.Timeout:
+                raise admission.Overloaded("timed out fetching %s" % url, 1, "deadline")
+
         image = Image.open(io.BytesIO(response.content))
-        feature_vector = _get_feature_vector(image)
+        feature_vector, classes, query_regions = _get_feature_vector(image)
 
         #feature_vector = _string_to_float_array( feature_vector )
 
-        results = _database.query_image(feature_vector, params.k)
-        #print("result = ", results)
-
-        if _args.s3:
-            for result in results:
-                result["filename"] = _args.s3 + result["filename"]
+        with metrics.stage("search"):
+            distances, ids = _database.search(feature_vector, _clamp_k(params.k), classes, _search_filter(params), query_regions, params.q, _diversity(params))
 
-        return jsonify(results)
+        return _results_response(distances, ids, params)
 
 
     def post(self):
@@ -91,17 +138,138 @@ class ImageSearchResource(Resource):
             #print("unsupported media type")
             return "415 Unsupported Media Type"    
 
+        params = _parse_search_args()
+
+        if params.cursor:
+            return _page_response(params)
+
         image = Image.open( io.BytesIO(image_bytes) )
 
-        feature_vector = _get_feature_vector(image)
-        results = _database.query_image(feature_vector)
-        #print("result = ", results)
+        feature_vector, classes, query_regions = _get_feature_vector(image)
+        with metrics.stage("search"):
+            distances, ids = _database.search(feature_vector, _clamp_k(params.k), classes, _search_filter(params), query_regions, params.q, _diversity(params))
 
-        if _args.s3:
-            for result in results:
-                result["filename"] = _args.s3 + result["filename"]
+        return _results_response(distances, ids, params)
+
+
+def _parse_search_args():
+    params = _image_search_parser.parse_args()
+
+    # Clients can also ask for a stream with an Accept header
+    if "application/x-ndjson" in request.headers.get("Accept", ""):
+        params.stream = True
+
+    return params
+
+
+def _clamp_k(k):
+    return max(1, min(k, _args.max_k))
+
+
+def _describe(idx, distance):
+    result = _database.describe(idx, distance)
+
+    if _args.s3:
+        result["filename"] = _args.s3 + result["filename"]
+
+    if _thumbnails is not None:
+        result["thumbnail"] = "/v1/images/%d/thumbnail" % result["id"]
+
+    return result
+
+
+# Return search results as one JSON list, as newline-delimited JSON, or as the first page of a cursor
+def _results_response(distances, ids, params):
+    if params.page_size:
+        query_id = _result_cache.add(distances, ids)
+        return _page(query_id, distances, ids, 0, params.page_size, params)
+
+    if params.stream:
+        return _stream(distances, ids)
+
+    with metrics.stage("hydrate"):
+        results = [_describe(ids[i], distances[i]) for i in range(len(ids))]
+
+    return jsonify(results)
+
+
+# Serve a page from the results cached for a cursor, without searching again.
+# Pages are the size of the first one, unless the request asks for another page_size.
+def _page_response(params):
+    query_id, offset, page_size = parse_cursor(params.cursor)
+    cached = _result_cache.get(query_id) if query_id else None
+
+    if cached is None:
+        return {"message" : "cursor %s has expired; search again" % params.cursor}, 410
+
+    return _page(query_id, cached.distances, cached.ids, offset, params.page_size or page_size, params)
+
+
+def _page(query_id, distances, ids, offset, page_size, params):
+    page_size = page_size or _args.page_size
+    stop = min(offset + page_size, len(ids))
+    next_cursor = make_cursor(query_id, stop, page_size) if stop < len(ids) else None
+
+    if params.stream:
+        return _stream(distances[offset:stop], ids[offset:stop], {"next_cursor" : next_cursor, "total" : len(ids)})
+
+    with metrics.stage("hydrate"):
+        results = [_describe(ids[i], distances[i]) for i in range(offset, stop)]
+
+    return jsonify({
+            "results" : results,
+            "next_cursor" : next_cursor,
+            "total" : len(ids),
+            })
+
+
+# Stream results as newline-delimited JSON, fetching each description as it's sent, so clients can start rendering early.
+# trailer, if given, is sent as the last line.  Hydration is timed as the hydrate stage, not counting time spent sending.
+# The stream holds its admission slot until it's sent (see admission.admitted), and stops at the request's deadline,
+# with a last line {"message": ...} instead of the rest of the results and the trailer.
+def _stream(distances, ids, trailer = None):
+    deadline = g.deadline
+
+    def generate():
+        hydrate_seconds = 0.0
+        for i in range(len(ids)):
+            if time.time() > deadline:
+                metrics.observe_stage("hydrate", hydrate_seconds)
+                yield json.dumps({ "message" : "deadline passed after %d of %d results" % (i, len(ids)) }) + "\n"
+                return
+
+            start = time.time()
+            line = json.dumps(_describe(ids[i], distances[i])) + "\n"
+            hydrate_seconds += time.time() - start
+            yield line
 
-        return jsonify(results)
+        metrics.observe_stage("hydrate", hydrate_seconds)
+
+        if trailer is not None:
+            yield json.dumps(trailer) + "\n"
+
+    return Response(generate(), mimetype = "application/x-ndjson")
+
+
+# Build a SearchFilter from the request's query parameters; None if there aren't any
+def _search_filter(params):
+    path_prefix = params.path_prefix
+
+    # Filenames in the database don't include the --s3 prefix we add to results
+    if path_prefix and _args.s3 and path_prefix.startswith(_args.s3):
+        path_prefix = path_prefix[len(_args.s3):]
+
+    if not (params.classnames or path_prefix or params.id_min is not None or params.id_max is not None):
+        return None
+
+    return SearchFilter(params.classnames, path_prefix, params.id_min, params.id_max)
+
+
+# The request's Diversity: its diversify and diversity parameters, else the server's defaults
+def _diversity(params):
+    default = diversify.from_args(_args)
+    return diversify.Diversity(params.diversify or default.method,
+                               params.diversity if params.diversity is not None else default.diversity)
 
 
 class ImageListResource(Resource):
@@ -117,7 +285,9 @@ class ImageListResource(Resource):
     def get(self):
         return { 
                 "database_name" : _database.name,
-                "num_images" : len(_database) 
+                "num_images" : len(_database),
+                "model" : _model["id"] if _model else None,
+                "dim" : _database.shape[1]
                 }
     
 
@@ -144,6 +314,27 @@ class ImageResource(Resource):
                }
 
 
+# GET /v1/images/<id>/thumbnail: a small JPEG from the index's thumbnail store (see thumbnails.py).
+# Thumbnails only change when the store is rebuilt, so clients and CDNs can cache them, and revalidate with the ETag.
+class ThumbnailResource(Resource):
+    def get(self, image_id):
+        if _thumbnails is None:
+            return {"message" : "%s has no thumbnails; build them with index.py --thumbnails" % _database.name}, 404
+
+        if image_id < 0 or image_id >= len(_thumbnails):
+            return {"message" : "image %d not found" % image_id}, 404
+
+        with metrics.stage("thumbnail"):
+            response = Response(_thumbnails[image_id], mimetype = "image/jpeg")
+
+        response.set_etag(_thumbnails.etag(image_id))
+        response.cache_control.public = True
+        response.cache_control.max_age = _args.thumbnail_max_age
+
+        # 304 Not Modified if the client's If-None-Match is still current
+        return response.make_conditional(request)
+
+
 def _main():
     parser = argparse.ArgumentParser()
     parser.add_argument("database", help="database of images")
@@ -156,6 +347,23 @@ def _main():
     parser.add_argument("--width", help="resize image before extracting features", default=256)
     parser.add_argument("--height", help="resize image before extracting features", default=256)
     parser.add_argument("--verbose", "-v", help="print verbose query information", action="store_true")
+    parser.add_argument("--class_partitions", help="search only the images whose predicted class matches the query's likely classes", action="store_true")
+    parser.add_argument("--num_classes", help="number of classes in the feature_server's classifier", type=int, default=1000)
+    parser.add_argument("--min_class_confidence", help="fall back to a global search if the query's top class probability is below this", type=float, default=0.5)
+    parser.add_argument("--class_coverage", help="search the query's most likely classes until their probabilities sum to this", type=float, default=0.9)
+    parser.add_argument("--max_classes", help="maximum number of class partitions to search", type=int, default=5)
+    search.add_arguments(parser)
+    snapshot.add_arguments(parser)
+    regions.add_arguments(parser)
+    diversify.add_arguments(parser)
+    parser.add_argument("--max_k", help="maximum number of search results per query", type=int, default=10000)
+    parser.add_argument("--page_size", help="default page size for paginated search results", type=int, default=50)
+    parser.add_argument("--cursor_cache", help="number of paginated searches to keep cached", type=int, default=1000)
+    parser.add_argument("--cursor_ttl", help="seconds to keep paginated search results cached", type=int, default=300)
+    parser.add_argument("--thumbnails", help="thumbnail store to serve; default <database>.thumbnails, if it exists")
+    parser.add_argument("--thumbnail_max_age", help="seconds clients may cache thumbnails", type=int, default=86400)
+    admission.add_arguments(parser, max_concurrent = 16)
+    profiling.add_arguments(parser)
    
     global _args
     _args = parser.parse_args()
@@ -176,6 +384,20 @@ def _main():
     global _database
     _database = Database(_args)
     _database.load_database(_args.database)
+
+    global _thumbnails
+    _thumbnails = _load_thumbnails()
+
+    # Queries must be featurized by the model that made the index
+    global _model
+    _model = _database.metadata.get("model")
+    _check_model()
+
+    global _result_cache
+    _result_cache = ResultCache(_args.cursor_cache, _args.cursor_ttl)
+
+    global _admission
+    _admission = admission.Admission(_args.max_concurrent, _args.max_queue, _args.max_batch_queue)
     
     # Start the web server
     global _app
@@ -186,6 +408,13 @@ def _main():
     # can invoke REST APIs on the backend
     CORS(_app, origins = "*")
 
+    # Trace ids, per-stage timing, and Prometheus metrics on /metrics
+    metrics.install(_app, log = _args.verbose)
+
+    # On-demand CPU profiles and memory stats, only if asked for
+    if _args.admin:
+        profiling.install(_app, _memory_stats)
+
     _api = Api(_app)
 
     _api.add_resource(ImageListResource,
@@ -195,6 +424,9 @@ def _main():
     _api.add_resource(ImageResource,
             "/v1/images/<int:image_id>")
 
+    _api.add_resource(ThumbnailResource,
+            "/v1/images/<int:image_id>/thumbnail")
+
     _api.add_resource(ImageSearchResource,
             "/v1/search",
             "/v1/search/",
@@ -204,6 +436,68 @@ def _main():
     
 
 
+# Check the feature_server has the index's model, and can return the regions --region_search needs; otherwise
+# region search falls back to the global vector.  Only warns, since the feature_server may be started later.
+def _check_model():
+    global _query_regions
+
+    if _model is None:
+        print("WARNING: %s doesn't record the model that made it; queries use the feature_server's default model" % _args.database)
+    elif _model["dim"] != _database.shape[1]:
+        print("WARNING: %s says model %s makes %d features, but it has %d" % (_args.database, _model["id"], _model["dim"], _database.shape[1]))
+
+    url = "http://" + _args.features_host + ":" + str(_args.features_port) + "/v1/models"
+    try:
+        reply = requests.get(url, timeout = 5).json()
+        hosted = dict((model["id"], model) for model in reply["models"])
+        model_id = _model["id"] if _model else reply["default"]
+    except (requests.RequestException, ValueError, KeyError) as ex:
+        print("WARNING: can't list the feature_server's models at %s: %s" % (url, ex))
+        return
+
+    if model_id not in hosted:
+        print("WARNING: the feature_server doesn't have model %s, which made %s; it has %s" % (model_id, _args.database, ", ".join(hosted)))
+        return
+
+    print("Routing queries to model %s" % model_id)
+
+    if _database.region_levels and not hosted[model_id].get("regions"):
+        print("WARNING: the feature_server's model %s can't return regions (it's --jit or --quantize); searching with the global vector instead" % model_id)
+        _query_regions = False
+
+
+# The thumbnail store for the database, or None
+def _load_thumbnails():
+    path = _args.thumbnails or thumbnails.path_for(_args.database)
+    if not os.path.exists(path):
+        if _args.thumbnails:
+            print("Error: thumbnails %s not found; not serving thumbnails" % path)
+        return None
+
+    try:
+        store = thumbnails.ThumbnailStore(path)
+    except (IOError, ValueError) as ex:
+        print("Error: %s; not serving thumbnails" % ex)
+        return None
+
+    # Thumbnails are looked up by image id, so they must match the index one for one
+    if len(store) != len(_database):
+        print("Error: %s has %d thumbnails, but %s has %d images; not serving thumbnails" %
+              (path, len(store), _args.database, len(_database)))
+        return None
+
+    print("Serving %d thumbnails (%.1f MB) from %s" % (len(store), store.nbytes / 1e6, path))
+    return store
+
+
+def _memory_stats():
+    stats = _database.memory_stats()
+    stats["result_cache_entries"] = len(_result_cache)
+    if _thumbnails is not None:
+        stats["thumbnails_mb"] = _thumbnails.nbytes / 1e6
+    return stats
+
+
 # Convert feature vector from string to array of floats
 # works with the truncated 7.3 floats we write to the database
 def _string_to_float_array(str):
@@ -226,24 +520,81 @@ def _string_to_float_array(str):
 
 
 # curl -X POST http://localhost:32817/featurize -H "Content-type: application/octet-stream" --data-binary @$@  
+# Returns the feature vector, the top-k (label, probability) class predictions if we're searching by class partition,
+# and the regional descriptors if we're searching regions
 def _get_feature_vector(image):
-   # Resize
-   size = (_args.width, _args.height)
-   img = image.resize(size)
+   # Image.open() is lazy; decode now so decode and resize are timed separately
+   with metrics.stage("decode"):
+       image.load()
 
-   byte_array = io.BytesIO()
-   img.save(byte_array, format='PNG')
-   data = byte_array.getvalue()
-
-   response = requests.post(url="http://" + _args.features_host + ":" + str(_args.features_port) + "/v1/image_features",
-                       data=data,
-                       headers={'Content-Type': 'application/octet-stream'})
+   # Resize
+   with metrics.stage("resize"):
+       size = (_args.width, _args.height)
+       img = image.resize(size)
+
+   with metrics.stage("png_encode"):
+       byte_array = io.BytesIO()
+       img.save(byte_array, format='PNG')
+       data = byte_array.getvalue()
+
+   params = {}
+   if _model:
+       params["model"] = _model["id"]
+
+   if _args.class_partitions:
+       params["classes"] = _args.max_classes
+
+   # The same levels of regions as the index has
+   if _database.region_levels and _query_regions:
+       params["regions"] = _database.region_levels
+
+   # Pass our trace id along, so the feature_server's log lines can be matched to ours,
+   # and our priority and remaining deadline, so it sheds what we can't use; give up when the deadline passes
+   headers = {'Content-Type': 'application/octet-stream',
+              metrics.TRACE_HEADER: metrics.current_trace_id() or ""}
+   headers.update(admission.forward_headers())
+
+   with metrics.stage("feature_server"):
+       try:
+           response = requests.post(url="http://" + _args.features_host + ":" + str(_args.features_port) + "/v1/image_features",
+                               params=params,
+                               data=data,
+                               headers=headers,
+                               timeout=admission.remaining_seconds())
+       except requests.Timeout:
+           raise admission.Overloaded("feature_server timed out", 1, "upstream")
+
+   if response.status_code == 503:
+       raise admission.Overloaded("feature_server is overloaded", float(response.headers.get("Retry-After", 1)), "upstream")
+
+   # e.g. 400 if its model can't return the regions we asked for, since the feature_server was restarted
+   try:
+       response.raise_for_status()
+   except requests.HTTPError:
+       try:
+           message = response.json()["message"]
+       except (ValueError, KeyError, TypeError):
+           message = response.text.strip()
+       raise BadGateway("feature_server refused the query with %d: %s" % (response.status_code, message))
+
+   # Vectors from another model can't be compared with the index's
+   if _model and response.headers.get("X-Model-Id") != _model["id"]:
+       raise BadGateway("feature_server answered with model %s, but %s was made by %s" %
+                        (response.headers.get("X-Model-Id"), _database.name, _model["id"]))
+
+   if "classes" in params or "regions" in params:
+       reply = response.json()
+       if _args.class_partitions and reply["num_classes"] != _args.num_classes:
+           print("WARNING: feature_server has %d classes, but --num_classes is %d" % (reply["num_classes"], _args.num_classes))
+
+       query_regions = np.array(reply["regions"], dtype = np.float32) if reply.get("regions") else None
+       return np.array(reply["features"]), reply["classes"] if _args.class_partitions else None, query_regions
   
    response = response.text
 
    features = _string_to_float_array(response)
 
-   return features
+   return features, None, None
 
 
 if __name__ == "__main__":
@@ -0,0 +1,140 @@
+import numpy as np
+
+import packed
+from precision import CompactVectors
+
+#
+# Region-level search: several descriptors per image, so a query showing one object in a cluttered scene can match
+# the part of an indexed photo that contains it (and vice versa).
+#
+# feature_server.py?regions=<levels> returns R-MAC-style regional descriptors: the CNN's last spatial feature map,
+# max-pooled over a grid of overlapping square windows at each level (1 window at level 1, 2 x 2 at level 2, 3 x 3 at
+# level 3, ...), each L2-normalized.  index.py --regions <levels> stores them next to the index as a packed file
+# (see packed.py), with row offsets:
+#   <index>.regions           float16 descriptors, back to back, one row per region, in index order
+#   <index>.regions.offsets   image i's regions are rows [offsets[i], offsets[i + 1])
+# and records the levels in the index header, so the query_server asks for the same regions for its queries.
+#
+# A RegionIndex scores every query region against every indexed region in blocks (one matrix product per block,
+# straight from float16 / int8 codes, see precision.py), takes each indexed region's best match, and then each
+# image's best region: an image's similarity is max over (query region, image region) pairs of their cosine.
+# Distances are 1 - similarity.  The float16 file is searched in place, memory-mapped; only --precision int8
+# builds a (smaller) copy in RAM, and float32 would be no more exact than the float16 it's stored as.
+#
+# Regions are looked up by image id; index_tool.py merges and splits them along with their index.
+#
+
+DEFAULT_LEVELS = 2
+
+_dtype = np.float16
+_block_rows = 16384
+
+
+def path_for(index_path):
+    return index_path + ".regions"
+
+
+# Number of regions per image with the given levels
+def regions_per_image(levels):
+    return sum(level * level for level in range(1, levels + 1))
+
+
+# Appends each image's regional descriptors in index order; close() writes the offsets
+class RegionWriter(packed.PackedWriter):
+    # R is [regions x features]
+    def add(self, R):
+        R = np.asarray(R, dtype = _dtype)
+        packed.PackedWriter.add(self, np.ascontiguousarray(R).tobytes(), len(R))
+
+
+class RegionIndex(object):
+    def __init__(self, path, precision = "float32"):
+        self._path = path
+        self._offsets, row_bytes = packed.load(path)
+        self._counts = np.diff(self._offsets)
+
+        num_regions = int(self._offsets[-1])
+        item_size = np.dtype(_dtype).itemsize
+        if num_regions == 0 or row_bytes % item_size:
+            raise ValueError("%s doesn't hold %d regions of %s features" % (path, num_regions, np.dtype(_dtype).name))
+
+        R = np.memmap(path, dtype = _dtype, mode = "r", shape = (num_regions, row_bytes // item_size))
+        if precision == "int8":
+            self._R = CompactVectors(R, precision)
+            del R
+        else:
+            self._R = CompactVectors.wrap(R)
+
+
+    # Q is [query regions x features].  candidates is an optional sorted array of the image ids to search.
+    # Returns (distances, ids) of the k most similar images, nearest first.
+    def search(self, Q, k, candidates = None):
+        Q = np.atleast_2d(np.asarray(Q, dtype = np.float32))
+        if Q.shape[1] != self._R.shape[1]:
+            raise ValueError("query regions have %d features, but %s has %d" % (Q.shape[1], self._path, self._R.shape[1]))
+
+        Q = Q / np.maximum(np.linalg.norm(Q, axis = 1), 1e-12)[:, np.newaxis]
+
+        if candidates is None:
+            images = np.arange(len(self._counts), dtype = np.int64)
+            rows = None
+            num_rows = len(self._R)
+        else:
+            images = np.asarray(candidates, dtype = np.int64)
+            rows = self._region_rows(images)
+            num_rows = len(rows)
+
+        # Best match of each indexed region with any query region, scored a block of regions at a time
+        best = np.empty(num_rows, dtype = np.float32)
+        for start in range(0, num_rows, _block_rows):
+            block = slice(start, min(start + _block_rows, num_rows)) if rows is None else rows[start : start + _block_rows]
+            best[start : start + _block_rows] = self._R.dot(Q, block).max(axis = 0)
+
+        # Then each image's best region; the regions of an image are contiguous
+        counts = self._counts[images]
+        has_regions = counts > 0
+        starts = np.cumsum(counts) - counts
+
+        similarity = np.full(len(images), -np.inf, dtype = np.float32)
+        if num_rows:
+            similarity[has_regions] = np.maximum.reduceat(best, starts[has_regions])
+
+        k = min(k, int(np.count_nonzero(has_regions)))
+        if k <= 0:
+            return np.empty(0), np.empty(0, dtype = np.int64)
+
+        top = np.argpartition(-similarity, k - 1)[:k]
+        top = top[np.argsort(-similarity[top], kind = "mergesort")]
+
+        return 1.0 - similarity[top].astype(np.float64), images[top]
+
+
+    # Region rows of the given images, in image order
+    def _region_rows(self, images):
+        counts = self._counts[images]
+        starts = np.repeat(self._offsets[images], counts)
+        local = np.arange(counts.sum(), dtype = np.int64) - np.repeat(np.cumsum(counts) - counts, counts)
+        return starts + local
+
+
+    def __len__(self):
+        return len(self._counts)
+
+
+    # Properties
+    def _get_num_regions(self):
+        return len(self._R)
+
+    def _get_num_features(self):
+        return self._R.shape[1]
+
+    def _get_vectors(self):
+        return self._R
+
+    num_regions     = property( _get_num_regions, None )
+    num_features    = property( _get_num_features, None )
+    vectors         = property( _get_vectors, None )
+
+
+def add_arguments(parser):
+    parser.add_argument("--region_search", help="search with regional descriptors, if the index has them (see regions.py)", action="store_true")
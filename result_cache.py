@@ -0,0 +1,82 @@
+import collections
+import threading
+import time
+import uuid
+
+#
+# Cache of search results, keyed by query cursor, for paginating deep result lists.
+#
+# The first page of a search finds all k neighbors once and caches the sorted (distances, ids).
+# Later pages slice the cached arrays instead of re-running the search (and re-featurizing the image).
+# Cursors are "<query id>:<offset>:<page size>", so fetching the same page twice returns the same results, and later
+# pages keep the first page's size.
+#
+# LRU with a time-to-live; entries are small (two arrays of k numbers), so the default size is generous.
+#
+
+CachedResults = collections.namedtuple("CachedResults", "distances, ids, created")
+
+
+class ResultCache(object):
+    def __init__(self, max_entries = 1000, ttl = 300):
+        self._max_entries = max_entries
+        self._ttl = ttl
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+
+    # Cache a result list; returns its query id
+    def add(self, distances, ids):
+        query_id = uuid.uuid4().hex
+
+        with self._lock:
+            self._entries[query_id] = CachedResults(distances, ids, time.time())
+            self._expire()
+
+        return query_id
+
+
+    # Returns the CachedResults for a query id, or None if it has expired
+    def get(self, query_id):
+        with self._lock:
+            entry = self._entries.get(query_id)
+            if entry is None:
+                return None
+
+            if time.time() - entry.created > self._ttl:
+                del self._entries[query_id]
+                return None
+
+            # Most recently used goes to the end
+            self._entries.pop(query_id)
+            self._entries[query_id] = entry
+
+            return entry
+
+
+    def _expire(self):
+        now = time.time()
+
+        while self._entries:
+            query_id, entry = next(iter(self._entries.items()))
+            if len(self._entries) <= self._max_entries and now - entry.created <= self._ttl:
+                break
+
+            del self._entries[query_id]
+
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def make_cursor(query_id, offset, page_size):
+    return "%s:%d:%d" % (query_id, offset, page_size)
+
+
+# Returns (query id, offset, page size), or (None, None, None) if the cursor is malformed
+def parse_cursor(cursor):
+    try:
+        query_id, offset, page_size = cursor.split(":")
+        return query_id, max(int(offset), 0), max(int(page_size), 1)
+    except (AttributeError, ValueError):
+        return None, None, None
@@ -7,6 +7,7 @@
 #       for result[1..5]
 #           if result == class, +1 top-1, top-5
 
+import io
 import os
 import sys
 import argparse
@@ -146,7 +147,12 @@ def query_file(input_path, args):
         _classname = matches[i]["class"]
         _filename  = matches[i]["filename"]
         _score     = matches[i]["distance"]
-        files.append(_filename)
+
+        # Show the server's thumbnail if it has one, rather than downloading the full-size original
+        if "thumbnail" in matches[i]:
+            files.append("http://%s:%d%s" % (args.host, args.port, matches[i]["thumbnail"]))
+        else:
+            files.append(_filename)
 
         if not args.summary:
             print("class = [%s] filename = [%s] score = [%f]" % (_classname, _filename, _score))
@@ -181,7 +187,7 @@ def _show_images(files):
     grid = Image.new("RGBA", (grid_width, grid_height), color=(255,255,255,0))
 
     # Display the query image on left
-    with Image.open( files.pop(0) ) as image:
+    with _open_image( files.pop(0) ) as image:
         image = image.resize((height, width), resample = Image.BILINEAR)
         grid.paste(image, box = (left, int(pad_h/2)))
         left += width + (2 * pad_w) 
@@ -193,7 +199,7 @@ def _show_images(files):
 
     # Display the query results on right
     for file in files:
-        with Image.open(file) as image:
+        with _open_image(file) as image:
             image = image.resize((height, width), resample = Image.BILINEAR)
             grid.paste(image, box = (left, int(pad_h/2)))
             left += width + pad_w 
@@ -201,6 +207,16 @@ def _show_images(files):
     grid.show()
 
 
+# Open a local image, or fetch one from a URL (e.g. a query_server thumbnail)
+def _open_image(file):
+    if file.startswith("http://") or file.startswith("https://"):
+        response = requests.get(file)
+        response.raise_for_status()
+        return Image.open(io.BytesIO(response.content))
+
+    return Image.open(file)
+
+
 
  
 if __name__ == "__main__":
@@ -0,0 +1,369 @@
+import os
+
+import joblib
+import numpy as np
+from sklearn.neighbors import NearestNeighbors
+
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
+from precision import CompactVectors, PRECISIONS
+
+#
+# Nearest-neighbor search backends for the Database.
+#
+# Every backend searches a [rows x features] matrix X and answers search(Q, k, candidates):
+#   Q           [queries x features] query vectors
+#   k           number of neighbors per query
+#   candidates  optional sorted array of row ids to restrict the search to (class partitions, filters).
+#               Small candidate sets are scanned exactly; large ones go to the ANN structure with a filter.
+# and returns (distances, ids), each [queries x k], nearest first.  If fewer than k rows are searchable,
+# the extra columns have id -1 and distance inf.
+#
+# Backends:
+#   brute   exact blocked matrix multiply in numpy
+#   knn     scikit-learn NearestNeighbors (the original Database search)
+#   hnsw    approximate, HNSW graph from hnswlib (optional: pip install hnswlib)
+#
+# Metrics: euclidean, cosine, or inner: 1 - q.x, i.e. cosine distance for unit-length (l2-normalized) vectors.
+#
+# X is stored at --precision (see precision.py) for the exact scans.  Exact scans rank rows in float32, then compute
+# the top-k distances in float64.  knn fits NearestNeighbors to the stored float32 vectors without copying them; at
+# float16 / int8 it has no float32 vectors to fit, so it scans the compact ones, like brute.  hnsw keeps float32
+# vectors in its graph, so it only runs at float32: reduced precision would add to its memory, not save it.
+#
+# save(directory) writes a backend's vectors and fitted structure (graph, trees) to files, and
+# load(directory, metric, args) maps them back in, without rebuilding anything; see snapshot.py.
+#
+
+_block_rows = 16384
+
+
+class SearchIndex(object):
+    def __init__(self, X, metric = "euclidean", args = None):
+        self._configure(metric, args)
+        self._X = CompactVectors(X, getattr(args, "precision", "float32"))
+
+        # Squared norms of every (stored) row, for computing distances to any subset of X
+        self._norms = np.empty(len(X), dtype = np.float32)
+        for start in range(0, len(X), _block_rows):
+            block = self._X[start : start + _block_rows]
+            self._norms[start : start + len(block)] = np.einsum("ij,ij->i", block, block)
+
+
+    def _configure(self, metric, args):
+        self._metric = metric
+        self._filter_brute_threshold = getattr(args, "filter_brute_threshold", 50000)
+
+
+    def search(self, Q, k, candidates = None):
+        raise NotImplementedError
+
+
+    # Write the vectors, norms and fitted structure to files in directory
+    def save(self, directory):
+        self._X.save(directory)
+        np.save(os.path.join(directory, "norms.npy"), self._norms)
+        self._save_structure(directory)
+
+
+    # Map a saved search index back in.  Arrays are memory-mapped read-only, so this takes seconds, not minutes.
+    @classmethod
+    def load(cls, directory, metric = "euclidean", args = None):
+        index = cls.__new__(cls)
+        index._configure(metric, args)
+        index._X = CompactVectors.load(directory, getattr(args, "precision", "float32"))
+        index._norms = np.load(os.path.join(directory, "norms.npy"), mmap_mode = "r")
+        index._load_structure(directory, args)
+        return index
+
+
+    # Backends with their own structure save and load it here
+    def _save_structure(self, directory):
+        pass
+
+    def _load_structure(self, directory, args):
+        pass
+
+
+    # Exact search over all of X, or over a subset of rows.
+    # Scans X in blocks so the [queries x block] distance matrix stays small, keeping a running top-k.
+    def exact_search(self, Q, k, candidates = None):
+        Q = np.atleast_2d(Q)
+        Q32 = Q.astype(np.float32)
+        num_rows = len(self._X) if candidates is None else len(candidates)
+
+        best_scores = np.full((len(Q), 0), np.inf, dtype = np.float32)
+        best_ids = np.full((len(Q), 0), -1, dtype = np.int64)
+
+        for start in range(0, num_rows, _block_rows):
+            stop = min(start + _block_rows, num_rows)
+
+            if candidates is None:
+                ids = np.arange(start, stop)
+                scores = self._scores(Q32, self._X.dot(Q32, slice(start, stop)), self._norms[start:stop])
+            else:
+                ids = candidates[start:stop]
+                scores = self._scores(Q32, self._X.dot(Q32, ids), self._norms[ids])
+
+            scores = np.concatenate((best_scores, scores), axis = 1)
+            ids = np.concatenate((best_ids, np.broadcast_to(ids, (len(Q), len(ids)))), axis = 1)
+
+            if scores.shape[1] > k:
+                nearest = np.argpartition(scores, k - 1, axis = 1)[:, :k]
+                scores = np.take_along_axis(scores, nearest, axis = 1)
+                ids = np.take_along_axis(ids, nearest, axis = 1)
+
+            best_scores, best_ids = scores, ids
+
+        distances = self._distances(Q, best_ids)
+        order = np.argsort(distances, axis = 1)
+        distances = np.take_along_axis(distances, order, axis = 1)
+        best_ids = np.take_along_axis(best_ids, order, axis = 1)
+
+        return _pad(distances, best_ids, k)
+
+
+    # Scores that rank rows the same way as their distance to each query, but are cheaper to compute:
+    # for euclidean, ||x||^2 - 2 x.q  (the ||q||^2 term and the sqrt are the same for every row)
+    def _scores(self, Q, dots, norms):
+        if self._metric == "inner":
+            return 1.0 - dots
+
+        if self._metric == "cosine":
+            q_norms = np.linalg.norm(Q, axis = 1)[:, np.newaxis]
+            return 1.0 - dots / (q_norms * np.sqrt(norms)[np.newaxis, :] + np.float32(1e-12))
+
+        dots *= -2.0
+        dots += norms[np.newaxis, :]
+        return dots
+
+
+    # Distances from each query to its top-k rows, in float64: the float32 scores lose precision to cancellation
+    def _distances(self, Q, ids):
+        Q = Q.astype(np.float64)
+        X = self._X[ids.ravel()].astype(np.float64).reshape(ids.shape + (Q.shape[1],))
+        return exact_distances(Q[:, np.newaxis, :], X, self._metric)
+
+
+    # Filtered search: exact scan of the candidates if there are few enough of them
+    def _use_exact(self, k, candidates):
+        return candidates is not None and len(candidates) <= max(k, self._filter_brute_threshold)
+
+
+    # Properties
+    def _get_shape(self):
+        return self._X.shape
+
+    def _get_X(self):
+        return self._X
+
+    def _get_norms(self):
+        return self._norms
+
+    shape       = property( _get_shape, None )
+    X           = property( _get_X, None )
+    norms       = property( _get_norms, None )
+
+
+class BruteForceSearch(SearchIndex):
+    def __init__(self, X, metric = "euclidean", args = None):
+        SearchIndex.__init__(self, X, metric, args)
+        print("BruteForceSearch: %d x %d, %s" % (X.shape[0], X.shape[1], metric))
+
+
+    def search(self, Q, k, candidates = None):
+        return self.exact_search(Q, k, candidates)
+
+
+class KnnSearch(SearchIndex):
+    def __init__(self, X, metric = "euclidean", args = None):
+        SearchIndex.__init__(self, X, metric, args)
+
+        if metric == "cosine":
+            # sklearn's built-in cosine: a Python callable is called one pair of rows at a time
+            self._knn = NearestNeighbors(n_neighbors=5, algorithm="brute", metric="cosine", n_jobs=1)
+        else:
+            # inner: for unit vectors, euclidean ranks the same as inner product, and is much faster than a Python metric
+            self._knn = NearestNeighbors(n_neighbors=5, algorithm="auto", metric="euclidean", n_jobs=1)
+
+        # Fit to the stored vectors, so there's one float32 copy of them, not two.
+        # At reduced precision there's no float32 copy to fit; scan the compact vectors instead.
+        if self._X.precision != "float32":
+            print("KnnSearch: %s vectors, scanned exactly (NearestNeighbors needs float32)" % self._X.precision)
+            self._knn = None
+            return
+
+#        self.knn = NearestNeighbors(n_neighbors=5, algorithm="ball_tree", metric="euclidean", n_jobs=4)         # also consider Chebyshev
+        self._knn.fit(self._X[:])
+        print(self._knn)
+
+
+    def search(self, Q, k, candidates = None):
+        # NearestNeighbors can't filter, but it's exact anyway: scanning the candidates is never slower
+        if candidates is not None or self._knn is None:
+            return self.exact_search(Q, k, candidates)
+
+        Q = np.atleast_2d(Q)
+        distances, ids = self._knn.kneighbors(Q, min(k, len(self._X)), return_distance=True)
+
+        # ||q - x||^2 = 2 - 2 q.x for unit vectors
+        if self._metric == "inner":
+            distances = distances * distances / 2.0
+
+        return _pad(distances, ids, k)
+
+
+    def _save_structure(self, directory):
+        if self._knn is not None:
+            joblib.dump(self._knn, os.path.join(directory, "knn.joblib"))
+
+    def _load_structure(self, directory, args):
+        self._knn = None
+        if self._X.precision == "float32":
+            self._knn = joblib.load(os.path.join(directory, "knn.joblib"), mmap_mode = "r")
+
+
+class HnswSearch(SearchIndex):
+    # The graph holds its own float32 copy of the vectors, and unfiltered searches never read the compact ones
+    def _configure(self, metric, args):
+        SearchIndex._configure(self, metric, args)
+
+        precision = getattr(args, "precision", "float32")
+        if precision != "float32":
+            raise ValueError("the hnsw backend keeps float32 vectors in its graph, so --precision %s would use more memory, "
+                             "not less; use --backend brute or knn" % precision)
+
+
+    def __init__(self, X, metric = "euclidean", args = None):
+        SearchIndex.__init__(self, X, metric, args)
+
+        if hnswlib is None:
+            raise ImportError("the hnsw backend requires hnswlib: pip install hnswlib")
+
+        self._ef = getattr(args, "hnsw_ef", 64)
+        self._index = hnswlib.Index(space = _hnsw_spaces[metric], dim = X.shape[1])
+        self._index.init_index(max_elements = len(X), M = getattr(args, "hnsw_m", 16), ef_construction = getattr(args, "hnsw_ef_construction", 200))
+
+        print("HnswSearch: building graph for %d x %d, %s..." % (X.shape[0], X.shape[1], metric))
+        self._index.add_items(X, np.arange(len(X)))
+
+        # Build with every core; query single-threaded, the web server already runs requests in parallel
+        self._index.set_num_threads(1)
+
+
+    def _save_structure(self, directory):
+        self._index.save_index(os.path.join(directory, "hnsw.bin"))
+
+    def _load_structure(self, directory, args):
+        if hnswlib is None:
+            raise ImportError("the hnsw backend requires hnswlib: pip install hnswlib")
+
+        self._ef = getattr(args, "hnsw_ef", 64)
+        self._index = hnswlib.Index(space = _hnsw_spaces[self._metric], dim = self._X.shape[1])
+        self._index.load_index(os.path.join(directory, "hnsw.bin"), max_elements = len(self._X))
+        self._index.set_num_threads(1)
+
+
+    def search(self, Q, k, candidates = None):
+        if self._use_exact(k, candidates):
+            return self.exact_search(Q, k, candidates)
+
+        Q = np.atleast_2d(Q).astype(np.float32)
+        k_ann = min(k, len(self._X) if candidates is None else len(candidates))
+        self._index.set_ef(max(self._ef, k_ann))
+
+        if candidates is None:
+            ids, distances = self._index.knn_query(Q, k = k_ann)
+        else:
+            # Let the graph walk skip rows that don't pass the filter, rather than over-fetching and filtering after
+            mask = np.zeros(len(self._X), dtype = bool)
+            mask[candidates] = True
+            try:
+                ids, distances = self._index.knn_query(Q, k = k_ann, filter = lambda i: bool(mask[i]))
+            except TypeError:
+                # hnswlib < 0.7 has no filter support
+                return self.exact_search(Q, k, candidates)
+
+        # hnswlib returns squared L2 distances
+        if self._metric == "euclidean":
+            distances = np.sqrt(np.maximum(distances, 0.0))
+
+        return _pad(distances.astype(np.float64), ids.astype(np.int64), k)
+
+
+_hnsw_spaces = {
+    "euclidean" : "l2",
+    "cosine" : "cosine",
+    "inner" : "ip",
+}
+
+
+_backends = {
+    "brute" : BruteForceSearch,
+    "knn"   : KnnSearch,
+    "hnsw"  : HnswSearch,
+}
+
+
+def backends():
+    return sorted(_backends.keys())
+
+
+def create(backend, X, metric = "euclidean", args = None):
+    if backend not in _backends:
+        raise ValueError("unknown search backend %s; expected one of %s" % (backend, ", ".join(backends())))
+
+    return _backends[backend](X, metric, args)
+
+
+def load(backend, directory, metric = "euclidean", args = None):
+    if backend not in _backends:
+        raise ValueError("unknown search backend %s; expected one of %s" % (backend, ", ".join(backends())))
+
+    return _backends[backend].load(directory, metric, args)
+
+
+# Backend name of a search index
+def backend_of(index):
+    for name, cls in _backends.items():
+        if type(index) is cls:
+            return name
+
+    return None
+
+
+def add_arguments(parser):
+    parser.add_argument("--backend", help="search backend [%s] default knn" % ", ".join(backends()), choices=backends(), default="knn")
+    parser.add_argument("--filter_brute_threshold", help="filtered searches with at most this many candidates are scanned exactly instead of using the ANN index", type=int, default=50000)
+    parser.add_argument("--hnsw_m", help="hnsw: graph out-degree", type=int, default=16)
+    parser.add_argument("--hnsw_ef_construction", help="hnsw: search depth while building the graph", type=int, default=200)
+    parser.add_argument("--hnsw_ef", help="hnsw: search depth while querying", type=int, default=64)
+    parser.add_argument("--precision", help="storage precision of the search matrix [%s] default float32" % ", ".join(PRECISIONS), choices=PRECISIONS, default="float32")
+    parser.add_argument("--rerank", help="float16 / int8: re-rank rerank * k results with the exact features", type=int, default=4)
+
+
+# Distances between vectors (broadcasting over leading dimensions)
+def exact_distances(Q, X, metric = "euclidean"):
+    if metric == "inner":
+        return 1.0 - np.sum(Q * X, axis = -1)
+
+    if metric == "cosine":
+        dots = np.sum(Q * X, axis = -1)
+        return 1.0 - dots / (np.linalg.norm(Q, axis = -1) * np.linalg.norm(X, axis = -1) + 1e-12)
+
+    return np.linalg.norm(Q - X, axis = -1)
+
+
+# Pad results out to k columns with id -1, distance inf
+def _pad(distances, ids, k):
+    if distances.shape[1] >= k:
+        return distances, ids
+
+    missing = k - distances.shape[1]
+    distances = np.concatenate((distances, np.full((len(distances), missing), np.inf)), axis = 1)
+    ids = np.concatenate((ids, np.full((len(ids), missing), -1, dtype = np.int64)), axis = 1)
+
+    return distances, ids
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import time
+
+import search
+
+#
+# Build the Database's search structure offline, so the query_server starts in seconds instead of minutes.
+#
+# Loading an index means parsing every feature vector from ASCII, building the metadata index, and fitting the search
+# backend (sklearn trees, an HNSW graph).  A snapshot saves all of that next to the index, in <index>.snapshot/:
+#   manifest.json       the settings it was built with, and the size and mtime of the index it was built from
+#   *.npy               vectors (at --precision), norms, and metadata index arrays; memory-mapped at load
+#   knn.joblib          knn: the fitted NearestNeighbors, with its arrays memory-mapped at load
+#   hnsw.bin            hnsw: the graph
+#
+# The Database uses the snapshot if it's up to date and was built with the same backend, metric and precision
+# (and HNSW build parameters); otherwise it says why, and loads the index the slow way.
+#
+#   python snapshot.py caltech256.index --backend brute --metric cosine --precision int8
+#   python query_server.py caltech256.index --backend brute --metric cosine --precision int8
+#
+
+_version = 2
+_manifest = "manifest.json"
+
+
+def _main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("database", help="index to build a snapshot for")
+    parser.add_argument("--metric", help="similariity metric [euclidean, cosine] default euclidean", default="euclidean")
+    parser.add_argument("--verbose", "-v", help="print verbose information", action="store_true")
+    search.add_arguments(parser)
+    args = parser.parse_args()
+
+    if not os.path.exists(args.database):
+        print("Error: %s not found" % args.database)
+        return -1
+
+    build(args.database, args)
+    return 0
+
+
+def directory(index_path):
+    return index_path + ".snapshot"
+
+
+# Load the index the slow way, and save its search structure as a snapshot
+def build(index_path, args):
+    from database import Database
+
+    start = time.time()
+    args.ignore_snapshot = True
+    database = Database(args)
+    database.load_database(index_path)
+    print("Loaded %s in %.1f s" % (index_path, time.time() - start))
+
+    # Write a new snapshot next to the old one, then swap, so a server starting meanwhile never sees half of one
+    path = directory(index_path)
+    temp = path + ".tmp"
+    if os.path.exists(temp):
+        shutil.rmtree(temp)
+    os.makedirs(temp)
+
+    manifest = database.save_snapshot(temp)
+    manifest["version"] = _version
+    manifest["index"] = _index_stamp(index_path)
+    manifest["settings"] = _settings(args)
+    manifest["created"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+
+    with open(os.path.join(temp, _manifest), "wt") as f:
+        json.dump(manifest, f, indent = 2)
+
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(temp, path)
+
+    print("Wrote %s in %.1f s" % (path, time.time() - start))
+    return path
+
+
+# Returns the manifest of an up-to-date snapshot for the index and args, or None
+def find(index_path, args):
+    path = os.path.join(directory(index_path), _manifest)
+    if getattr(args, "ignore_snapshot", False) or not os.path.exists(path):
+        return None
+
+    with open(path, "rt") as f:
+        manifest = json.load(f)
+
+    if manifest.get("version") != _version:
+        reason = "it's version %s, expected %d" % (manifest.get("version"), _version)
+    elif manifest.get("index") != _index_stamp(index_path):
+        reason = "the index has changed since it was built"
+    elif manifest.get("settings") != _settings(args):
+        reason = "it was built with %s, not %s" % (manifest.get("settings"), _settings(args))
+    else:
+        return manifest
+
+    print("Ignoring snapshot %s: %s" % (directory(index_path), reason))
+    return None
+
+
+# What a snapshot depends on, besides the index itself
+def _settings(args):
+    settings = {
+        "backend" : getattr(args, "backend", "knn"),
+        "metric" : args.metric,
+        "precision" : getattr(args, "precision", "float32"),
+    }
+
+    if settings["backend"] == "hnsw":
+        settings["hnsw_m"] = getattr(args, "hnsw_m", 16)
+        settings["hnsw_ef_construction"] = getattr(args, "hnsw_ef_construction", 200)
+
+    return settings
+
+
+def _index_stamp(index_path):
+    stat = os.stat(index_path)
+    return { "size" : stat.st_size, "mtime" : int(stat.st_mtime) }
+
+
+def add_arguments(parser):
+    parser.add_argument("--ignore_snapshot", help="load the index the slow way, even if it has an up-to-date snapshot", action="store_true")
+
+
+if __name__ == "__main__":
+    sys.exit(_main())
@@ -0,0 +1,166 @@
+import os
+import re
+
+import numpy as np
+import pandas as pd
+
+#
+# Inverted index over the words in every image's classname and path, for text queries ("dog", "golden retriever").
+#
+# Built by the Database on its first text query (and saved in its snapshot): words are lowercase runs of letters
+# and digits, e.g. /data/caltech256/train/056.dog/056_0001.jpg -> data caltech256 train 056 dog 056 0001 jpg.
+# Postings are CSR, like the Database's other posting lists: the images containing word w (sorted by id) are
+# ids[offsets[w] : offsets[w + 1]], with weights[...] of 2 for words in the classname and 1 for words only in the path.
+#
+# A query's score for an image is the sum, over the query words it contains, of weight * idf(word), divided by the
+# best possible score, so 1.0 means every word matched in the classname.
+#
+# Words in more than half of the images (data, train, jpg, ...) say nothing about an image, so queries ignore them,
+# unless the query has no other words.  search(text, match_all = True) only returns images with every other word.
+#
+
+CLASSNAME_WEIGHT = 2.0
+PATH_WEIGHT = 1.0
+
+_word_pattern = r"[a-z0-9]+"
+
+# Queries ignore words in more than this fraction of the images
+_max_word_fraction = 0.5
+
+# Arrays saved in a snapshot
+_arrays = ["words", "offsets", "ids", "weights", "idf"]
+
+
+def tokenize(text):
+    return re.findall(_word_pattern, text.lower())
+
+
+class TextIndex(object):
+    def __init__(self, words, offsets, ids, weights, idf):
+        self._words = words
+        self._offsets = offsets
+        self._ids = ids
+        self._weights = weights
+        self._idf = idf
+
+
+    # classnames and filenames are per-image sequences of strings, in id order
+    @staticmethod
+    def build(classnames, filenames):
+        classnames = pd.Series(classnames).astype(str).str.lower().str.findall(_word_pattern)
+        filenames = pd.Series(filenames).astype(str).str.lower().str.findall(_word_pattern)
+
+        # One (id, word, weight) row per word occurrence; keep each word's best weight per image
+        postings = pd.concat([
+            pd.DataFrame({ "word" : classnames.explode(), "weight" : CLASSNAME_WEIGHT }),
+            pd.DataFrame({ "word" : filenames.explode(), "weight" : PATH_WEIGHT }),
+        ])
+        postings = postings.dropna().rename_axis("id").reset_index()
+        postings = postings.groupby(["word", "id"], sort = True)["weight"].max().reset_index()
+
+        codes, words = pd.factorize(postings["word"], sort = True)
+        counts = np.bincount(codes, minlength = len(words))
+
+        num_images = len(classnames)
+        idf = np.log(1.0 + num_images / np.maximum(counts, 1)).astype(np.float32)
+
+        return TextIndex(np.array([word.encode("utf-8") for word in words], dtype = bytes),
+                         np.concatenate(([0], np.cumsum(counts))).astype(np.int64),
+                         postings["id"].values.astype(np.int64),
+                         postings["weight"].values.astype(np.float32),
+                         idf)
+
+
+    # Returns (ids, scores) of the images matching any word of text (every word, with match_all), sorted by id,
+    # with scores in (0, 1]
+    def search(self, text, match_all = False):
+        words = self._query_words(text)
+        if not words:
+            return np.empty(0, dtype = np.int64), np.empty(0, dtype = np.float32)
+
+        ids = []
+        scores = []
+        best = 0.0
+        for word in words:
+            best += CLASSNAME_WEIGHT * self._word_idf(word)
+
+            w = self._lookup(word)
+            if w is None:
+                if match_all:
+                    return np.empty(0, dtype = np.int64), np.empty(0, dtype = np.float32)
+                continue
+
+            postings = slice(self._offsets[w], self._offsets[w + 1])
+            ids.append(self._ids[postings])
+            scores.append(self._weights[postings] * self._idf[w])
+
+        if not ids:
+            return np.empty(0, dtype = np.int64), np.empty(0, dtype = np.float32)
+
+        ids, inverse = np.unique(np.concatenate(ids), return_inverse = True)
+        scores = np.bincount(inverse, weights = np.concatenate(scores)).astype(np.float32)
+
+        # An image has each word at most once, so its number of postings is its number of matching words
+        if match_all:
+            everything = np.bincount(inverse) == len(words)
+            ids, scores = ids[everything], scores[everything]
+
+        return ids, scores / best
+
+
+    # The distinct words of text that say something about an image: near-universal ones are dropped, unless
+    # that would leave none
+    def _query_words(self, text):
+        words = sorted(set(tokenize(text)))
+        informative = [word for word in words if self._word_fraction(word) <= _max_word_fraction]
+        return informative or words
+
+
+    # Fraction of the images containing word, from its idf = log(1 + images / count)
+    def _word_fraction(self, word):
+        w = self._lookup(word)
+        if w is None:
+            return 0.0
+
+        return 1.0 / np.expm1(float(self._idf[w]))
+
+
+    # Index of word in the vocabulary, or None
+    def _lookup(self, word):
+        word = word.encode("utf-8")
+        w = np.searchsorted(self._words, word)
+        if w < len(self._words) and self._words[w] == word:
+            return int(w)
+
+        return None
+
+
+    # Words we've never seen count as much as the rarest word we have
+    def _word_idf(self, word):
+        w = self._lookup(word)
+        if w is None:
+            return float(self._idf.max()) if len(self._idf) else 1.0
+
+        return float(self._idf[w])
+
+
+    def save(self, directory):
+        for name in _arrays:
+            np.save(os.path.join(directory, "text_" + name + ".npy"), getattr(self, "_" + name))
+
+
+    # Memory-map a saved index, read-only
+    @staticmethod
+    def load(directory):
+        return TextIndex(*[np.load(os.path.join(directory, "text_" + name + ".npy"), mmap_mode = "r") for name in _arrays])
+
+
+    # Properties
+    def _get_num_words(self):
+        return len(self._words)
+
+    def _get_num_postings(self):
+        return len(self._ids)
+
+    num_words       = property( _get_num_words, None )
+    num_postings    = property( _get_num_postings, None )
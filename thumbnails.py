@@ -0,0 +1,79 @@
+import io
+import mmap
+import os
+
+from PIL import Image
+
+import packed
+
+#
+# Packed store of small JPEG thumbnails, one per image in an index, so clients can show search results without
+# fetching full-size originals from S3.
+#
+# index.py --thumbnails writes them next to the index as a packed file (see packed.py), with byte offsets:
+#   <index>.thumbnails           every thumbnail's JPEG bytes, back to back, in index order
+#   <index>.thumbnails.offsets   image i is bytes [offsets[i], offsets[i + 1])
+#
+# The query_server memory-maps both and serves GET /v1/images/<id>/thumbnail straight from the page cache.
+# Thumbnails are keyed by image id; index_tool.py merges and splits them along with their index.
+#
+
+DEFAULT_SIZE = 128
+DEFAULT_QUALITY = 85
+
+
+def path_for(index_path):
+    return index_path + ".thumbnails"
+
+
+# Returns the JPEG bytes of a thumbnail of image, at most size x size, keeping its aspect ratio
+def make_thumbnail(image, size = DEFAULT_SIZE, quality = DEFAULT_QUALITY):
+    image = image.convert("RGB")
+    image.thumbnail((size, size), Image.BILINEAR)
+
+    data = io.BytesIO()
+    image.save(data, format = "JPEG", quality = quality)
+    return data.getvalue()
+
+
+# Appends thumbnails in index order; close() writes the offsets
+class ThumbnailWriter(packed.PackedWriter):
+    def add(self, jpeg):
+        packed.PackedWriter.add(self, jpeg, len(jpeg))
+
+
+class ThumbnailStore(object):
+    def __init__(self, path):
+        self._path = path
+        self._offsets, _ = packed.load(path, 1, mmap_mode = "r")
+        stat = os.stat(path)
+
+        # mmap can't map an empty file
+        self._file = open(path, "rb")
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access = mmap.ACCESS_READ) if stat.st_size else b""
+
+        # Changes whenever the store is rebuilt, for ETags
+        self._version = "%x-%x" % (int(stat.st_mtime), stat.st_size)
+
+
+    # JPEG bytes of image idx's thumbnail
+    def __getitem__(self, idx):
+        if idx < 0 or idx >= len(self):
+            raise IndexError("no thumbnail for image %d; %s has %d" % (idx, self._path, len(self)))
+
+        return self._mmap[int(self._offsets[idx]) : int(self._offsets[idx + 1])]
+
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+
+    def etag(self, idx):
+        return "%s-%d" % (self._version, idx)
+
+
+    # Properties
+    def _get_nbytes(self):
+        return int(self._offsets[-1])
+
+    nbytes      = property( _get_nbytes, None )
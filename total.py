@@ -73,7 +73,7 @@ def main():
         print(top[i])
 
     print("Worst 5 classes:")
-    for i in xrange(1,6):
+    for i in range(1,6):
         print(top[ len(top) - i ])
 
 